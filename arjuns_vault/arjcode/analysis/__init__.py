@@ -1,4 +1,12 @@
-from .classifier_gui import classifier
+from .active_learning import UncertaintyOrder
+from .batch import run_batch
+from .classifier_gui import classifier, load_session, merge_sessions, shard_indices
+from .deferral import deferral_analysis
+from .folds import fold_analysis
 from .graphs import compare_models, roc, scatterplot, sen_spec
+from .multilabel import multilabel_analysis
+from .preview import get_preview_sample, preview_analysis
+from .rolling import RollingEvaluation, rolling_analysis
 from .stratified import stratified_analysis
+from .subgroups import find_worst_subgroups
 from .threshold import threshold_analysis
@@ -0,0 +1,3 @@
+from arjcode.analysis.batch import main
+
+main()
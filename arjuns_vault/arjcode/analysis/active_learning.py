@@ -0,0 +1,175 @@
+import heapq
+
+import numpy as np
+import pandas as pd
+
+
+class UncertaintyOrder:
+    """
+    Orders datapoints for the classifier by how uncertain the models are about them, so that annotators see the most
+    informative datapoints first. Can be passed to `classifier` in place of `indices`.
+
+    A datapoint is more uncertain the closer its scores are to the thresholds. Datapoints whose score columns disagree
+    (one above and another below its threshold) come before all others. Every time a label contradicts a model's
+    prediction, the margins of the unlabeled datapoints within `bandwidth` of that score are multiplied by `decay`,
+    which moves the region where the model errs to the front of the queue.
+
+    Items are kept in a heap with lazy deletion, so each step costs O(log n) plus the number of datapoints in the
+    affected band, instead of re-sorting all datapoints. The position of a datapoint is fixed once it is requested, so
+    upcoming datapoints should be looked up with `peek`, which leaves them free to be re-prioritized. Not thread-safe.
+
+    Args:
+        scores (pd.DataFrame or pd.Series): Model scores, indexed by the unique keys of the datapoints, with one column
+            per model. To split datapoints between annotators, pass `scores.loc[shard_indices(scores.index, ...)]`.
+        thresholds (float or dict[str, float]): Threshold of every score column, or a single threshold for all
+        label_fn (object, optional): Function which maps the labels selected in the classifier (dict[str, str]) to 1, 0
+            or None (no ground truth, e.g. for "unsure"). Without it, the order is static. Defaults to None.
+        bandwidth (float, optional): Distance in score around a wrong prediction whose datapoints are re-prioritized.
+            Defaults to 0.05.
+        decay (float, optional): Factor applied to the margins of re-prioritized datapoints. Defaults to 0.5.
+    """
+
+    def __init__(self, scores, thresholds, label_fn=None, bandwidth=0.05, decay=0.5):
+        if isinstance(scores, pd.Series):
+            scores = scores.to_frame()
+        if not isinstance(thresholds, dict):
+            thresholds = {col: thresholds for col in scores.columns}
+        assert set(thresholds) == set(scores.columns), "A threshold must be provided for every score column"
+
+        self.keys = list(scores.index)
+        self.cols = list(scores.columns)
+        self.scores = scores.to_numpy(dtype=float)
+        self.thresholds = np.array([thresholds[col] for col in self.cols], dtype=float)
+        self.label_fn = label_fn
+        self.bandwidth = bandwidth
+        self.decay = decay
+
+        with np.errstate(invalid="ignore"):
+            margins = np.abs(self.scores - self.thresholds)
+            predictions = np.where(np.isnan(self.scores), np.nan, self.scores >= self.thresholds)
+        valid = ~np.isnan(margins).all(axis=1)
+        self.margins = np.full(len(self.keys), np.inf)
+        self.margins[valid] = np.nanmin(margins[valid], axis=1)
+        self.agree = (np.nanmin(predictions, axis=1, initial=1) == np.nanmax(predictions, axis=1, initial=0)) | ~valid
+
+        # Sorted scores of each column, to find the datapoints near a wrong prediction with a binary search
+        self.sorted_positions = [np.argsort(self.scores[:, c], kind="stable") for c in range(len(self.cols))]
+        self.sorted_scores = [self.scores[positions, c] for c, positions in enumerate(self.sorted_positions)]
+
+        self.position = {key: i for i, key in enumerate(self.keys)}
+        # Margins before every update, so that updates can be undone
+        self.updates = []
+        self.served = []
+        self.is_served = np.zeros(len(self.keys), dtype=bool)
+        self.version = np.zeros(len(self.keys), dtype=int)
+        # Ties are broken by the original order
+        self.heap = [(int(agree), margin, i, 0) for i, (agree, margin) in enumerate(zip(self.agree, self.margins))]
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __repr__(self):
+        return f"UncertaintyOrder({len(self.served)}/{len(self)} datapoints served)"
+
+    def _pop(self):
+        while self.heap:
+            _, _, i, version = heapq.heappop(self.heap)
+            # Skip entries superseded by a re-prioritization
+            if version == self.version[i] and not self.is_served[i]:
+                self.is_served[i] = True
+                self.served.append(self.keys[i])
+                return
+        raise IndexError("All datapoints have been served")
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        while len(self.served) <= i:
+            self._pop()
+        return self.served[i]
+
+    def peek(self, start, stop):
+        """
+        Returns the keys of the datapoints at positions [start, stop) without fixing the positions of those not yet
+        served, e.g. to prefetch them. They are the datapoints that will be served unless an update re-prioritizes
+        others before them.
+        """
+        stop = min(stop, len(self))
+        keys = self.served[start:stop]
+        entries = []
+        while len(self.served) + len(entries) < stop and self.heap:
+            entry = heapq.heappop(self.heap)
+            _, _, i, version = entry
+            # Entries superseded by a re-prioritization are dropped for good, as in `_pop`
+            if version == self.version[i] and not self.is_served[i]:
+                entries.append(entry)
+        for entry in entries:
+            heapq.heappush(self.heap, entry)
+        return keys + [self.keys[entry[2]] for entry in entries[max(start - len(self.served), 0) :]]
+
+    def _push(self, j):
+        self.version[j] += 1
+        heapq.heappush(self.heap, (int(self.agree[j]), self.margins[j], j, self.version[j]))
+
+    def _reprioritize(self, i, label):
+        previous_margins = {}
+        for c in range(len(self.cols)):
+            score = self.scores[i, c]
+            if np.isnan(score) or (score >= self.thresholds[c]) == label:
+                continue
+            lo = np.searchsorted(self.sorted_scores[c], score - self.bandwidth, side="left")
+            hi = np.searchsorted(self.sorted_scores[c], score + self.bandwidth, side="right")
+            for j in self.sorted_positions[c][lo:hi]:
+                if self.is_served[j]:
+                    continue
+                previous_margins.setdefault(j, self.margins[j])
+                self.margins[j] *= self.decay
+                self._push(j)
+        return previous_margins
+
+    def update(self, key, labels):
+        """
+        Re-prioritizes the remaining datapoints based on the labels of a datapoint
+
+        Args:
+            key (object): unique key of the labelled datapoint
+            labels (dict[str, str]): labels selected in the classifier
+        """
+        label = None if self.label_fn is None else self.label_fn(labels)
+        self.updates.append({} if label is None else self._reprioritize(self.position[key], bool(label)))
+
+    def undo(self):
+        """Reverts the last `update`, e.g. when its label is undone in the classifier"""
+        assert self.updates, "No update to undo"
+        for j, margin in self.updates.pop().items():
+            self.margins[j] = margin
+            # Datapoints served since the update keep their position
+            if not self.is_served[j]:
+                self._push(j)
+
+    def restore(self, keys, labels):
+        """
+        Replays the actions of a resumed session, so that the datapoints already labelled are served first and in the
+        same order as before, and the remaining ones are ordered as they were
+
+        Args:
+            keys (list): unique keys of the labelled (or undone) datapoints, in the order of the actions
+            labels (list[dict[str, str]]): labels selected for each of them, or None where the label was undone
+        """
+        assert not self.served, "Datapoints can only be restored before any datapoint has been served"
+        for key, datapoint_labels in zip(keys, labels):
+            if datapoint_labels is None:
+                self.undo()
+                continue
+            assert key in self.position, f"Unknown datapoint in the session log: {key}"
+            i = self.position[key]
+            # An undone datapoint is labelled again at the same position
+            if not self.is_served[i]:
+                self.is_served[i] = True
+                self.served.append(key)
+            self.update(key, datapoint_labels)
@@ -0,0 +1,229 @@
+import os
+
+import numpy as np
+import pandas as pd
+from arjcode.analysis.utils import add_count_metrics, get_histogram_aucs
+
+
+def _import_polars():
+    try:
+        import polars as pl
+    except ImportError as e:
+        raise ImportError("Arrow and Polars inputs require polars (pip install polars)") from e
+    return pl
+
+
+def to_lazy_frame(data):
+    """
+    Wraps the inputs accepted by the Arrow backend in a polars LazyFrame: a pyarrow Table, a polars DataFrame or
+    LazyFrame, or the path (or glob) of parquet files. Parquet files are scanned lazily, so only the columns used by the
+    analysis are read, and filters applied to a LazyFrame beforehand are pushed down to the scan.
+    """
+    pl = _import_polars()
+    if isinstance(data, pl.LazyFrame):
+        return data
+    if isinstance(data, pl.DataFrame):
+        return data.lazy()
+    if isinstance(data, (str, os.PathLike)):
+        return pl.scan_parquet(data)
+    return pl.from_arrow(data).lazy()
+
+
+def get_columns(data):
+    return to_lazy_frame(data).collect_schema().names()
+
+
+def add_constant_column(data, colname: str, value):
+    pl = _import_polars()
+    return to_lazy_frame(data).with_columns(pl.lit(value).alias(colname))
+
+
+def _select_valid(lf, cols: list[str], other_cols: list[str] = [], unpack_strata_cols: bool = False):
+    """Lazy equivalent of `preprocess_data`, followed by the unpacking of the list strata columns if requested"""
+    pl = _import_polars()
+    schema = lf.collect_schema()
+
+    exprs = []
+    for col in dict.fromkeys(cols + other_cols):
+        expr = pl.col(col)
+        if col in cols and schema[col].is_float():
+            # pandas treats NaN as missing, polars does not
+            expr = expr.fill_nan(None)
+        if col == cols[0]:
+            expr = expr.cast(pl.Int8).alias("GT")
+        elif col == cols[1]:
+            # Scores are compared to thresholds in float32, as in the compact pandas path
+            expr = expr.cast(pl.Float32).alias("Score")
+        exprs.append(expr)
+    lf = lf.select(exprs).drop_nulls(["GT", "Score", *cols[2:]])
+
+    if unpack_strata_cols:
+        for col in cols[2:]:
+            if isinstance(schema[col], (pl.List, pl.Array)):
+                lf = lf.explode(col).drop_nulls(col).with_columns(pl.col(col).cast(pl.String))
+    return lf
+
+
+def _thresh(pl, thresholds):
+    """Expression equivalent of `thresh`, which is null wherever no threshold applies"""
+    if not isinstance(thresholds, list):
+        thresholds = [thresholds]
+
+    expr = None
+    for threshold_info in thresholds:
+        if isinstance(threshold_info, np.floating):
+            threshold_info = float(threshold_info)
+        assert isinstance(threshold_info, (tuple, float)), "Threshold info must be a float or a tuple"
+        if isinstance(threshold_info, float):
+            threshold_info = (None, {None: threshold_info})
+
+        assert len(threshold_info) == 2, "Threshold tuple must be of the format (str, dict[str, float])"
+        colname, subset_thresholds = threshold_info
+        assert isinstance(subset_thresholds, dict), "Subset thresholds for column {colname} must be a dict"
+        for subset, threshold in subset_thresholds.items():
+            assert (
+                isinstance(threshold, float) and 0 <= threshold <= 1
+            ), f"Threshold must be between 0 and 1. Threshold used: {threshold}"
+            condition = pl.lit(True) if subset is None else pl.col(str(colname)) == subset
+            expr = pl.when(condition) if expr is None else expr.when(condition)
+            expr = expr.then(pl.col("Score") > pl.lit(threshold, dtype=pl.Float32))
+    return expr
+
+
+def _get_histograms(pl, lf, strata_cols: list[str]):
+    return (
+        lf.group_by([*strata_cols, "Score"])
+        .agg((pl.col("GT") == 1).sum().alias("P"), (pl.col("GT") == 0).sum().alias("N"))
+        .sort([*strata_cols, "Score"])
+    )
+
+
+def _split_histograms(histograms, strata_cols: list[str]):
+    """Splits the collected histogram into the sorted scores and positive and negative counts of every stratum"""
+    groups = {}
+    for key, group in histograms.partition_by(strata_cols, as_dict=True, maintain_order=True).items():
+        groups[key] = (
+            group["Score"].to_numpy(),
+            group["P"].to_numpy().astype(np.int64),
+            group["N"].to_numpy().astype(np.int64),
+        )
+    return groups
+
+
+def _add_auc(df: pd.DataFrame, groups: dict):
+    """AUCs of the strata in `df`, from the concatenation of their score histograms"""
+    histograms = [groups[key if isinstance(key, tuple) else (key,)] for key in df.index]
+    blocks = np.repeat(np.arange(len(histograms)), [len(scores) for scores, _, _ in histograms])
+    positives = np.concatenate([positives for _, positives, _ in histograms])
+    negatives = np.concatenate([negatives for _, _, negatives in histograms])
+    df["AUC"], df["AUC 95% CI Lower"], df["AUC 95% CI Upper"], _ = get_histogram_aucs(
+        blocks, positives, negatives, len(histograms)
+    )
+    return df
+
+
+def get_stratified_metrics(
+    data,
+    cols: list[str],
+    other_cols: list[str],
+    unpack_strata_cols: bool,
+    threshold,
+    far_thresholds: tuple[float, float],
+    uncertainty_ranges: list[tuple[float, float]],
+    uncertainty_colnames: list[str],
+):
+    """
+    Metrics of every stratum of `stratified_analysis`, computed from a single lazy query: the confusion counts are
+    aggregated per stratum and the scores are histogrammed per stratum for the AUCs, both as multi-threaded polars
+    group-bys. Returns a frame indexed by the strata columns, or None if there is no valid data.
+    """
+    pl = _import_polars()
+    strata_cols = cols[2:]
+    lf = _select_valid(to_lazy_frame(data), cols, other_cols, unpack_strata_cols)
+
+    gt = pl.col("GT") == 1
+    pred = _thresh(pl, threshold)
+    score = pl.col("Score")
+    far_fn_pred = score > pl.lit(far_thresholds[0], dtype=pl.Float32)
+    far_fp_pred = score > pl.lit(far_thresholds[1], dtype=pl.Float32)
+    counts = (
+        lf.with_columns(pred.alias("Pred"))
+        .group_by(strata_cols)
+        .agg(
+            pl.len().alias("Total"),
+            gt.sum().alias("P"),
+            pl.col("Pred").sum().alias("PP"),
+            (gt & pl.col("Pred")).sum().alias("TP"),
+            (gt & ~pl.col("Pred") & ~far_fn_pred).sum().alias("Far FN"),
+            (~gt & pl.col("Pred") & far_fp_pred).sum().alias("Far FP"),
+            score.n_unique().alias("Unique"),
+            pl.col("Pred").null_count().alias("Unthresholded"),
+            *[
+                ((pl.lit(lower, dtype=pl.Float32) <= score) & (score < pl.lit(upper, dtype=pl.Float32)))
+                .sum()
+                .alias(name)
+                for (lower, upper), name in zip(uncertainty_ranges, uncertainty_colnames)
+            ],
+        )
+    )
+    counts, histograms = pl.collect_all([counts, _get_histograms(pl, lf, strata_cols)])
+    if len(counts) == 0:
+        return None
+
+    assert (
+        counts["Unthresholded"].sum() == 0
+    ), "Strict thresholding failed. Please provide a default threshold for foolproof usage."
+    df = counts.drop("Unthresholded").to_pandas().set_index(strata_cols)
+    df = _add_auc(df, _split_histograms(histograms, strata_cols))
+    return add_count_metrics(df, uncertainty_colnames)
+
+
+def get_score_histograms(data, cols: list[str]):
+    """
+    Sorted distinct scores, and the number of positives and negatives at each of them, of every stratum (keyed by the
+    tuple of its values, in sorted order). Returns an empty dict if there is no valid data.
+    """
+    pl = _import_polars()
+    strata_cols = cols[2:]
+    lf = _select_valid(to_lazy_frame(data), cols)
+    return _split_histograms(_get_histograms(pl, lf, strata_cols).collect(), strata_cols)
+
+
+def get_threshold_counts(
+    scores: np.ndarray,
+    positives: np.ndarray,
+    negatives: np.ndarray,
+    thresholds: list[float],
+    far_thresholds: tuple[float, float],
+):
+    """
+    Counts of `add_count_metrics` for every threshold, from the histogram of a stratum. Predictions are `score >
+    threshold` in float32, as in `thresh`, so every count is a difference of cumulative sums at a binary-searched
+    position.
+    """
+
+    def _cumsum(counts):
+        return np.concatenate([[0], np.cumsum(counts)])
+
+    def _n_below(thresholds):
+        # Number of distinct scores at or below each threshold
+        return np.searchsorted(scores, np.asarray(thresholds, dtype=np.float32), side="right")
+
+    cum_positives, cum_negatives = _cumsum(positives), _cumsum(negatives)
+    n_positives, n_negatives = cum_positives[-1], cum_negatives[-1]
+    thresholds = np.array([float(threshold) for threshold in thresholds])
+    below = _n_below(thresholds)
+    far_fn_below = _n_below(np.minimum(thresholds, far_thresholds[0]))
+    far_fp_below = _n_below(np.maximum(thresholds, far_thresholds[1]))
+
+    df = pd.DataFrame(index=pd.Index(thresholds, name="Threshold"))
+    df["Total"] = n_positives + n_negatives
+    df["P"] = n_positives
+    df["PP"] = df["Total"] - cum_positives[below] - cum_negatives[below]
+    df["TP"] = n_positives - cum_positives[below]
+    df["Far FN"] = cum_positives[far_fn_below]
+    df["Far FP"] = n_negatives - cum_negatives[far_fp_below]
+    df["Unique"] = len(scores)
+    aucs = get_histogram_aucs(np.zeros(len(scores), dtype=int), positives, negatives, 1)
+    df["AUC"], df["AUC 95% CI Lower"], df["AUC 95% CI Upper"] = aucs[0][0], aucs[1][0], aucs[2][0]
+    return df
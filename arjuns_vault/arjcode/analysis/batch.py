@@ -0,0 +1,252 @@
+"""
+Runs batches of `stratified_analysis` and `threshold_analysis` jobs outside notebooks, e.g. nightly in CI:
+
+    python -m arjcode.analysis spec.yaml --workers 8
+
+The spec is a JSON or YAML file such as:
+
+    input: predictions.parquet          # parquet, feather / arrow or CSV
+    output_dir: results
+    formats: [parquet, html]            # any of parquet, csv and html
+    backend: arrow                      # arrow (multi-threaded polars) or pandas
+    jobs:
+      - name: nodules
+        analysis: stratified            # or threshold
+        y_gt_col: gt_nodule
+        y_scores_col: [score_epoch10, score_epoch20]
+        strata_cols: [site]
+        threshold: 0.5
+
+Every other key of a job is passed to the analysis. A job with lists of GT or score columns is expanded into one job
+per (GT, score) pair, and every job writes its table to `output_dir/<name>.<format>`.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from pathlib import Path
+from time import time
+
+import pandas as pd
+from arjcode.analysis.stratified import stratified_analysis
+from arjcode.analysis.threshold import threshold_analysis
+from arjcode.analysis.utils import get_thresh_cols, style_df
+
+ANALYSES = {"stratified": stratified_analysis, "threshold": threshold_analysis}
+OUTPUT_FORMATS = ("parquet", "csv", "html")
+
+
+def load_spec(path: str):
+    """Reads a spec from a JSON or YAML file"""
+    with open(path) as f:
+        if Path(path).suffix.lower() in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError as e:
+                raise ImportError("YAML specs require pyyaml (pip install pyyaml)") from e
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def _parse_threshold(threshold):
+    """Converts a threshold read from JSON or YAML, which have no tuples, into the format of `thresh`"""
+    if isinstance(threshold, list):
+        return [
+            tuple(threshold_info) if isinstance(threshold_info, list) else float(threshold_info)
+            for threshold_info in threshold
+        ]
+    return float(threshold)
+
+
+def get_jobs(spec: dict):
+    """Expands the jobs of a spec into one job per (GT, score) pair"""
+    jobs = []
+    for i, job in enumerate(spec["jobs"]):
+        kwargs = dict(job)
+        name = kwargs.pop("name", f"job{i}")
+        analysis = kwargs.pop("analysis", "stratified")
+        assert analysis in ANALYSES, f"Unknown analysis: {analysis}"
+        path = kwargs.pop("input", spec.get("input"))
+        assert path is not None, f"No input for job {name}"
+        if "threshold" in kwargs:
+            kwargs["threshold"] = _parse_threshold(kwargs["threshold"])
+
+        gt_cols, scores_cols = kwargs.pop("y_gt_col"), kwargs.pop("y_scores_col")
+        gt_cols = [gt_cols] if isinstance(gt_cols, str) else list(gt_cols)
+        scores_cols = [scores_cols] if isinstance(scores_cols, str) else list(scores_cols)
+        for y_gt_col, y_scores_col in product(gt_cols, scores_cols):
+            job_name = name if len(gt_cols) == len(scores_cols) == 1 else f"{name}__{y_gt_col}__{y_scores_col}"
+            jobs.append(
+                {
+                    "name": re.sub(r"[^\w.-]+", "_", job_name),
+                    "analysis": analysis,
+                    "input": path,
+                    "y_gt_col": y_gt_col,
+                    "y_scores_col": y_scores_col,
+                    "kwargs": kwargs,
+                }
+            )
+    names = [job["name"] for job in jobs]
+    assert len(set(names)) == len(names), "Job names must be unique"
+    return jobs
+
+
+def read_columns(path: str, columns: list[str]):
+    """
+    Reads `columns` of a parquet, feather / arrow IPC or CSV file into a pyarrow Table. Parquet files are memory-mapped
+    and only the column chunks of the requested columns are decoded. Uncompressed feather files are memory-mapped
+    without any copy, so parallel jobs reading the same file share its pages.
+    """
+    import pyarrow
+
+    suffixes = Path(path).suffixes
+    suffix = suffixes[-2] if suffixes[-1:] == [".gz"] and len(suffixes) > 1 else Path(path).suffix
+    suffix = suffix.lower()
+    if suffix in (".parquet", ".pq"):
+        from pyarrow import parquet
+
+        return parquet.read_table(path, columns=columns, memory_map=True)
+    if suffix in (".feather", ".arrow", ".ipc"):
+        from pyarrow import feather
+
+        return feather.read_table(path, columns=columns, memory_map=True)
+    if suffix in (".csv", ".tsv"):
+        from pyarrow import csv
+
+        return csv.read_csv(
+            path,
+            parse_options=csv.ParseOptions(delimiter="\t" if suffix == ".tsv" else ","),
+            convert_options=csv.ConvertOptions(include_columns=columns),
+        )
+    raise ValueError(f"Unsupported file type: {path} (pyarrow {pyarrow.__version__})")
+
+
+def run_job(job: dict, backend: str = "arrow"):
+    """Runs a job of `get_jobs` on the columns it uses, returning its table (None if there is no valid data)"""
+    assert backend in ("arrow", "pandas"), f"Unknown backend: {backend}"
+    kwargs = job["kwargs"]
+    columns = [
+        job["y_gt_col"],
+        job["y_scores_col"],
+        *kwargs.get("strata_cols", []),
+        *get_thresh_cols(kwargs.get("threshold")),
+    ]
+    data = read_columns(job["input"], list(dict.fromkeys(columns)))
+    if backend == "pandas":
+        data = data.to_pandas()
+    return ANALYSES[job["analysis"]](data, job["y_gt_col"], job["y_scores_col"], **kwargs, return_df=True)
+
+
+def _timed_run_job(job: dict, backend: str):
+    start = time()
+    return run_job(job, backend), time() - start
+
+
+def _init_worker(n_threads: int):
+    # Jobs run side by side, so each gets its share of the cores (polars is imported lazily, after this)
+    import pyarrow
+
+    os.environ.setdefault("POLARS_MAX_THREADS", str(n_threads))
+    pyarrow.set_cpu_count(n_threads)
+
+
+def write_table(df: pd.DataFrame, path: str, formats: list[str], show_bars: bool = True):
+    """Writes a table to `path` with the extension of every format"""
+    for output_format in formats:
+        if output_format == "parquet":
+            df.reset_index().to_parquet(f"{path}.parquet", index=False)
+        elif output_format == "csv":
+            df.to_csv(f"{path}.csv")
+        elif output_format == "html":
+            style_df(df, show_bars).to_html(f"{path}.html")
+
+
+def run_batch(spec, workers: int = None):
+    """
+    Runs all the jobs of a spec, in parallel processes, and writes their tables as they finish. Jobs are independent,
+    so each process reads only the columns of its job. Failed jobs are reported and do not stop the others.
+
+    Args:
+        spec (dict or str): Spec, or the path of its JSON or YAML file
+        workers (int, optional): Number of jobs run in parallel. Defaults to the number of cores.
+
+    Returns:
+        dict[str, pd.DataFrame]: Table of every job, None for the jobs which failed or had no valid data
+    """
+    if not isinstance(spec, dict):
+        spec = load_spec(spec)
+    jobs = get_jobs(spec)
+    backend = spec.get("backend", "arrow")
+    formats = spec.get("formats", ["parquet"])
+    assert set(formats) <= set(OUTPUT_FORMATS), f"Output formats must be among {OUTPUT_FORMATS}"
+    output_dir = Path(spec.get("output_dir", "."))
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    n_cores = os.cpu_count() or 1
+    workers = max(1, min(workers or n_cores, len(jobs)))
+    print(f"Running {len(jobs)} jobs with {workers} workers")
+
+    results = {}
+
+    def _finish(job, get_result):
+        try:
+            df, duration = get_result()
+        except Exception as e:
+            message = str(e).splitlines()[0] if str(e) else ""
+            print(f"[{len(results) + 1}/{len(jobs)}] {job['name']}: FAILED ({type(e).__name__}: {message})")
+            df = None
+        else:
+            if df is None:
+                print(f"[{len(results) + 1}/{len(jobs)}] {job['name']}: no valid data")
+            else:
+                write_table(df, output_dir / job["name"], formats, spec.get("show_bars", True))
+                print(f"[{len(results) + 1}/{len(jobs)}] {job['name']}: {len(df)} rows in {duration:.1f}s")
+        results[job["name"]] = df
+
+    if workers == 1:
+        for job in jobs:
+            _finish(job, lambda: _timed_run_job(job, backend))
+    else:
+        # Spawned rather than forked, as forking a process whose polars thread pool is running can deadlock
+        with ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(max(1, n_cores // workers),),
+        ) as executor:
+            futures = {executor.submit(_timed_run_job, job, backend): job for job in jobs}
+            for future in as_completed(futures):
+                _finish(futures[future], future.result)
+
+    return {job["name"]: results[job["name"]] for job in jobs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run batches of stratified and threshold analyses from a spec")
+    parser.add_argument("spec", type=str, help="JSON or YAML file of the jobs to run")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of jobs run in parallel (default: number of cores)",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=None,
+        help="Directory to write the tables to, overriding that of the spec",
+    )
+    args = parser.parse_args()
+
+    spec = load_spec(args.spec)
+    if args.output_dir is not None:
+        spec["output_dir"] = args.output_dir
+    results = run_batch(spec, args.workers)
+
+    # A non-zero exit status fails CI pipelines when any job fails
+    sys.exit(int(any(df is None for df in results.values())))
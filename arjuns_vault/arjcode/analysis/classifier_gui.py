@@ -1,28 +1,251 @@
-from time import time
-
+import json
+import os
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, time
+
+import numpy as np
 import pandas as pd
+from arjcode.analysis.active_learning import UncertaintyOrder
 from IPython.display import display
 from ipywidgets import interactive, widgets
 
 
-def _get_estimated_time_to_completion(df: pd.DataFrame, n_cur, n_left, n_total):
+def _to_json(obj):
+    # numpy scalars used as keys or timestamps
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _from_json(obj):
+    # JSON has no tuples, and lists cannot be unique keys, so every list was a tuple (e.g. of a MultiIndex)
+    if isinstance(obj, list):
+        return tuple(_from_json(value) for value in obj)
+    return obj
+
+
+class _LabelState:
+    """
+    Append-only columnar store of the classification labels. The number of datapoints per combination of labels is
+    maintained incrementally, so adding, undoing and computing stats do not depend on the number of datapoints. The
+    DataFrame is only built when requested through `to_dataframe`.
+
+    If `log_path` is given, every action is also appended to a JSONL write-ahead log, and an existing log is replayed so
+    that a session can be resumed after a crash or kernel restart.
+
+    Args:
+        label_groups (dict[str, list[str]]): the classification labels displayed for each datapoint
+        log_path (str, optional): path of the write-ahead log. Defaults to None.
+        fsync_every (int, optional): number of actions after which the log is fsync-ed to disk. Every action is flushed
+            to the OS immediately, so only an OS crash can lose the actions since the last fsync. Defaults to 10.
+    """
+
+    def __init__(self, label_groups, log_path=None, fsync_every=10):
+        self.label_groups = label_groups
+        self.index = []
+        self.timestamp = []
+        self.labels = {groupname: [] for groupname in label_groups}
+        self.comments = []
+        self.counts = Counter()
+        # Every replayed action as (key, labels), with None labels for an undo of the datapoint
+        self.replayed = []
+
+        self.log_path = log_path
+        self.fsync_every = fsync_every
+        self._log = None
+        self._n_unsynced = 0
+        if log_path is not None:
+            if os.path.exists(log_path):
+                self._replay(log_path)
+            self._log = open(log_path, "a+")
+            self._log.seek(0)
+            content = self._log.read()
+            if content and not content.endswith("\n"):
+                # Drop a line left incomplete by a crash, so that only lines corrupted otherwise precede new records
+                self._log.truncate(len(content[: content.rfind("\n") + 1].encode()))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return f"{len(self)} datapoints classified. Use .to_dataframe() to get the classifications."
+
+    def _replay(self, log_path):
+        with open(log_path) as f:
+            lines = f.readlines()
+        for i, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Only the last line is expected to be incomplete, if writing it was interrupted
+                if i < len(lines) - 1 and line.strip():
+                    print(f"Warning: skipping corrupt line {i + 1} of {log_path}: {line.strip()[:100]}")
+                continue
+            if record["op"] == "add":
+                index = _from_json(record["index"])
+                self._append(index, record["labels"], record["comments"], record["timestamp"])
+                self.replayed.append((index, record["labels"]))
+            elif record["op"] == "undo":
+                self.replayed.append((self._pop(), None))
+
+    def _write(self, record):
+        if self._log is None:
+            return
+        self._log.write(json.dumps(record, default=_to_json) + "\n")
+        self._log.flush()
+        self._n_unsynced += 1
+        if self._n_unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        if self._log is not None:
+            os.fsync(self._log.fileno())
+            self._n_unsynced = 0
+
+    def close(self):
+        if self._log is not None:
+            self.sync()
+            self._log.close()
+            self._log = None
+
+    def append(self, index, labels, comments="", timestamp=None):
+        """
+        Args:
+            index (object): unique key of the datapoint
+            labels (dict[str, str]): the label selected for each group
+            comments (str, optional): comments for the datapoint. Defaults to "".
+            timestamp (float, optional): time at which the datapoint was classified. Defaults to now.
+        """
+        timestamp = time() if timestamp is None else timestamp
+        self._write({"op": "add", "index": index, "labels": labels, "comments": comments, "timestamp": timestamp})
+        self._append(index, labels, comments, timestamp)
+
+    def _append(self, index, labels, comments, timestamp):
+        self.index.append(index)
+        self.timestamp.append(timestamp)
+        for groupname in self.label_groups:
+            self.labels[groupname].append(labels[groupname])
+        self.comments.append(comments)
+        self.counts[tuple(labels[groupname] for groupname in self.label_groups)] += 1
+
+    def pop(self):
+        """Removes the last datapoint and returns its unique key"""
+        self._write({"op": "undo"})
+        return self._pop()
+
+    def _pop(self):
+        key = tuple(self.labels[groupname].pop() for groupname in self.label_groups)
+        self.counts[key] -= 1
+        if self.counts[key] == 0:
+            del self.counts[key]
+        self.timestamp.pop()
+        self.comments.pop()
+        return self.index.pop()
+
+    def get_labels(self):
+        """Returns the labels of every datapoint as dicts, in the order they were classified"""
+        return [dict(zip(self.label_groups, labels)) for labels in zip(*self.labels.values())]
+
+    def get_stats(self):
+        stats = pd.Series(
+            list(self.counts.values()),
+            index=pd.MultiIndex.from_tuples(list(self.counts), names=list(self.label_groups)),
+            dtype=int,
+        )
+        return stats.sort_index().to_frame("Count")
+
+    def to_dataframe(self):
+        df = pd.DataFrame({"Index": self.index})
+        for groupname, labels in self.label_groups.items():
+            selected = np.array(self.labels[groupname], dtype=object)
+            for label in labels:
+                df[f"{groupname}__{label}"] = selected == label
+        df["comments"] = self.comments
+        return df.set_index("Index")
+
+
+def shard_indices(indices, n_annotators, annotator_id, replication=1):
+    """
+    Deterministically splits the datapoints between annotators, so that each annotator can run their own session
+
+    Args:
+        indices (list): list of unique keys of all the datapoints
+        n_annotators (int): number of annotators
+        annotator_id (int): id of the current annotator, in [0, n_annotators)
+        replication (int, optional): number of annotators that classify each datapoint, to allow voting on the labels
+            with `combine_cols`. Defaults to 1.
+
+    Returns:
+        list: unique keys of the datapoints assigned to the annotator, in their original order
+    """
+    assert 0 <= annotator_id < n_annotators, "annotator_id must be in [0, n_annotators)"
+    assert 1 <= replication <= n_annotators, "replication must be in [1, n_annotators]"
+    # Datapoint j goes to annotators j, j + 1, ..., j + replication - 1 (mod n_annotators)
+    return [index for j, index in enumerate(indices) if (annotator_id - j) % n_annotators < replication]
+
+
+def load_session(session_path, label_groups):
+    """
+    Args:
+        session_path (str): path of the write-ahead log of a classifier session
+        label_groups (dict[str, list[str]]): the classification labels used in the session
+
+    Returns:
+        _LabelState: classifications of the session. Use .to_dataframe() to get them as a DataFrame.
+    """
+    assert os.path.exists(session_path), f"Session not found: {session_path}"
+    state = _LabelState(label_groups)
+    state._replay(session_path)
+    return state
+
+
+def merge_sessions(session_paths, label_groups):
+    """
+    Merges the sessions of multiple annotators into a wide DataFrame with one column per annotator for every label,
+    named "{groupname}__{label}__{annotator}". Values are 1.0 or 0.0, and NaN for datapoints an annotator did not
+    classify, so the columns of a label can be passed directly to `combine_cols`.
+
+    Args:
+        session_paths (dict[str, str] or list[str]): paths of the session logs, keyed by annotator name. If a list is
+            given, annotators are named by their position in it.
+        label_groups (dict[str, list[str]]): the classification labels used in the sessions
+
+    Returns:
+        pd.DataFrame: merged classifications, indexed by the unique keys of the datapoints
+    """
+    if not isinstance(session_paths, dict):
+        session_paths = {str(i): session_path for i, session_path in enumerate(session_paths)}
+
+    dfs = []
+    for annotator, session_path in session_paths.items():
+        df = load_session(session_path, label_groups).to_dataframe()
+        df = df[[col for col in df.columns if "__" in col] + ["comments"]]
+        df = df.astype({col: float for col in df.columns if col != "comments"})
+        dfs.append(df.add_suffix(f"__{annotator}"))
+
+    return pd.concat(dfs, axis=1)
+
+
+def _get_estimated_time_to_completion(timestamps: list[float], n_cur, n_left, n_total):
     # Average number of datapoints to estimate time required to complete analysis
     lookback_multiplier = min(40, int(0.40 * n_total))
 
-    # Calculate median time taken over all datapoints
-    median_time = df.timestamp.diff(1).median()
+    # Calculate median time taken over the recent datapoints
+    median_time = float(np.median(np.diff(timestamps[-lookback_multiplier - 1 :])))
 
-    # Decide on the datapoints to use to make estimation
-    df_est = df[df.timestamp >= time() - median_time * lookback_multiplier]
+    # Decide on the datapoints to use to make estimation (timestamps are sorted)
+    n_est = n_cur - bisect_left(timestamps, time() - median_time * lookback_multiplier)
 
-    if len(df_est) > 1:
+    if n_est > 1:
         # Take average of datapoints decided
-        time_per_iter = (df_est.iloc[-1].timestamp - df_est.iloc[0].timestamp) / (len(df_est) - 1)
-        n_datapoints_used = len(df_est)
+        time_per_iter = (timestamps[-1] - timestamps[-n_est]) / (n_est - 1)
+        n_datapoints_used = n_est
     else:
         # If no datapoints accepted by criterion, take average of (mean and median time) over all datapoints
-        time_per_iter = (median_time + (time() - df.iloc[0].timestamp) / n_cur) / 2
-        n_datapoints_used = len(df)
+        time_per_iter = (median_time + (time() - timestamps[0]) / n_cur) / 2
+        n_datapoints_used = n_cur
 
     # Calculate actual total time
     est_time = time_per_iter * n_left
@@ -30,18 +253,17 @@ def _get_estimated_time_to_completion(df: pd.DataFrame, n_cur, n_left, n_total):
     return est_time, time_per_iter, n_datapoints_used
 
 
-def _print_stats(df, n_total, label_groups):
+def _print_stats(state, n_total):
     """
     Calculates and displays the various stats w.r.t the current classification situation
 
     Args:
-        df (object): pandas DataFrame containing all classification datapoints till now
+        state (_LabelState): all classification datapoints till now
         n_total (int): total number of classification datapoints expected
-        label_groups (dict[str, list[str]]): the classification labels displayed for each datapoint
     """
 
     # Calculate basic variables
-    n_cur = len(df)
+    n_cur = len(state)
     n_left = n_total - n_cur
 
     print("\nStats")
@@ -58,7 +280,7 @@ def _print_stats(df, n_total, label_groups):
                 est_time,
                 time_per_iter,
                 n_datapoints_used,
-            ) = _get_estimated_time_to_completion(df, n_cur, n_left, n_total)
+            ) = _get_estimated_time_to_completion(state.timestamp, n_cur, n_left, n_total)
 
             if est_time / 60 < 1:
                 est_time = round(est_time, 1)
@@ -75,22 +297,78 @@ def _print_stats(df, n_total, label_groups):
 
             print(f", {n_datapoints_used} datapoints used)")
 
-    # Calculate stats
-    stats = pd.DataFrame(columns=label_groups)
+    # Display stats
+    display(state.get_stats())
 
-    for i in df.index:
-        new_row = {}
-        for groupname, labels in label_groups.items():
-            for label in labels:
-                if df.loc[i, f"{groupname}__{label}"] is True:
-                    new_row[groupname] = label
-                    break
-        stats = pd.concat([stats, pd.DataFrame([new_row])], ignore_index=True)
 
-    stats = stats.value_counts()
-    stats = stats.sort_index()
-    stats = stats.to_frame("Count")
-    display(stats)
+class _Prefetcher:
+    """
+    Loads the datapoints at the next few positions in background threads and keeps them in a bounded cache, so that
+    moving to the next datapoint does not have to wait for it to load. Keys are resolved on the calling thread, and the
+    upcoming datapoints of an UncertaintyOrder are only peeked at, so that labels can still re-prioritize them. If they
+    are re-prioritized, the datapoints served instead are loaded when requested.
+
+    Args:
+        indices (list or UncertaintyOrder): unique keys of the datapoints
+        load_data (object): function which loads (and optionally pre-renders) a datapoint given its unique key
+        prefetch (int): number of upcoming datapoints to load in the background
+        num_workers (int): number of background threads
+    """
+
+    def __init__(self, indices, load_data, prefetch, num_workers):
+        self.indices = indices
+        self.load_data = load_data
+        self.prefetch = prefetch
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="classifier")
+        self.futures = OrderedDict()
+        self.load_times = {}
+        self.wait_times = {}
+
+    def _load(self, key):
+        tic = perf_counter()
+        data = self.load_data(key)
+        return data, perf_counter() - tic
+
+    def _get_keys(self, start, stop):
+        if isinstance(self.indices, UncertaintyOrder):
+            return self.indices.peek(start, stop)
+        return list(self.indices[start:stop])
+
+    def get(self, i):
+        # Keep the previous datapoint for undo, and schedule the upcoming ones
+        key = self.indices[i]
+        keys = [*self._get_keys(max(i - 1, 0), i), key, *self._get_keys(i + 1, i + self.prefetch + 1)]
+        for cached_key in list(self.futures):
+            if cached_key not in keys:
+                self.futures.pop(cached_key).cancel()
+        for upcoming_key in keys:
+            if upcoming_key not in self.futures:
+                self.futures[upcoming_key] = self.executor.submit(self._load, upcoming_key)
+
+        tic = perf_counter()
+        data, load_time = self.futures[key].result()
+        if i not in self.wait_times:
+            self.wait_times[i] = perf_counter() - tic
+            self.load_times[i] = load_time
+        return data
+
+
+def _print_latencies(render_times, prefetcher=None):
+    """
+    Displays the measured per-datapoint latencies
+
+    Args:
+        render_times (dict[int, float]): time taken by vis_data for each datapoint
+        prefetcher (_Prefetcher, optional): prefetcher whose load latencies should be displayed. Defaults to None.
+    """
+    if not render_times:
+        return
+    print(f"Render time:\t{np.mean(list(render_times.values())):.3f}s (mean)")
+    if prefetcher is not None and prefetcher.load_times:
+        print(
+            f"Load time:\t{np.mean(list(prefetcher.load_times.values())):.3f}s (mean), "
+            f"{np.mean(list(prefetcher.wait_times.values())):.3f}s (mean time spent waiting)"
+        )
 
 
 def _reset_toggle_buttons(choices):
@@ -107,35 +385,63 @@ def _reset_toggle_buttons(choices):
             choice.value = None
 
 
-def classifier(indices, vis_data, label_groups, show_stats=True):
+def classifier(
+    indices,
+    vis_data,
+    label_groups,
+    show_stats=True,
+    load_data=None,
+    prefetch=4,
+    num_workers=2,
+    session_path=None,
+    fsync_every=10,
+    n_annotators=1,
+    annotator_id=0,
+    replication=1,
+):
     """
     GUI which can aid in classifying data visualized in any manner. Data has to be referenceable using a unique key.
-    All classification outputs are returned in the form of a pandas DataFrame.
+    All classification outputs can be obtained in the form of a pandas DataFrame with `gui.result.to_dataframe()`.
 
     Args:
-        indices (list): list of unique keys which can reference the data to be visualized
-        vis_data (object): function which visualizes the data based on the unique key
+        indices (list or UncertaintyOrder): list of unique keys which can reference the data to be visualized, or an
+            UncertaintyOrder to show the most uncertain datapoints first
+        vis_data (object): function which visualizes the data based on the unique key, or based on the output of
+            `load_data` if it is provided
         label_groups (dict[str, list[str]]): the classification labels to be viewed for each datapoint
         show_stats (bool, optional): Whether or not to print current stats at the end of the visualization.
             Defaults to True.
+        load_data (object, optional): function which loads the data based on the unique key. It is run for the next
+            `prefetch` datapoints in background threads, so it should do all the slow work (reading files, rendering
+            images e.g. with `get_annotated_scan`) and must not use pyplot. With an UncertaintyOrder, the upcoming
+            datapoints are those expected before the current label is saved, so a datapoint re-prioritized by the label
+            is loaded when it is reached. Defaults to None.
+        prefetch (int, optional): Number of upcoming datapoints to load in the background. Defaults to 4.
+        num_workers (int, optional): Number of background threads used for loading. Defaults to 2.
+        session_path (str, optional): path of a JSONL write-ahead log to which every classification and undo is
+            appended. If it already exists, the session is resumed from where it was left. Use `merge_sessions` to
+            combine the sessions of multiple annotators. Defaults to None.
+        fsync_every (int, optional): number of actions after which the session log is fsync-ed to disk. Defaults to 10.
+        n_annotators (int, optional): number of annotators the datapoints are split between (see `shard_indices`).
+            Defaults to 1.
+        annotator_id (int, optional): id of the current annotator, in [0, n_annotators). Defaults to 0.
+        replication (int, optional): number of annotators that classify each datapoint. Defaults to 1.
 
     Returns:
         object: GUI which can be `display()`ed in a jupyter notebook
     """
 
-    # Set up dataframe
-    all_labels = []
-    for groupname, labels in label_groups.items():
-        for label in labels:
-            all_labels.append(f"{groupname}__{label}")
-
-    df = pd.DataFrame(
-        columns=[
-            "Index",  # Save the unique key of each datapoint
-            "timestamp",  # Save the timestamp at which each datapoint was added to the dataframe
-            *all_labels,  # The classification labels
-        ]
-    )
+    # Set up the store of classifications, restoring the previous classifications of the session if any
+    state = _LabelState(label_groups, session_path, fsync_every)
+    if isinstance(indices, UncertaintyOrder):
+        assert n_annotators == 1, "Shard the scores of the UncertaintyOrder with shard_indices instead"
+        if state.replayed:
+            indices.restore(*map(list, zip(*state.replayed)))
+    else:
+        indices = shard_indices(indices, n_annotators, annotator_id, replication)
+        assert state.index == list(indices[: len(state)]), "The session log does not match the given indices"
+    if len(state) > 0:
+        print(f"Resuming session: {len(state)}/{len(indices)} datapoints already classified")
 
     # Set up widgets
     choices = {}
@@ -144,11 +450,17 @@ def classifier(indices, vis_data, label_groups, show_stats=True):
         choices[groupname] = widgets.ToggleButtons(options=labels, value=None, description=f"{groupname}:")
     choices["comments"] = widgets.Text(value="", description="Comments:")
 
+    # Set up prefetching
+    prefetcher = None
+    if load_data is not None:
+        prefetcher = _Prefetcher(indices, load_data, prefetch, num_workers)
+    render_times = {}
+
     # Interact
-    cur_i = 0
+    cur_i = len(state)
 
     def callback(**kwargs):
-        nonlocal cur_i, df
+        nonlocal cur_i
 
         if cur_i < 0:
             cur_i = 0
@@ -159,22 +471,24 @@ def classifier(indices, vis_data, label_groups, show_stats=True):
         # If all the data has been classified
         if cur_i == len(indices):
             print("You have gone through all the data! Congratulations!")
+            state.sync()
 
             # Visualize stats
             if show_stats:
-                _print_stats(df, len(indices), label_groups)
+                _print_stats(state, len(indices))
         elif kwargs["actions"] == "UNDO":  # Else if undo was pressed
             cur_i -= 1
-            df = df.drop(df[df.Index == indices[cur_i]].index)
+            if cur_i >= 0:
+                state.pop()
+                if isinstance(indices, UncertaintyOrder):
+                    indices.undo()
 
             # Reset toggle buttons
             _reset_toggle_buttons(choices)
         else:
             # If all groups have values
-            new_row = {"Index": indices[cur_i], "timestamp": time()}
-
-            for label in all_labels:
-                new_row[label] = False
+            new_labels = {}
+            comments = ""
 
             flag = False
             for groupname, label_selected in kwargs.items():
@@ -182,18 +496,20 @@ def classifier(indices, vis_data, label_groups, show_stats=True):
                     continue
 
                 if groupname == "comments":
-                    new_row[groupname] = label_selected
+                    comments = label_selected
                     continue
 
                 if label_selected is None:
                     flag = True
                     break
 
-                # Add element to dataframe
-                new_row[f"{groupname}__{label_selected}"] = True
+                new_labels[groupname] = label_selected
 
             if not flag:
-                df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
+                # Add element to the store
+                state.append(indices[cur_i], new_labels, comments)
+                if isinstance(indices, UncertaintyOrder):
+                    indices.update(indices[cur_i], new_labels)
 
                 # Increment cur_i
                 cur_i += 1
@@ -202,13 +518,17 @@ def classifier(indices, vis_data, label_groups, show_stats=True):
                 _reset_toggle_buttons(choices)
             else:
                 # Show image
-                vis_data(indices[cur_i])
+                data = indices[cur_i] if prefetcher is None else prefetcher.get(cur_i)
+                tic = perf_counter()
+                vis_data(data)
+                render_times.setdefault(cur_i, perf_counter() - tic)
 
                 # Visualize stats
                 if show_stats:
-                    _print_stats(df, len(indices), label_groups)
+                    _print_stats(state, len(indices))
+                    _print_latencies(render_times, prefetcher)
 
-        return df.drop("timestamp", axis=1).set_index("Index")
+        return state
 
     gui = interactive(callback, **choices)
     return gui
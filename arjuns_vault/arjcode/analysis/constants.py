@@ -17,3 +17,51 @@ TABLE_COLUMNS = [
     "NPV",
     "Acc",
 ]
+
+MULTILABEL_TABLE_COLUMNS = [colname for colname in TABLE_COLUMNS if colname not in ("Far FN", "Far FP")]
+
+DEFERRAL_TABLE_COLUMNS = ["Deferred", "Coverage", "Errors Deferred", *MULTILABEL_TABLE_COLUMNS]
+
+ROLLING_TABLE_COLUMNS = ["Scored", *MULTILABEL_TABLE_COLUMNS]
+
+DRIFT_COLUMNS = ["PSI", "KS"]
+
+PREVIEW_TABLE_COLUMNS = [
+    "Total",
+    "P",
+    "N",
+    "Sampled",
+    "AUC",
+    "AUC Error",
+    "Sen",
+    "Sen Error",
+    "Spec",
+    "Spec Error",
+    "PPV",
+    "NPV",
+    "Acc",
+]
+
+FOLD_TABLE_COLUMNS = [
+    "Total",
+    "P",
+    "N",
+    "AUC",
+    "AUC 95% CI Lower",
+    "AUC 95% CI Upper",
+    "TP",
+    "FN",
+    "FP",
+    "TN",
+    "Far FN",
+    "Far FP",
+    "Sen",
+    "Sen 95% CI Lower",
+    "Sen 95% CI Upper",
+    "Spec",
+    "Spec 95% CI Lower",
+    "Spec 95% CI Upper",
+    "PPV",
+    "NPV",
+    "Acc",
+]
@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+from arjcode.analysis.constants import DEFERRAL_TABLE_COLUMNS, NO_DATA_ERROR
+from arjcode.analysis.utils import add_count_metrics, check_cols, get_block_aucs, preprocess_data, style_df
+from IPython.display import display
+from matplotlib import pyplot as plt
+
+
+def _get_counts(groups: np.ndarray, gt: np.ndarray, pred: np.ndarray, n_groups: int):
+    def _count(weights=None):
+        return np.bincount(groups, weights=weights, minlength=n_groups)
+
+    return pd.DataFrame({"Total": _count(), "P": _count(gt), "PP": _count(pred), "TP": _count(gt & pred)})
+
+
+def _plot_curves(curves: pd.DataFrame, strata_cols: list[str], metrics: list[str] = ["Sen", "Spec", "Acc"]):
+    _, axes = plt.subplots(1, len(metrics), figsize=(6 * len(metrics), 5), sharey=True)
+    for key, curve in curves.groupby(strata_cols, sort=False, observed=True):
+        for ax, metric in zip(axes, metrics):
+            ax.plot(curve["Coverage"], curve[metric], label=", ".join(map(str, key)))
+    for ax, metric in zip(axes, metrics):
+        ax.set_xlim(-0.05, 1.05)
+        ax.set_ylim(-0.05, 1.05)
+        ax.set_xlabel("Coverage")
+        ax.set_ylabel(metric)
+    axes[-1].legend(bbox_to_anchor=(1.0, 1.01), loc="upper left")
+    plt.show()
+
+
+def deferral_analysis(
+    data: pd.DataFrame,
+    y_gt_col: str,
+    y_scores_col: str,
+    strata_cols: list[str] = [],
+    threshold: float = 0.5,
+    uncertainty_ranges: list[tuple[float, float]] = [(0.4, 0.6)],
+    coverages: list[float] = [0.9, 0.8, 0.7],
+    table_columns: list[str] = DEFERRAL_TABLE_COLUMNS,
+    show_bars: bool = True,
+    show_plot: bool = True,
+    return_df: bool = False,
+):
+    """
+    Evaluates selective prediction, where the datapoints the model is least sure about are deferred to a reader and
+    the metrics are computed on the rest.
+
+    The datapoints of every stratum are sorted once by their margin |score - threshold|, from most to least confident.
+    The confusion counts of every coverage, i.e. of deferring every datapoint below each distinct margin, are then
+    cumulative sums along that order, which gives the full coverage vs. Sen / Spec / Acc curve. The table reports, for
+    every stratum, the metrics without deferral, when deferring each of `uncertainty_ranges` (as counted by
+    `stratified_analysis`), and at each of `coverages` (the largest coverage on the curve that does not exceed it).
+
+    Args:
+        data (pd.DataFrame): Data
+        y_gt_col (str): Binary ground truth column
+        y_scores_col (str): Score column
+        strata_cols (list[str], optional): Columns to stratify by. Defaults to [].
+        threshold (float, optional): Threshold. Defaults to 0.5.
+        uncertainty_ranges (list[tuple[float, float]], optional): Score ranges [lower, upper) to defer. Defaults to
+            [(0.4, 0.6)].
+        coverages (list[float], optional): Fractions of datapoints to keep. Defaults to [0.9, 0.8, 0.7].
+        table_columns (list[str], optional): Columns to show. Defaults to DEFERRAL_TABLE_COLUMNS.
+        show_bars (bool, optional): Whether to show bars in the displayed table. Defaults to True.
+        show_plot (bool, optional): Whether to plot the curves. Defaults to True.
+        return_df (bool, optional): Return the table and curves instead of displaying them. Defaults to False.
+
+    Returns:
+        tuple[pd.DataFrame, pd.DataFrame]: Metrics of every deferral policy, indexed by the strata columns and the
+            policy, and the curves, indexed by the strata columns and the smallest margin kept, if return_df is True
+    """
+    if isinstance(threshold, np.floating):
+        threshold = float(threshold)
+    assert isinstance(threshold, float) and 0 <= threshold <= 1, f"Threshold must be between 0 and 1: {threshold}"
+
+    if not return_df:
+        print("-------------------------")
+        print("GT:".ljust(16), y_gt_col)
+        print("Score:".ljust(16), y_scores_col)
+        print("Threshold:".ljust(16), threshold)
+        print()
+
+    if not strata_cols:
+        data = data.copy()
+        data["Data"] = "All"
+        strata_cols = ["Data"]
+
+    cols = [y_gt_col, y_scores_col, *strata_cols]
+    missing_cols = check_cols(data, cols)
+    if missing_cols:
+        print(f"Missing columns: {missing_cols}")
+        return
+
+    df = preprocess_data(data, cols)
+    if len(df) == 0:
+        print(NO_DATA_ERROR, f"({strata_cols})")
+        return
+
+    grouper = df.groupby(strata_cols, sort=True, observed=True)
+    groups = grouper.ngroup().to_numpy()
+    strata = grouper.size().index
+    n_groups = len(strata)
+
+    # Scores are compared in float32, as in `thresh` and `get_uncertain`
+    scores = df["Score"].to_numpy(dtype=np.float32)
+    gt = df["GT"].to_numpy() == 1
+    pred = scores > np.float32(threshold)
+    margins = np.abs(scores - np.float32(threshold))
+
+    # The single sort: by stratum, then from the largest margin to the smallest
+    order = np.lexsort((-margins, groups))
+    sorted_groups, sorted_margins = groups[order], margins[order]
+    group_sizes = np.bincount(groups, minlength=n_groups)
+    group_starts = np.cumsum(group_sizes) - group_sizes
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - group_starts[sorted_groups]
+
+    # Cumulative counts within every stratum, read at the last datapoint of every margin
+    is_last = np.ones(len(order), dtype=bool)
+    is_last[:-1] = (sorted_groups[1:] != sorted_groups[:-1]) | (sorted_margins[1:] != sorted_margins[:-1])
+    cumulative = {}
+    for colname, values in {"P": gt, "PP": pred, "TP": gt & pred}.items():
+        totals = np.bincount(groups, weights=values, minlength=n_groups)
+        cumulative[colname] = (np.cumsum(values[order]) - (np.cumsum(totals) - totals)[sorted_groups])[is_last]
+    curves = pd.DataFrame(cumulative)
+    curves["Total"] = (ranks[order] + 1)[is_last]
+    curve_groups = sorted_groups[is_last]
+    curves["Coverage"] = curves["Total"] / group_sizes[curve_groups]
+    curves["Deferred"] = group_sizes[curve_groups] - curves["Total"]
+    curves = add_count_metrics(curves)
+
+    # Datapoints kept by every policy: no deferral, deferring each uncertainty range, and each coverage
+    policies = ["None"]
+    kept = [np.ones(len(df), dtype=bool)]
+    for lower, upper in uncertainty_ranges:
+        policies.append(f"[{lower}, {upper})")
+        kept.append(~((np.float32(lower) <= scores) & (scores < np.float32(upper))))
+    for coverage in coverages:
+        # The curve is increasing in coverage, so the largest number of datapoints kept within the coverage is its max
+        within = (curves["Coverage"] <= coverage).to_numpy()
+        n_kept = np.zeros(n_groups, dtype=np.int64)
+        np.maximum.at(n_kept, curve_groups[within], curves["Total"].to_numpy()[within])
+        policies.append(f"Coverage {coverage}")
+        kept.append(ranks < n_kept[groups])
+    kept = np.stack(kept, axis=1)
+
+    # Metrics of every (stratum, policy) block, with the AUCs of all the blocks from a single sort
+    rows, cols = np.nonzero(kept)
+    blocks = groups[rows] * len(policies) + cols
+    table = _get_counts(blocks, gt[rows], pred[rows], n_groups * len(policies))
+    table["AUC"], table["AUC 95% CI Lower"], table["AUC 95% CI Upper"], table["Unique"] = get_block_aucs(
+        blocks, scores[rows], gt[rows], n_groups * len(policies)
+    )
+    table = add_count_metrics(table.astype(float))
+    table["Deferred"] = np.repeat(group_sizes, len(policies)) - table["Total"]
+    table["Coverage"] = table["Total"] / np.repeat(group_sizes, len(policies))
+    errors = table["FP"] + table["FN"]
+    all_errors = errors.to_numpy().reshape(n_groups, len(policies))[:, 0]
+    table["Errors Deferred"] = 1 - errors / np.repeat(all_errors, len(policies))
+
+    keys = [key if isinstance(key, tuple) else (key,) for key in strata]
+    table.index = pd.MultiIndex.from_tuples(
+        [(*key, policy) for key in keys for policy in policies], names=[*strata_cols, "Deferral"]
+    )
+    table = table[table_columns]
+    strata_values = strata.to_frame(index=False)
+    curves.index = pd.MultiIndex.from_arrays(
+        [strata_values[col].to_numpy()[curve_groups] for col in strata_cols] + [sorted_margins[is_last]],
+        names=[*strata_cols, "Margin"],
+    )
+
+    if return_df:
+        return table, curves
+    display(style_df(table, show_bars))
+    if show_plot:
+        _plot_curves(curves, strata_cols)
+    print("-------------------------")
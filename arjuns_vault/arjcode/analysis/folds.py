@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+from arjcode.analysis.constants import FOLD_TABLE_COLUMNS, NO_DATA_ERROR
+from arjcode.analysis.utils import (
+    add_count_metrics,
+    check_cols,
+    get_block_aucs,
+    get_thresh_cols,
+    preprocess_data,
+    style_df,
+    thresh,
+)
+from IPython.display import display
+
+
+def fold_analysis(
+    data: pd.DataFrame,
+    y_gt_col: str,
+    y_scores_col: str,
+    fold_cols: list[str],
+    strata_cols: list[str] = [],
+    seed_col: str = None,
+    threshold=0.5,
+    far_thresholds: tuple[float, float] = (0.1, 0.9),
+    y_gt_desc: str = "No description",
+    table_columns: list[str] = FOLD_TABLE_COLUMNS,
+    show_bars: bool = True,
+    return_df: bool = False,
+):
+    """
+    Evaluates the out-of-fold predictions of cross-validation, stacked in one frame with the fold of every prediction
+    in `fold_cols`. Every stratum gets a row per fold, followed by the mean and standard deviation of the metrics over
+    its folds, and the pooled metrics and CIs of all its predictions.
+
+    Repeated runs (e.g. seeds) predict every datapoint once per run, so their column must be given as `seed_col` and
+    not in `fold_cols`: the folds are pooled within every run and the pooled metrics and CIs averaged over runs, as
+    pooling the replicates together would treat them as independent datapoints and make the CIs too narrow.
+
+    The data is grouped once by the strata and fold columns. The confusion counts of every (stratum, fold) block come
+    from a single bincount and their AUCs from a single sort, and the pooled counts of every stratum are the sums of the
+    counts of its folds, instead of one `stratified_analysis` per fold.
+
+    Args:
+        data (pd.DataFrame): Data
+        y_gt_col (str): Binary ground truth column
+        y_scores_col (str): Score column
+        fold_cols (list[str] or str): Columns identifying the fold of every datapoint, e.g. ["Fold", "Seed"]
+        strata_cols (list[str], optional): Columns to stratify by. Defaults to [].
+        seed_col (str, optional): Column identifying the run (e.g. seed) of every prediction, when every datapoint is
+            predicted once per run. Defaults to None.
+        threshold (optional): Threshold, in any format accepted by `stratified_analysis`. Defaults to 0.5.
+        far_thresholds (tuple[float, float], optional): Thresholds of the far FNs and FPs. Defaults to (0.1, 0.9).
+        y_gt_desc (str, optional): Description of the ground truth. Defaults to "No description".
+        table_columns (list[str], optional): Columns to show. Defaults to FOLD_TABLE_COLUMNS.
+        show_bars (bool, optional): Whether to show bars in the displayed table. Defaults to True.
+        return_df (bool, optional): Return the table instead of displaying it. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Metrics indexed by the strata, fold and seed columns, if return_df is True. The Mean, Std and
+            Pooled rows of every stratum are labelled in the first fold column.
+    """
+    fold_cols = [fold_cols] if isinstance(fold_cols, str) else list(fold_cols)
+    assert seed_col not in fold_cols, "The seed column must not be one of the fold columns"
+    # The seed column is the last one of the blocks, so that the summary rows are labelled in the first fold column
+    block_cols = fold_cols if seed_col is None else [*fold_cols, seed_col]
+
+    if not return_df:
+        print("-------------------------")
+        print("GT:".ljust(16), y_gt_col, f"({y_gt_desc})")
+        print("Score:".ljust(16), y_scores_col)
+        print("Folds:".ljust(16), fold_cols)
+        if seed_col is not None:
+            print("Seeds:".ljust(16), seed_col)
+        print("Threshold:".ljust(16), threshold)
+        print("Far thresholds:".ljust(16), far_thresholds)
+        print()
+
+    if not strata_cols:
+        data = data.copy()
+        data["Data"] = "All"
+        strata_cols = ["Data"]
+
+    cols = [y_gt_col, y_scores_col, *strata_cols, *block_cols]
+    other_cols = list(set(get_thresh_cols(threshold)) - set(cols))
+    missing_cols = check_cols(data, cols + other_cols)
+    if missing_cols:
+        print(f"Missing columns: {missing_cols}")
+        return
+
+    df = preprocess_data(data, cols, other_cols)
+    if len(df) == 0:
+        print(NO_DATA_ERROR, f"({strata_cols})")
+        return
+
+    # Blocks are sorted by strata first, so the folds of every stratum are consecutive blocks
+    grouper = df.groupby([*strata_cols, *block_cols], sort=True, observed=True)
+    blocks = grouper.ngroup().to_numpy()
+    keys = grouper.size().index
+    keys = [key if isinstance(key, tuple) else (key,) for key in keys]
+    n_blocks = len(keys)
+    block_strata = pd.Series([key[: len(strata_cols)] for key in keys]).factorize()[0]
+    n_strata = block_strata.max() + 1
+
+    gt = df["GT"].to_numpy() == 1
+    pred = thresh(df, "Score", threshold).to_numpy() == 1
+    far_fn_pred = thresh(df, "Score", far_thresholds[0]).to_numpy() == 1
+    far_fp_pred = thresh(df, "Score", far_thresholds[1]).to_numpy() == 1
+    scores = df["Score"].to_numpy()
+
+    def _count(weights=None):
+        return np.bincount(blocks, weights=weights, minlength=n_blocks)
+
+    count_colnames = ["Total", "P", "PP", "TP", "Far FN", "Far FP"]
+    folds = pd.DataFrame(
+        {
+            "Total": _count(),
+            "P": _count(gt),
+            "PP": _count(pred),
+            "TP": _count(gt & pred),
+            "Far FN": _count(gt & ~pred & ~far_fn_pred),
+            "Far FP": _count(~gt & pred & far_fp_pred),
+        }
+    )
+    folds["AUC"], folds["AUC 95% CI Lower"], folds["AUC 95% CI Upper"], folds["Unique"] = get_block_aucs(
+        blocks, scores, gt, n_blocks
+    )
+
+    # The folds of every stratum are pooled within every seed, where each datapoint appears once. The pooled counts
+    # are the sums of the counts of the folds, only the pooled AUCs need the scores again.
+    pool_keys = [key[: len(strata_cols)] + key[len(strata_cols) + len(fold_cols) :] for key in keys]
+    block_pools = pd.Series(pool_keys).factorize()[0]
+    n_pools = block_pools.max() + 1
+    pools = folds[count_colnames].groupby(block_pools).sum()
+    pools["AUC"], pools["AUC 95% CI Lower"], pools["AUC 95% CI Upper"], pools["Unique"] = get_block_aucs(
+        block_pools[blocks], scores, gt, n_pools
+    )
+    folds = add_count_metrics(folds.astype(float))
+    pool_strata = pd.Series(block_strata).groupby(block_pools).first().to_numpy()
+    pooled = add_count_metrics(pools.astype(float)).groupby(pool_strata).mean()
+
+    # The spread over folds is that of their metrics, which have no CIs of their own
+    by_strata = folds.groupby(block_strata)
+    mean, std = by_strata.mean(), by_strata.std()
+    ci_colnames = [colname for colname in folds.columns if "95% CI" in colname]
+    mean[ci_colnames] = np.nan
+    std[ci_colnames] = np.nan
+
+    summary_labels = ["Mean", "Std", "Pooled"]
+    index, rows = [], []
+    for stratum in range(n_strata):
+        stratum_blocks = np.flatnonzero(block_strata == stratum)
+        key = keys[stratum_blocks[0]][: len(strata_cols)]
+        index += [keys[block] for block in stratum_blocks]
+        index += [(*key, label, *[""] * (len(block_cols) - 1)) for label in summary_labels]
+        rows += [folds.iloc[stratum_blocks], mean.iloc[[stratum]], std.iloc[[stratum]], pooled.iloc[[stratum]]]
+    df = pd.concat(rows, ignore_index=True)
+    df.index = pd.MultiIndex.from_tuples(index, names=[*strata_cols, *block_cols])
+    df = df[table_columns]
+
+    if return_df:
+        return df
+    display(style_df(df, show_bars))
+    print("-------------------------")
@@ -0,0 +1,164 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+from arjcode.analysis.constants import MULTILABEL_TABLE_COLUMNS, NO_DATA_ERROR
+from arjcode.analysis.utils import add_count_metrics, check_cols, get_block_aucs, get_valid_mask, style_df
+from IPython.display import display
+
+
+def _get_matrices(data: pd.DataFrame, y_gt_cols, y_scores_cols: list[str], labels: list, threshold, multi_class: bool):
+    """GT, prediction and validity matrices of shape (datapoints, labels)"""
+    scores = data[y_scores_cols].to_numpy(dtype=np.float32)
+    valid = ~np.isnan(scores)
+
+    if isinstance(y_gt_cols, str):
+        assert multi_class, "A single GT column of class labels is only supported in multi-class mode"
+        classes = data[y_gt_cols]
+        gt = classes.to_numpy()[:, None] == np.array(labels, dtype=object)[None, :]
+        valid &= classes.notna().to_numpy()[:, None]
+    else:
+        assert len(y_gt_cols) == len(y_scores_cols), "Provide one GT column per score column"
+        gt = data[list(y_gt_cols)].to_numpy(dtype=float)
+        valid &= ~np.isnan(gt)
+        assert np.isin(gt[valid], (0, 1)).all(), "GT columns must be binary"
+        gt = gt == 1
+
+    if multi_class:
+        # A datapoint is predicted as the class with the highest score, so all its scores are needed
+        valid &= valid.all(axis=1, keepdims=True)
+        pred = np.zeros(scores.shape, dtype=bool)
+        pred[np.arange(len(scores)), np.argmax(np.where(valid, scores, -np.inf), axis=1)] = True
+    else:
+        if not isinstance(threshold, dict):
+            threshold = {label: threshold for label in labels}
+        assert set(threshold) == set(labels), "A threshold must be provided for every label"
+        thresholds = np.array([threshold[label] for label in labels], dtype=np.float32)
+        pred = scores > thresholds
+
+    return gt & valid, pred & valid, valid, scores
+
+
+def multilabel_analysis(
+    data: pd.DataFrame,
+    y_gt_cols,
+    y_scores_cols: list[str],
+    strata_cols: list[str] = [],
+    labels: list = None,
+    threshold=0.5,
+    multi_class: bool = False,
+    table_columns: list[str] = MULTILABEL_TABLE_COLUMNS,
+    show_bars: bool = True,
+    return_df: bool = False,
+):
+    """
+    Evaluates many labels at once, e.g. every finding of a model which outputs a matrix of probabilities. Every label is
+    evaluated one-vs-rest on the datapoints where both its GT and score are present, and is followed in every stratum by
+    the micro average (counts pooled over labels, and the AUC of all the pooled scores) and the macro average (mean of
+    the metrics of the labels).
+
+    The (datapoint, label) pairs of all strata are stacked into blocks, so the confusion counts of every label and
+    stratum come from a single bincount and the AUCs from a single sort, instead of one `stratified_analysis` per label.
+
+    Args:
+        data (pd.DataFrame): Data
+        y_gt_cols (list[str] or str): Binary GT column of each label. In multi-class mode, this can also be a single
+            column whose values are the labels.
+        y_scores_cols (list[str]): Score column of each label
+        strata_cols (list[str], optional): Columns to stratify by. Defaults to [].
+        labels (list, optional): Name of each label. Defaults to `y_scores_cols`.
+        threshold (float or dict, optional): Threshold of all labels, or of each label. Ignored in multi-class mode.
+            Defaults to 0.5.
+        multi_class (bool, optional): Whether the labels are mutually exclusive, in which case every datapoint is
+            predicted as the label with the highest score. Defaults to False.
+        table_columns (list[str], optional): Columns to show. Defaults to MULTILABEL_TABLE_COLUMNS.
+        show_bars (bool, optional): Whether to show bars in the displayed table. Defaults to True.
+        return_df (bool, optional): Return the table instead of displaying it. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Metrics indexed by the strata columns and the label, if return_df is True
+    """
+    if labels is None:
+        labels = list(y_scores_cols)
+    assert len(labels) == len(y_scores_cols), "Provide one label name per score column"
+
+    if not return_df:
+        print("-------------------------")
+        print("GT:".ljust(16), y_gt_cols)
+        print("Score:".ljust(16), y_scores_cols)
+        print("Threshold:".ljust(16), "argmax" if multi_class else threshold)
+        print()
+
+    if not strata_cols:
+        data = data.copy()
+        data["Data"] = "All"
+        strata_cols = ["Data"]
+
+    gt_cols = [y_gt_cols] if isinstance(y_gt_cols, str) else list(y_gt_cols)
+    missing_cols = check_cols(data, gt_cols + list(y_scores_cols) + strata_cols)
+    if missing_cols:
+        print(f"Missing columns: {missing_cols}")
+        return
+
+    data = data[get_valid_mask(data, strata_cols)]
+    gt, pred, valid, scores = _get_matrices(data, y_gt_cols, y_scores_cols, labels, threshold, multi_class)
+    if not valid.any():
+        print(NO_DATA_ERROR, f"({strata_cols})")
+        return
+
+    grouper = data.groupby(strata_cols, sort=True, observed=True)
+    groups = grouper.ngroup().to_numpy()
+    strata = grouper.size().index
+    n_groups, n_labels = len(strata), len(labels)
+
+    # Every valid (datapoint, label) pair belongs to the block of its stratum and label
+    rows, cols = np.nonzero(valid)
+    blocks = groups[rows] * n_labels + cols
+    gt, pred, scores = gt[rows, cols], pred[rows, cols], scores[rows, cols]
+
+    def _count(weights=None):
+        return np.bincount(blocks, weights=weights, minlength=n_groups * n_labels).reshape(n_groups, n_labels)
+
+    counts = {"Total": _count(), "P": _count(gt), "PP": _count(pred), "TP": _count(gt & pred)}
+    aucs = [auc.reshape(n_groups, n_labels) for auc in get_block_aucs(blocks, scores, gt, n_groups * n_labels)]
+    micro_aucs = get_block_aucs(groups[rows], scores, gt, n_groups)
+
+    auc_colnames = ["AUC", "AUC 95% CI Lower", "AUC 95% CI Upper", "Unique"]
+    per_label = pd.DataFrame(
+        {colname: count.ravel() for colname, count in counts.items()}
+        | {colname: auc.ravel() for colname, auc in zip(auc_colnames, aucs)}
+    )
+    micro = pd.DataFrame(
+        {colname: count.sum(axis=1) for colname, count in counts.items()}
+        | {colname: auc for colname, auc in zip(auc_colnames, micro_aucs)}
+    )
+    per_label = add_count_metrics(per_label.astype(float))
+    micro = add_count_metrics(micro.astype(float))
+
+    # Macro averages are the means of the metrics of the labels, next to the pooled counts
+    metric_colnames = ["AUC", "Sen", "Spec", "Youden", "PPV", "NPV", "F1", "Acc"]
+    macro = micro.copy()
+    macro[[colname for colname in macro.columns if "95% CI" in colname]] = np.nan
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=RuntimeWarning, message="Mean of empty slice")
+        macro[metric_colnames] = np.nanmean(
+            per_label[metric_colnames].to_numpy().reshape(n_groups, n_labels, -1), axis=1
+        )
+
+    df = pd.concat(
+        [
+            pd.concat([per_label.iloc[g * n_labels : (g + 1) * n_labels], micro.iloc[[g]], macro.iloc[[g]]])
+            for g in range(n_groups)
+        ],
+        ignore_index=True,
+    )
+    keys = [key if isinstance(key, tuple) else (key,) for key in strata]
+    df.index = pd.MultiIndex.from_tuples(
+        [(*key, label) for key in keys for label in [*labels, "Micro", "Macro"]], names=[*strata_cols, "Label"]
+    )
+    df = df[table_columns]
+
+    if return_df:
+        return df
+    display(style_df(df, show_bars))
+    print("-------------------------")
@@ -0,0 +1,240 @@
+import numpy as np
+import pandas as pd
+from arjcode.analysis.constants import NO_DATA_ERROR, PREVIEW_TABLE_COLUMNS
+from arjcode.analysis.utils import (
+    add_count_metrics,
+    check_cols,
+    get_block_aucs,
+    get_thresh_cols,
+    get_valid_mask,
+    preprocess_data,
+    style_df,
+    thresh,
+)
+from IPython.display import display
+from scipy.stats import norm
+
+_Z = norm.ppf(0.975)
+
+
+def _get_preview_table(sample: pd.DataFrame, groups: np.ndarray, population: pd.DataFrame, threshold):
+    """Metrics of every stratum on its sample, with the 95% bounds of their sampling error from the full data"""
+    n_groups = len(population)
+    gt = sample["GT"].to_numpy() == 1
+    pred = thresh(sample, "Score", threshold).to_numpy() == 1
+
+    def _count(weights=None):
+        return np.bincount(groups, weights=weights, minlength=n_groups)
+
+    df = pd.DataFrame({"Total": _count(), "P": _count(gt), "PP": _count(pred), "TP": _count(gt & pred)})
+    df["AUC"], lower, _, df["Unique"] = get_block_aucs(groups, sample["Score"].to_numpy(), gt, n_groups)
+    df = add_count_metrics(df.astype(float))
+
+    # The sample is drawn without replacement, so its error shrinks to 0 as it covers the whole stratum
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for metric, n, total in [
+            ("Sen", df["P"], population["P"]),
+            ("Spec", df["N"], population["N"]),
+            ("AUC", df["Total"], population["Total"]),
+        ]:
+            correction = np.sqrt(np.clip(1 - n / total, 0, 1))
+            if metric == "AUC":
+                error = (df["AUC"] - lower) * correction
+            else:
+                error = _Z * np.sqrt(df[metric] * (1 - df[metric]) / n) * correction
+            df[f"{metric} Error"] = error
+
+    df["Sampled"] = df["Total"]
+    df[["Total", "P", "N"]] = population[["Total", "P", "N"]].to_numpy()
+    return df
+
+
+def _iter_preview(
+    df: pd.DataFrame,
+    strata_cols: list[str],
+    threshold,
+    target_ci_width: float,
+    initial_size: int,
+    growth: float,
+    max_rounds: int,
+    seed: int,
+):
+    """
+    Draws a random sample of every stratum, growing it round by round until the sampling errors of Sen, Spec and AUC
+    are within half of `target_ci_width` (or the stratum is exhausted). Yields the positions of the sampled rows of
+    `df`, the strata and the preview table after every round.
+    """
+    grouper = df.groupby(strata_cols, sort=True, observed=True)
+    groups = grouper.ngroup().to_numpy()
+    strata = grouper.size().index
+    n_groups = len(strata)
+
+    group_sizes = np.bincount(groups, minlength=n_groups)
+    population = pd.DataFrame({"Total": group_sizes, "P": np.bincount(groups, weights=df["GT"], minlength=n_groups)})
+    population["N"] = population["Total"] - population["P"]
+
+    # Every stratum is visited in a random order, so that each round extends the previous sample
+    rng = np.random.default_rng(seed)
+    shuffled = rng.permutation(len(df))
+    sequence = shuffled[np.argsort(groups[shuffled], kind="stable")]
+    ranks = np.arange(len(df)) - (np.cumsum(group_sizes) - group_sizes)[groups[sequence]]
+
+    sizes = np.minimum(initial_size, group_sizes)
+    for _ in range(max_rounds):
+        positions = sequence[ranks < sizes[groups[sequence]]]
+        table = _get_preview_table(df.iloc[positions], groups[positions], population, threshold)
+        yield positions, strata, table
+
+        # Errors shrink as 1 / sqrt(sample size), which gives the size each stratum needs
+        errors = table[["Sen Error", "Spec Error", "AUC Error"]].to_numpy()
+        ratios = np.where(np.isnan(errors), 0, errors).max(axis=1) / (target_ci_width / 2)
+        needed = np.ceil(sizes * np.maximum(ratios, 1) ** 2 * 1.1).astype(np.int64)
+        # A class missing from the sample but not from the stratum leaves its errors unknown, so the sample keeps
+        # growing until it is found (the errors of classes missing from the whole stratum are not needed)
+        unknown = (np.isnan(errors[:, 0]) & (population["P"] > 0).to_numpy()) | (
+            np.isnan(errors[:, 1]) & (population["N"] > 0).to_numpy()
+        )
+        needed[unknown] = group_sizes[unknown]
+        done = ((ratios <= 1) & ~unknown) | (sizes == group_sizes)
+        if done.all():
+            break
+        new_sizes = np.minimum(np.minimum(needed, np.ceil(sizes * growth).astype(np.int64)), group_sizes)
+        sizes = np.where(done, sizes, np.maximum(new_sizes, sizes + 1))
+
+
+def get_preview_sample(
+    data: pd.DataFrame,
+    y_gt_col: str,
+    y_scores_col: str,
+    strata_cols: list[str] = [],
+    threshold=0.5,
+    target_ci_width: float = 0.05,
+    initial_size: int = 1000,
+    growth: float = 4,
+    max_rounds: int = 10,
+    seed: int = 0,
+):
+    """
+    Stratified random sample of `data`, sized per stratum so that the sampling errors of its Sen, Spec and AUC are
+    within half of `target_ci_width`. The metrics of every stratum computed on the sample, e.g. by
+    `stratified_analysis` or `threshold_analysis`, approximate those on the full data, but the strata are sampled at
+    different rates, so metrics pooled over strata are not.
+
+    Args:
+        data (pd.DataFrame): Data
+        y_gt_col (str): Binary ground truth column
+        y_scores_col (str): Score column
+        strata_cols (list[str], optional): Columns to stratify by. Defaults to [].
+        threshold (optional): Threshold used to size the sample, in any format accepted by `stratified_analysis`.
+            Defaults to 0.5.
+        target_ci_width (float, optional): Width of the 95% interval of the sampling error. Defaults to 0.05.
+        initial_size (int, optional): Size of the first sample of every stratum. Defaults to 1000.
+        growth (float, optional): Maximum factor by which a sample grows in a round. Defaults to 4.
+        max_rounds (int, optional): Maximum number of rounds. Defaults to 10.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: Sampled rows of `data`
+    """
+    cols = [y_gt_col, y_scores_col, *strata_cols]
+    other_cols = list(set(get_thresh_cols(threshold)) - set(cols))
+    valid_positions = np.flatnonzero(get_valid_mask(data, cols))
+    df = preprocess_data(data, cols, other_cols)
+    if len(df) == 0:
+        return data.iloc[valid_positions]
+
+    if not strata_cols:
+        df["Data"] = "All"
+        strata_cols = ["Data"]
+    positions = None
+    for positions, _, _ in _iter_preview(
+        df, strata_cols, threshold, target_ci_width, initial_size, growth, max_rounds, seed
+    ):
+        pass
+    return data.iloc[valid_positions[np.sort(positions)]]
+
+
+def preview_analysis(
+    data: pd.DataFrame,
+    y_gt_col: str,
+    y_scores_col: str,
+    strata_cols: list[str] = [],
+    threshold=0.5,
+    target_ci_width: float = 0.05,
+    initial_size: int = 1000,
+    growth: float = 4,
+    max_rounds: int = 10,
+    seed: int = 0,
+    table_columns: list[str] = PREVIEW_TABLE_COLUMNS,
+    show_bars: bool = True,
+    return_df: bool = False,
+):
+    """
+    Fast approximate `stratified_analysis` for interactive exploration of large frames. Metrics are computed on a
+    stratified random sample which grows round by round (see `get_preview_sample`), and the displayed table is
+    refined after every round. Total, P and N are exact; every other metric is estimated from the sample, and the
+    Error columns are the half-widths of the 95% intervals of the differences from the metrics on the full data.
+    Run `stratified_analysis` for the exact metrics.
+
+    Args:
+        data (pd.DataFrame): Data
+        y_gt_col (str): Binary ground truth column
+        y_scores_col (str): Score column
+        strata_cols (list[str], optional): Columns to stratify by. Defaults to [].
+        threshold (optional): Threshold, in any format accepted by `stratified_analysis`. Defaults to 0.5.
+        target_ci_width (float, optional): Width of the 95% interval of the sampling error. Defaults to 0.05.
+        initial_size (int, optional): Size of the first sample of every stratum. Defaults to 1000.
+        growth (float, optional): Maximum factor by which a sample grows in a round. Defaults to 4.
+        max_rounds (int, optional): Maximum number of rounds. Defaults to 10.
+        seed (int, optional): Random seed. Defaults to 0.
+        table_columns (list[str], optional): Columns to show. Defaults to PREVIEW_TABLE_COLUMNS.
+        show_bars (bool, optional): Whether to show bars in the displayed table. Defaults to True.
+        return_df (bool, optional): Return the final table instead of displaying the refinements. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Approximate metrics indexed by the strata columns, if return_df is True
+    """
+    if not return_df:
+        print("-------------------------")
+        print("GT:".ljust(16), y_gt_col)
+        print("Score:".ljust(16), y_scores_col)
+        print("Threshold:".ljust(16), threshold)
+        print("Target CI width:".ljust(16), target_ci_width)
+        print()
+
+    if not strata_cols:
+        data = data.copy()
+        data["Data"] = "All"
+        strata_cols = ["Data"]
+
+    cols = [y_gt_col, y_scores_col, *strata_cols]
+    other_cols = list(set(get_thresh_cols(threshold)) - set(cols))
+    missing_cols = check_cols(data, cols + other_cols)
+    if missing_cols:
+        print(f"Missing columns: {missing_cols}")
+        return
+
+    df = preprocess_data(data, cols, other_cols)
+    if len(df) == 0:
+        print(NO_DATA_ERROR, f"({strata_cols})")
+        return
+
+    handle = None
+    for i, (_, strata, table) in enumerate(
+        _iter_preview(df, strata_cols, threshold, target_ci_width, initial_size, growth, max_rounds, seed)
+    ):
+        table.index = strata
+        table = table[table_columns]
+        if return_df:
+            continue
+        styled = style_df(table, show_bars).set_caption(
+            f"Round {i + 1}: {int(table['Sampled'].sum())} of {len(df)} rows sampled"
+        )
+        if handle is None:
+            handle = display(styled, display_id=True)
+        else:
+            handle.update(styled)
+
+    if return_df:
+        return table
+    print("-------------------------")
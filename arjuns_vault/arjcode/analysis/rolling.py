@@ -0,0 +1,279 @@
+import numpy as np
+import pandas as pd
+from arjcode.analysis.constants import DRIFT_COLUMNS, ROLLING_TABLE_COLUMNS
+from arjcode.analysis.utils import add_count_metrics, check_cols, get_histogram_aucs, get_valid_mask, style_df
+from IPython.display import display
+
+
+class RollingEvaluation:
+    """
+    Evaluates a model in production over time windows (e.g. days or weeks) of a timestamp column, per stratum.
+
+    Only sufficient statistics are kept for every (window, stratum): histograms of the scores of the positives,
+    negatives and unlabelled datapoints, and the number of each predicted positive. They are additive, so new
+    predictions are added with `update` without revisiting history, and rolling windows are sums of consecutive windows.
+    Every datapoint must be added exactly once; ground truth that arrives after its datapoint was added without it is
+    added with `update(..., relabel=True)`, which moves the datapoint from the unlabelled to the labelled histograms.
+
+    Sen, Spec and the other confusion metrics are exact. The AUC, and the PSI and KS drift of the score distribution
+    from a reference window, are computed from the histograms, so scores are resolved to `n_bins` bins in [0, 1].
+
+    Args:
+        y_gt_col (str): Binary ground truth column. Datapoints without ground truth only count towards drift.
+        y_scores_col (str): Score column
+        time_col (str): Timestamp column
+        strata_cols (list[str], optional): Columns to stratify by. Defaults to [].
+        freq (str, optional): Window length, as a pandas period frequency ("D", "W", "M", ...). Defaults to "D".
+        threshold (float, optional): Threshold. Defaults to 0.5.
+        n_bins (int, optional): Number of score bins. Defaults to 1000.
+    """
+
+    def __init__(
+        self,
+        y_gt_col: str,
+        y_scores_col: str,
+        time_col: str,
+        strata_cols: list[str] = [],
+        freq: str = "D",
+        threshold: float = 0.5,
+        n_bins: int = 1000,
+    ):
+        if isinstance(threshold, np.floating):
+            threshold = float(threshold)
+        assert isinstance(threshold, float) and 0 <= threshold <= 1, f"Threshold must be between 0 and 1: {threshold}"
+
+        self.y_gt_col = y_gt_col
+        self.y_scores_col = y_scores_col
+        self.time_col = time_col
+        self.strata_cols = list(strata_cols)
+        self.freq = freq
+        self.threshold = threshold
+        self.n_bins = n_bins
+
+        # (window, *strata) -> counts of shape (3, n_bins + 1): the score histograms of the negatives, positives and
+        # unlabelled datapoints, followed by the number of them that are predicted positive
+        self.stats = {}
+
+    def __len__(self):
+        return len(self.stats)
+
+    def __repr__(self):
+        return f"RollingEvaluation({len(self)} windows x strata, freq={self.freq})"
+
+    def update(self, data: pd.DataFrame, relabel: bool = False):
+        """
+        Adds datapoints to the statistics of their windows
+
+        Args:
+            data (pd.DataFrame): New datapoints
+            relabel (bool, optional): Whether `data` holds the ground truth of datapoints which were already added
+                without it. They are moved from the unlabelled histograms to the labelled ones, and datapoints still
+                without ground truth are ignored. Defaults to False.
+        """
+        cols = [self.y_gt_col, self.y_scores_col, self.time_col, *self.strata_cols]
+        missing_cols = check_cols(data, cols)
+        assert not missing_cols, f"Missing columns: {missing_cols}"
+
+        valid_cols = [self.y_scores_col, self.time_col, *self.strata_cols]
+        data = data[get_valid_mask(data, valid_cols + [self.y_gt_col] if relabel else valid_cols)]
+        if len(data) == 0:
+            return
+
+        # Scores are compared in float32, as in `thresh`
+        scores = data[self.y_scores_col].to_numpy(dtype=np.float32)
+        bins = np.clip((scores.astype(float) * self.n_bins).astype(np.int64), 0, self.n_bins - 1)
+        pred = scores > np.float32(self.threshold)
+        gt = data[self.y_gt_col].to_numpy(dtype=float)
+        assert np.isin(gt[~np.isnan(gt)], (0, 1)).all(), "GT column must be binary"
+        kinds = np.where(np.isnan(gt), 2, gt).astype(np.int64)
+
+        windows = pd.to_datetime(data[self.time_col]).dt.to_period(self.freq).dt.start_time
+        grouper = pd.concat([windows, data[self.strata_cols]], axis=1).groupby(
+            [windows.name, *self.strata_cols], sort=False, observed=True
+        )
+        groups = grouper.ngroup().to_numpy()
+        keys = grouper.size().index
+
+        # One bincount for the histograms and one for the predicted positives of all the new (window, stratum) pairs
+        size = 3 * (self.n_bins + 1)
+        flat = groups * size + kinds * (self.n_bins + 1)
+        counts = np.bincount(flat + bins, minlength=len(keys) * size)
+        counts += np.bincount(flat + self.n_bins, weights=pred, minlength=len(keys) * size).astype(np.int64)
+        counts = counts.reshape(len(keys), 3, self.n_bins + 1)
+        if relabel:
+            # The same datapoints were counted as unlabelled
+            counts[:, 2] = -counts[:, :2].sum(axis=1)
+
+        keys = [key if isinstance(key, tuple) else (key,) for key in keys]
+        if relabel:
+            # Checked before any change, so that a failed update leaves the statistics untouched
+            for key, key_counts in zip(keys, counts):
+                assert (
+                    key in self.stats and (self.stats[key] + key_counts >= 0).all()
+                ), f"Datapoints relabelled in {key} were not added without ground truth"
+
+        for key, key_counts in zip(keys, counts):
+            if key in self.stats:
+                self.stats[key] += key_counts
+            else:
+                self.stats[key] = key_counts.copy()
+
+    def _get_windows(self, rolling: int):
+        """
+        Yields the strata, and the start and counts of every window of the strata from the first to the last (including
+        empty ones), with the counts summed over the last `rolling` windows
+        """
+        by_strata = {}
+        for key in sorted(self.stats, key=lambda key: (key[1:], key[0])):
+            by_strata.setdefault(key[1:], []).append(key[0])
+
+        for strata, windows in by_strata.items():
+            windows = pd.DatetimeIndex(windows)
+            periods = pd.period_range(windows.min(), windows.max(), freq=self.freq)
+            dense = np.zeros((len(periods), 3, self.n_bins + 1), dtype=np.int64)
+            dense[periods.get_indexer(windows.to_period(self.freq))] = [
+                self.stats[(window, *strata)] for window in windows
+            ]
+
+            # Rolling sums as differences of cumulative sums
+            cumulative = np.cumsum(dense, axis=0)
+            rolled = cumulative.copy()
+            rolled[rolling:] -= cumulative[:-rolling]
+            yield strata, periods.start_time, rolled
+
+    def get_table(self, rolling: int = 1, reference: str = "previous", psi_bins: int = 10):
+        """
+        Metrics of every window of every stratum
+
+        Args:
+            rolling (int, optional): Number of consecutive windows summed into each row. Defaults to 1.
+            reference (str, optional): Window the drift is measured from: "previous" (the `rolling` windows before) or
+                "first". Defaults to "previous".
+            psi_bins (int, optional): Number of equal-width score bins of the PSI. Must divide `n_bins`. Defaults to 10.
+
+        Returns:
+            pd.DataFrame: Metrics indexed by the start of the (last) window and the strata columns
+        """
+        assert rolling >= 1, f"rolling must be at least 1: {rolling}"
+        assert reference in ("previous", "first"), f"Unknown reference: {reference}"
+        assert self.n_bins % psi_bins == 0, "psi_bins must divide n_bins"
+
+        index, stats, psis, kss = [], [], [], []
+        for strata, starts, rolled in self._get_windows(rolling):
+            histograms = rolled[:, :3, :-1].sum(axis=1).astype(float)
+            references = np.full(histograms.shape, np.nan)
+            if reference == "previous":
+                references[rolling:] = histograms[:-rolling]
+            elif len(histograms) >= rolling:
+                references[:] = histograms[rolling - 1]
+            psi, ks = _get_drift(histograms, references, psi_bins)
+
+            # Only windows with `rolling` windows of history are reported
+            index += [(start, *strata) for start in starts[rolling - 1 :]]
+            stats.append(rolled[rolling - 1 :])
+            psis.append(psi[rolling - 1 :])
+            kss.append(ks[rolling - 1 :])
+        if not index:
+            return pd.DataFrame(columns=ROLLING_TABLE_COLUMNS + DRIFT_COLUMNS)
+        stats = np.concatenate(stats)
+
+        negatives, positives, unlabelled = stats[:, 0, :-1], stats[:, 1, :-1], stats[:, 2, :-1]
+        df = pd.DataFrame(
+            {
+                "Scored": (negatives + positives + unlabelled).sum(axis=1),
+                "Total": (negatives + positives).sum(axis=1),
+                "P": positives.sum(axis=1),
+                "PP": stats[:, 0, -1] + stats[:, 1, -1],
+                "TP": stats[:, 1, -1],
+            }
+        )
+
+        # AUCs of all the windows from their non-empty bins
+        rows, bins = np.nonzero(negatives + positives)
+        df["AUC"], df["AUC 95% CI Lower"], df["AUC 95% CI Upper"], df["Unique"] = get_histogram_aucs(
+            rows, positives[rows, bins], negatives[rows, bins], len(df)
+        )
+        df = add_count_metrics(df.astype(float)).drop(columns="Unique")
+        df["PSI"] = np.concatenate(psis)
+        df["KS"] = np.concatenate(kss)
+
+        if self.strata_cols:
+            df.index = pd.MultiIndex.from_tuples(index, names=["Window", *self.strata_cols])
+        else:
+            df.index = pd.DatetimeIndex([window for window, in index], name="Window")
+        return df
+
+    def display(
+        self,
+        rolling: int = 1,
+        reference: str = "previous",
+        table_columns: list[str] = ROLLING_TABLE_COLUMNS + DRIFT_COLUMNS,
+        show_bars: bool = True,
+    ):
+        """Displays the table of `get_table` with the columns `table_columns`"""
+        display(style_df(self.get_table(rolling, reference)[table_columns], show_bars))
+
+
+def _get_drift(histograms: np.ndarray, references: np.ndarray, psi_bins: int, eps: float = 1e-4):
+    """PSI (on `psi_bins` coarser bins) and KS statistic between every row of `histograms` and of `references`"""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p = histograms / histograms.sum(axis=1, keepdims=True)
+        q = references / references.sum(axis=1, keepdims=True)
+        ks = np.abs(np.cumsum(p, axis=1) - np.cumsum(q, axis=1)).max(axis=1)
+
+        # Empty bins are floored at `eps`, as is customary for the PSI
+        coarse_p = np.maximum(p.reshape(len(p), psi_bins, -1).sum(axis=2), eps)
+        coarse_q = np.maximum(q.reshape(len(q), psi_bins, -1).sum(axis=2), eps)
+        psi = ((coarse_p - coarse_q) * np.log(coarse_p / coarse_q)).sum(axis=1)
+    return psi, ks
+
+
+def rolling_analysis(
+    data: pd.DataFrame,
+    y_gt_col: str,
+    y_scores_col: str,
+    time_col: str,
+    strata_cols: list[str] = [],
+    freq: str = "D",
+    rolling: int = 1,
+    threshold: float = 0.5,
+    reference: str = "previous",
+    n_bins: int = 1000,
+    table_columns: list[str] = ROLLING_TABLE_COLUMNS + DRIFT_COLUMNS,
+    show_bars: bool = True,
+    return_df: bool = False,
+):
+    """
+    Windowed evaluation of a static frame. See `RollingEvaluation`, which can be updated as new predictions arrive.
+
+    Args:
+        data (pd.DataFrame): Data
+        y_gt_col (str): Binary ground truth column
+        y_scores_col (str): Score column
+        time_col (str): Timestamp column
+        strata_cols (list[str], optional): Columns to stratify by. Defaults to [].
+        freq (str, optional): Window length, as a pandas period frequency. Defaults to "D".
+        rolling (int, optional): Number of consecutive windows summed into each row. Defaults to 1.
+        threshold (float, optional): Threshold. Defaults to 0.5.
+        reference (str, optional): Window the drift is measured from, "previous" or "first". Defaults to "previous".
+        n_bins (int, optional): Number of score bins. Defaults to 1000.
+        table_columns (list[str], optional): Columns to show. Defaults to ROLLING_TABLE_COLUMNS + DRIFT_COLUMNS.
+        show_bars (bool, optional): Whether to show bars in the displayed table. Defaults to True.
+        return_df (bool, optional): Return the table instead of displaying it. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Metrics indexed by the start of the window and the strata columns, if return_df is True
+    """
+    evaluation = RollingEvaluation(y_gt_col, y_scores_col, time_col, strata_cols, freq, threshold, n_bins)
+    evaluation.update(data)
+    df = evaluation.get_table(rolling, reference)[table_columns]
+    if return_df:
+        return df
+
+    print("-------------------------")
+    print("GT:".ljust(16), y_gt_col)
+    print("Score:".ljust(16), y_scores_col)
+    print("Window:".ljust(16), freq if rolling == 1 else f"{rolling} x {freq}")
+    print()
+    display(style_df(df, show_bars))
+    print("-------------------------")
@@ -1,19 +1,64 @@
 import warnings
 
 import pandas as pd
+from arjcode.analysis.arrow_backend import add_constant_column, get_columns, get_stratified_metrics
 from arjcode.analysis.constants import NO_DATA_ERROR, TABLE_COLUMNS
+from arjcode.analysis.preview import get_preview_sample
 from arjcode.analysis.utils import (
     add_metrics,
     check_cols,
     get_thresh_cols,
     get_uncertain,
     preprocess_data,
+    restore_index_dtypes,
     style_df,
     thresh,
 )
 from IPython.display import display
 
 
+def _get_stratified_metrics(
+    data: pd.DataFrame,
+    cols: list[str],
+    other_cols: list[str],
+    unpack_strata_cols: bool,
+    threshold,
+    far_thresholds: tuple[float, float],
+    uncertainty_ranges: list[tuple[float, float]],
+    uncertainty_colnames: list[str],
+):
+    strata_cols = cols[2:]
+    df = preprocess_data(data, cols, other_cols)
+    df["Pred"] = thresh(df, "Score", threshold)
+    df["Far FN Pred"] = thresh(df, "Score", far_thresholds[0])
+    df["Far FP Pred"] = thresh(df, "Score", far_thresholds[1])
+    for i, uncertainty_range in enumerate(uncertainty_ranges):
+        df[f"Uncertain{i}"] = get_uncertain(df["Score"], uncertainty_range)
+
+    if len(df) == 0:
+        return None
+
+    if unpack_strata_cols:
+        for strata_col in strata_cols:
+            if isinstance(df[strata_col].values[0], (list, tuple)):
+                indices = df.index
+                new_rows = []
+                for i in indices:
+                    new_row = df.loc[i].to_dict()
+                    for val in df.loc[i, strata_col]:
+                        new_rows.append(new_row | {strata_col: str(val)})
+                df = df.drop(index=indices)
+                df = pd.concat([df, pd.DataFrame(new_rows)], ignore_index=True)
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=FutureWarning, message=".*empty or all-NA entries.*")
+        return pd.DataFrame(
+            df.groupby(strata_cols, sort=False, observed=True)
+            .apply(lambda x: add_metrics(x, uncertainty_ranges, uncertainty_colnames))
+            .reset_index(drop=True)
+        )
+
+
 def stratified_analysis(
     data: pd.DataFrame,
     y_gt_col: str,
@@ -28,6 +73,7 @@ def stratified_analysis(
     table_columns=TABLE_COLUMNS,
     show_bars: bool = True,
     return_df: bool = False,
+    preview_ci_width: float = None,
 ):
     if not return_df:
         print("-------------------------")
@@ -38,8 +84,11 @@ def stratified_analysis(
         print()
 
     if not strata_cols:
-        data = data.copy()
-        data["Data"] = "All"
+        if isinstance(data, pd.DataFrame):
+            data = data.copy()
+            data["Data"] = "All"
+        else:
+            data = add_constant_column(data, "Data", "All")
         strata_cols = ["Data"]
 
     uncertainty_colnames = []
@@ -50,41 +99,39 @@ def stratified_analysis(
     thresh_cols = get_thresh_cols(threshold)
     other_cols = list(set(thresh_cols) - set(cols))
 
-    missing_cols = check_cols(data, cols + other_cols)
+    if isinstance(data, pd.DataFrame):
+        missing_cols = check_cols(data, cols + other_cols)
+    else:
+        # Arrow tables, polars frames and parquet files are aggregated by the multi-threaded Arrow backend
+        missing_cols = [col for col in cols + other_cols if col not in get_columns(data)]
     if missing_cols:
         print(f"Missing columns: {missing_cols}")
     else:
-        df = preprocess_data(data, cols, other_cols)
-        df["Pred"] = thresh(df, "Score", threshold)
-        df["Far FN Pred"] = thresh(df, "Score", far_thresholds[0])
-        df["Far FP Pred"] = thresh(df, "Score", far_thresholds[1])
-        for i, uncertainty_range in enumerate(uncertainty_ranges):
-            df[f"Uncertain{i}"] = get_uncertain(df["Score"], uncertainty_range)
-
-        if len(df) == 0:
+        if preview_ci_width is not None:
+            # Approximate metrics on a stratified sample, see `preview_analysis`
+            assert isinstance(data, pd.DataFrame), "Previews are only supported for pandas data"
+            assert not unpack_strata_cols, "Previews do not support unpacking strata columns"
+            n_rows = len(data)
+            data = get_preview_sample(data, y_gt_col, y_scores_col, strata_cols, threshold, preview_ci_width)
+            if not return_df:
+                print(f"Preview on {len(data)} of {n_rows} rows")
+
+        get_metrics = _get_stratified_metrics if isinstance(data, pd.DataFrame) else get_stratified_metrics
+        df = get_metrics(
+            data,
+            cols,
+            other_cols,
+            unpack_strata_cols,
+            threshold,
+            far_thresholds,
+            uncertainty_ranges,
+            uncertainty_colnames,
+        )
+
+        if df is None:
             print(NO_DATA_ERROR, f"({strata_cols})")
         else:
-            if unpack_strata_cols:
-                for strata_col in strata_cols:
-                    if isinstance(df[strata_col].values[0], (list, tuple)):
-                        indices = df.index
-                        new_rows = []
-                        for i in indices:
-                            new_row = df.loc[i].to_dict()
-                            for val in df.loc[i, strata_col]:
-                                new_row[strata_col] = str(val)
-                                new_rows.append(new_row)
-                        df = df.drop(index=indices)
-                        df = pd.concat([df, pd.DataFrame(new_rows)], ignore_index=True)
-
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore", category=FutureWarning, message=".*empty or all-NA entries.*")
-                df = pd.DataFrame(
-                    df.groupby(strata_cols, sort=False)
-                    .apply(lambda x: add_metrics(x, uncertainty_ranges, uncertainty_colnames))
-                    .reset_index(drop=True)
-                )
-            df = df.groupby(strata_cols, sort=False).agg(
+            df = df.groupby(strata_cols, sort=False, observed=True).agg(
                 {colname: "max" for colname in table_columns}
                 | {uncertainty_colname: "max" for uncertainty_colname in uncertainty_colnames}
             )
@@ -94,6 +141,7 @@ def stratified_analysis(
                 df = df.iloc[: min(limit, len(df))]
 
             df = df.sort_index()
+            df.index = restore_index_dtypes(df.index)
 
             if not return_df:
                 df = style_df(df, show_bars)
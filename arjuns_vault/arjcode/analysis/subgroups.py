@@ -0,0 +1,209 @@
+import heapq
+
+import numpy as np
+import pandas as pd
+from arjcode.analysis.constants import NO_DATA_ERROR
+from arjcode.analysis.utils import check_cols, get_histogram_aucs, get_thresh_cols, preprocess_data, style_df, thresh
+from IPython.display import display
+from statsmodels.stats.proportion import proportion_confint
+
+
+def _get_wilson_ci(successes, total):
+    if total == 0:
+        return np.nan, np.nan
+    return proportion_confint(successes, total, alpha=0.05, method="wilson")
+
+
+def _get_auc(sorted_scores: np.ndarray, gt: np.ndarray):
+    """AUC and DeLong 95% CI of scores that are already sorted, computed as in `stratified_analysis`"""
+    is_new_score = np.ones(len(sorted_scores), dtype=bool)
+    is_new_score[1:] = sorted_scores[1:] != sorted_scores[:-1]
+    score_ids = np.cumsum(is_new_score) - 1
+    positives = np.bincount(score_ids, weights=gt)
+    negatives = np.bincount(score_ids) - positives
+    auc, lower, upper, _ = get_histogram_aucs(np.zeros(len(positives), dtype=int), positives, negatives, 1)
+    return auc[0], (lower[0], upper[0])
+
+
+def _get_group_stats(positions: np.ndarray, gt: np.ndarray, pred: np.ndarray, scores: np.ndarray):
+    group_gt = gt[positions]
+    group_pred = pred[positions]
+    n_positives = int(group_gt.sum())
+    n_negatives = len(positions) - n_positives
+    tp = int((group_gt & group_pred).sum())
+    fp = int(group_pred.sum()) - tp
+    stats = {
+        "Total": len(positions),
+        "P": n_positives,
+        "N": n_negatives,
+        "TP": tp,
+        "FN": n_positives - tp,
+        "FP": fp,
+        "TN": n_negatives - fp,
+    }
+    stats["Sen"] = tp / n_positives if n_positives else np.nan
+    stats["Sen 95% CI Lower"], stats["Sen 95% CI Upper"] = _get_wilson_ci(tp, n_positives)
+    stats["Spec"] = stats["TN"] / n_negatives if n_negatives else np.nan
+    stats["Spec 95% CI Lower"], stats["Spec 95% CI Upper"] = _get_wilson_ci(stats["TN"], n_negatives)
+    stats["AUC"], (stats["AUC 95% CI Lower"], stats["AUC 95% CI Upper"]) = _get_auc(scores[positions], group_gt)
+    return stats
+
+
+def _get_support(stats: dict, metric: str):
+    if metric == "Sen":
+        return stats["P"]
+    if metric == "Spec":
+        return stats["N"]
+    return min(stats["P"], stats["N"])
+
+
+def _get_descendant_bound(stats: dict, metric: str, min_support: int):
+    """Lowest value of the metric that any subgroup of this group with at least `min_support` samples can have"""
+    if metric == "Sen":
+        # At best, all the false negatives of the group fall in a subgroup of the smallest allowed size
+        return max(min_support - stats["FN"], 0) / min_support
+    if metric == "Spec":
+        return max(min_support - stats["FP"], 0) / min_support
+    # AUC has no such bound, so the confidence interval of the group is used as a heuristic
+    return stats["AUC 95% CI Lower"]
+
+
+def find_worst_subgroups(
+    data: pd.DataFrame,
+    y_gt_col: str,
+    y_scores_col: str,
+    strata_cols: list[str],
+    metric: str = "Sen",
+    threshold: float = 0.5,
+    min_support: int = 30,
+    max_depth: int = None,
+    top_k: int = 10,
+    prune: bool = True,
+    show_bars: bool = True,
+    return_df: bool = False,
+):
+    """
+    Searches the intersections of the values of `strata_cols` (e.g. site x scanner x sex) for the subgroups on which
+    the model performs worst.
+
+    The lattice of column combinations is explored breadth first. The rows of every subgroup are taken from its
+    parent's rows, which are kept sorted by score so that AUCs never need a sort. Subgroups with fewer than
+    `min_support` positives (Sen), negatives (Spec) or either (AUC) are not expanded. When `prune` is set, subgroups
+    none of whose descendants can be worse than the current top-K are not expanded either. The bound is exact for Sen
+    and Spec, and the lower bound of the 95% CI for AUC.
+
+    Args:
+        data (pd.DataFrame): Data
+        y_gt_col (str): Binary ground truth column
+        y_scores_col (str): Score column
+        strata_cols (list[str]): Columns whose value combinations define the subgroups
+        metric (str, optional): "Sen", "Spec" or "AUC". Defaults to "Sen".
+        threshold (float, optional): Threshold, in any format accepted by `stratified_analysis`. Defaults to 0.5.
+        min_support (int, optional): Minimum support of a subgroup. Defaults to 30.
+        max_depth (int, optional): Maximum number of columns combined. Defaults to all of them.
+        top_k (int, optional): Number of subgroups returned. Defaults to 10.
+        prune (bool, optional): Whether to prune subgroups that cannot contain a worse subgroup. Defaults to True.
+        show_bars (bool, optional): Whether to show bars in the displayed table. Defaults to True.
+        return_df (bool, optional): Return the table instead of displaying it. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Worst subgroups, indexed by the value of every strata column ("All" where it is unconstrained),
+            if return_df is True
+    """
+    assert metric in ("Sen", "Spec", "AUC"), f"Unknown metric: {metric}"
+    assert min_support > 0, "min_support must be positive"
+    if max_depth is None:
+        max_depth = len(strata_cols)
+
+    cols = [y_gt_col, y_scores_col, *strata_cols]
+    other_cols = list(set(get_thresh_cols(threshold)) - set(cols))
+    missing_cols = check_cols(data, cols + other_cols)
+    if missing_cols:
+        print(f"Missing columns: {missing_cols}")
+        return
+
+    df = preprocess_data(data, [y_gt_col, y_scores_col], strata_cols + other_cols)
+    if len(df) == 0:
+        print(NO_DATA_ERROR, f"({strata_cols})")
+        return
+    df["Pred"] = thresh(df, "Score", threshold)
+
+    gt = df["GT"].to_numpy(dtype=bool)
+    pred = df["Pred"].to_numpy(dtype=bool)
+    scores = df["Score"].to_numpy(dtype=float)
+    codes, uniques = [], []
+    for strata_col in strata_cols:
+        col_codes, col_uniques = pd.factorize(df[strata_col], sort=True)
+        codes.append(col_codes)
+        uniques.append(col_uniques)
+
+    overall = _get_group_stats(np.argsort(scores, kind="stable"), gt, pred, scores)
+    if not return_df:
+        print("-------------------------")
+        print("GT:".ljust(16), y_gt_col)
+        print("Score:".ljust(16), y_scores_col)
+        print("Threshold:".ljust(16), threshold)
+        print(f"Overall {metric}:".ljust(16), f"{overall[metric]:.3f}")
+        print()
+
+    # Max-heap (by negated metric) of the top_k worst subgroups found so far
+    worst = []
+    n_evaluated = 0
+
+    # A subgroup is a tuple of (column index, value code) pairs, and its children constrain columns after its last one
+    level = [((), np.argsort(scores, kind="stable"))]
+    for _ in range(max_depth):
+        next_level = []
+        for subgroup, positions in level:
+            last_col = subgroup[-1][0] if subgroup else -1
+            for col in range(last_col + 1, len(strata_cols)):
+                # Split the parent's rows by the values of the column, keeping them sorted by score
+                col_codes = codes[col][positions]
+                order = np.argsort(col_codes, kind="stable")
+                counts = np.bincount(col_codes[col_codes >= 0], minlength=len(uniques[col]))
+                start = int((col_codes < 0).sum())  # Missing values come first and belong to no subgroup
+                for value, count in enumerate(counts):
+                    child_positions = positions[order[start : start + count]]
+                    start += count
+                    if count == 0:
+                        continue
+
+                    stats = _get_group_stats(child_positions, gt, pred, scores)
+                    n_evaluated += 1
+                    if _get_support(stats, metric) < min_support:
+                        continue
+
+                    child = subgroup + ((col, value),)
+                    if not np.isnan(stats[metric]):
+                        entry = (-stats[metric], stats["Total"], child, stats)
+                        if len(worst) < top_k:
+                            heapq.heappush(worst, entry)
+                        elif stats[metric] < -worst[0][0]:
+                            heapq.heapreplace(worst, entry)
+
+                    if (
+                        prune
+                        and len(worst) == top_k
+                        and _get_descendant_bound(stats, metric, min_support) >= -worst[0][0]
+                    ):
+                        continue
+                    next_level.append((child, child_positions))
+        level = next_level
+
+    if not return_df:
+        print(f"Subgroups evaluated: {n_evaluated}")
+
+    rows = []
+    for _, _, subgroup, stats in sorted(worst, key=lambda entry: (-entry[0], -entry[1])):
+        values = dict.fromkeys(strata_cols, "All")
+        for col, value in subgroup:
+            values[strata_cols[col]] = uniques[col][value]
+        rows.append(values | {"Depth": len(subgroup)} | stats)
+
+    result = pd.DataFrame(rows, columns=[*strata_cols, "Depth", *overall])
+    result = result.set_index(strata_cols)
+
+    if return_df:
+        return result
+    display(style_df(result, show_bars))
+    print("-------------------------")
@@ -1,11 +1,117 @@
 import numpy as np
 import pandas as pd
+from arjcode.analysis.arrow_backend import add_constant_column, get_columns, get_score_histograms, get_threshold_counts
 from arjcode.analysis.constants import NO_DATA_ERROR, TABLE_COLUMNS
-from arjcode.analysis.utils import add_metrics, check_cols, find_nearest, preprocess_data, style_df, thresh
+from arjcode.analysis.preview import get_preview_sample
+from arjcode.analysis.utils import (
+    add_count_metrics,
+    add_metrics,
+    check_cols,
+    find_nearest,
+    preprocess_data,
+    style_df,
+    thresh,
+)
 from IPython.display import display
 from sklearn.metrics import roc_curve
 
 
+def get_thresholds(
+    gt,
+    scores,
+    thresholds_slice: tuple[float],
+    desired_sensitivities_slice: tuple[float],
+    desired_specificities_slice: tuple[float],
+    custom_thresholds: tuple[float],
+    show_only_custom: bool,
+    sample_weight=None,
+):
+    """
+    Returns the distinct thresholds analysed by `threshold_analysis`, in the order they are first chosen. The ROC curve
+    can be computed from a histogram of the scores by passing the count of every (gt, score) pair as `sample_weight`.
+    """
+    thresholds = []
+
+    def _add(threshold):
+        threshold = np.round(threshold, 3)
+        threshold = np.clip(threshold, 0, 1)
+        if threshold not in thresholds:
+            thresholds.append(threshold)
+
+    for threshold in custom_thresholds:
+        _add(threshold)
+
+    if not show_only_custom:
+        for threshold in np.arange(*thresholds_slice):
+            _add(threshold)
+
+        fpr, tpr, roc_thresholds = roc_curve(gt, scores, sample_weight=sample_weight)
+        tnr = 1 - fpr
+
+        for desired_sensitivity in np.arange(*desired_sensitivities_slice):
+            _add(roc_thresholds[find_nearest(tpr, desired_sensitivity)])
+
+        for desired_specificity in np.arange(*desired_specificities_slice):
+            _add(roc_thresholds[find_nearest(tnr, desired_specificity)])
+
+        _add(roc_thresholds[find_nearest(tpr - tnr, 0)])
+
+    return thresholds
+
+
+def _get_threshold_tables(
+    data: pd.DataFrame,
+    cols: list[str],
+    far_thresholds: tuple[float, float],
+    *threshold_args,
+):
+    """Metrics of every stratum at each of its thresholds, as (stratum, frame indexed by threshold) pairs"""
+    strata_cols = cols[2:]
+    df = preprocess_data(data, cols)
+
+    tables = []
+    if len(df) == 0:
+        return tables
+
+    for _names, _df in df.groupby(strata_cols, observed=True):
+        dfs = []
+
+        # P = len(_df[_df["GT"] == 1])
+        # N = len(_df[_df["GT"] == 0])
+
+        def get_threshed_df(x, threshold):
+            x = x.copy()
+            x["Threshold"] = threshold
+            x["Pred"] = thresh(x, "Score", threshold)
+            x["Far FN Pred"] = thresh(x, "Score", far_thresholds[0])
+            x["Far FP Pred"] = thresh(x, "Score", far_thresholds[1])
+            return x
+
+        for threshold in get_thresholds(_df["GT"], _df["Score"], *threshold_args):
+            dfs.append(get_threshed_df(_df, threshold))
+
+        _df = pd.concat(dfs)
+        _df = pd.DataFrame(_df.groupby("Threshold", group_keys=True).apply(add_metrics, include_groups=False))
+        tables.append((_names, _df))
+    return tables
+
+
+def _get_arrow_threshold_tables(data, cols: list[str], far_thresholds: tuple[float, float], *threshold_args):
+    """
+    Same as `_get_threshold_tables`, computed from the score histogram of every stratum: the ROC curve is weighted by
+    the counts of each score and all the thresholds of a stratum are counted with a single binary search
+    """
+    tables = []
+    for _names, (scores, positives, negatives) in get_score_histograms(data, cols).items():
+        gt = np.concatenate([np.ones(len(scores), dtype=int), np.zeros(len(scores), dtype=int)])
+        thresholds = get_thresholds(
+            gt, np.concatenate([scores, scores]), *threshold_args, sample_weight=np.concatenate([positives, negatives])
+        )
+        counts = get_threshold_counts(scores, positives, negatives, thresholds, far_thresholds)
+        tables.append((_names, add_count_metrics(counts)))
+    return tables
+
+
 def threshold_analysis(
     data: pd.DataFrame,
     y_gt_col: str,
@@ -21,103 +127,75 @@ def threshold_analysis(
     table_columns: list[str] = TABLE_COLUMNS,
     show_bars: bool = True,
     pm_mode: bool = False,
+    preview_ci_width: float = None,
+    return_df: bool = False,
 ):
     if pm_mode:
         custom_thresholds = np.linspace(0, 1, 101, endpoint=True)
         show_only_custom = True
         table_columns = ["TP", "FN", "FP", "TN", "Sen", "Spec"]
 
-    print("-------------------------")
-    print("GT:".ljust(16), y_gt_col, f"({y_gt_desc})")
-    print("Score:".ljust(16), y_scores_col)
-    print()
+    if not return_df:
+        print("-------------------------")
+        print("GT:".ljust(16), y_gt_col, f"({y_gt_desc})")
+        print("Score:".ljust(16), y_scores_col)
+        print()
 
     cols = [y_gt_col, y_scores_col, *strata_cols]
-    missing_cols = check_cols(data, cols)
+    if isinstance(data, pd.DataFrame):
+        missing_cols = check_cols(data, cols)
+    else:
+        # Arrow tables, polars frames and parquet files are aggregated by the multi-threaded Arrow backend
+        missing_cols = [col for col in cols if col not in get_columns(data)]
     if len(missing_cols):
         print(f"Missing columns: {missing_cols}")
     else:
         if not strata_cols:
-            data = data.copy()
-            data["Data"] = "All"
+            if isinstance(data, pd.DataFrame):
+                data = data.copy()
+                data["Data"] = "All"
+            else:
+                data = add_constant_column(data, "Data", "All")
             strata_cols = ["Data"]
             cols += strata_cols
 
-        df = preprocess_data(data, cols)
-
-        if len(df) == 0:
+        if preview_ci_width is not None:
+            # Approximate metrics on a stratified sample, see `preview_analysis`
+            assert isinstance(data, pd.DataFrame), "Previews are only supported for pandas data"
+            n_rows = len(data)
+            data = get_preview_sample(data, y_gt_col, y_scores_col, strata_cols, target_ci_width=preview_ci_width)
+            if not return_df:
+                print(f"Preview on {len(data)} of {n_rows} rows")
+
+        get_tables = _get_threshold_tables if isinstance(data, pd.DataFrame) else _get_arrow_threshold_tables
+        tables = get_tables(
+            data,
+            cols,
+            far_thresholds,
+            thresholds_slice,
+            desired_sensitivities_slice,
+            desired_specificities_slice,
+            custom_thresholds,
+            show_only_custom,
+        )
+
+        if len(tables) == 0:
             print(NO_DATA_ERROR)
         else:
             final_df = []
-            for _names, _df in df.groupby(strata_cols):
-                dfs = []
-
-                # P = len(_df[_df["GT"] == 1])
-                # N = len(_df[_df["GT"] == 0])
-
-                def get_threshed_df(x, threshold):
-                    x = x.copy()
-                    x["Threshold"] = threshold
-                    x["Pred"] = thresh(x, "Score", threshold)
-                    x["Far FN Pred"] = thresh(x, "Score", far_thresholds[0])
-                    x["Far FP Pred"] = thresh(x, "Score", far_thresholds[1])
-                    return x
-
-                thresholds = set()
-
-                for threshold in custom_thresholds:
-                    threshold = np.round(threshold, 3)
-                    threshold = np.clip(threshold, 0, 1)
-                    if threshold not in thresholds:
-                        thresholds.add(threshold)
-                        dfs.append(get_threshed_df(_df, threshold))
-
-                if not show_only_custom:
-                    for threshold in np.arange(*thresholds_slice):
-                        threshold = np.round(threshold, 3)
-                        threshold = np.clip(threshold, 0, 1)
-                        if threshold not in thresholds:
-                            thresholds.add(threshold)
-                            dfs.append(get_threshed_df(_df, threshold))
-
-                    fpr, tpr, roc_thresholds = roc_curve(_df["GT"], _df["Score"])
-                    tnr = 1 - fpr
-
-                    for desired_sensitivity in np.arange(*desired_sensitivities_slice):
-                        threshold = roc_thresholds[find_nearest(tpr, desired_sensitivity)]
-                        threshold = np.round(threshold, 3)
-                        threshold = np.clip(threshold, 0, 1)
-                        if threshold not in thresholds:
-                            thresholds.add(threshold)
-                            dfs.append(get_threshed_df(_df, threshold))
-
-                    for desired_specificity in np.arange(*desired_specificities_slice):
-                        threshold = roc_thresholds[find_nearest(tnr, desired_specificity)]
-                        threshold = np.round(threshold, 3)
-                        threshold = np.clip(threshold, 0, 1)
-                        if threshold not in thresholds:
-                            thresholds.add(threshold)
-                            dfs.append(get_threshed_df(_df, threshold))
-
-                    if True:
-                        threshold = roc_thresholds[find_nearest(tpr - tnr, 0)]
-                        threshold = np.round(threshold, 3)
-                        threshold = np.clip(threshold, 0, 1)
-                        if threshold not in thresholds:
-                            thresholds.add(threshold)
-                            dfs.append(get_threshed_df(_df, threshold))
-
-                _df = pd.concat(dfs)
-                _df = pd.DataFrame(_df.groupby("Threshold", group_keys=True).apply(add_metrics, include_groups=False))
+            for _names, _df in tables:
                 _df = _df.groupby("Threshold").agg({colname: "max" for colname in table_columns})
                 _df = _df.sort_index()
-                _names = [_names] if not isinstance(_names, list) else _names
+                _names = list(_names) if isinstance(_names, tuple) else [_names]
                 _df.index = pd.MultiIndex.from_tuples(
                     [(*_names, threshold) for threshold in _df.index], names=[*strata_cols, _df.index.name]
                 )
                 final_df.append(_df)
 
             final_df = pd.concat(final_df)
+            if return_df:
+                return final_df
             final_df = style_df(final_df, show_bars)
             display(final_df)
-    print("-------------------------")
+    if not return_df:
+        print("-------------------------")
@@ -1,10 +1,10 @@
-import itertools
-
 import numpy as np
 import pandas as pd
 from confidenceinterval import roc_auc_score as ci_roc_auc_score
 from confidenceinterval import tnr_score, tpr_score
+from scipy.stats import norm
 from sklearn.metrics import roc_auc_score as sk_roc_auc_score
+from statsmodels.stats.proportion import proportion_confint
 
 
 def thresh(df: pd.DataFrame, scores_col: str, thresholds: list, strict: bool = True):
@@ -71,16 +71,48 @@ def get_uncertain(scores: pd.Series, thresholds: tuple[float, float]):
     return uncertain
 
 
-def get_truth_table(seriess: dict[str, pd.Series]):
-    df = pd.DataFrame(data=seriess).value_counts()
-
-    for truth in itertools.product([0, 1], repeat=len(seriess)):
-        if truth not in df.index:
-            df = pd.concat([df, pd.Series({truth: 0})])
-
-    df = df.sort_index()
-
-    return df
+def _get_binary_matrix(seriess: dict[str, pd.Series]):
+    df = pd.DataFrame(data=seriess).dropna()
+    bits = df.to_numpy()
+    assert np.isin(bits, (0, 1)).all(), "Truth tables can only be built from binary data"
+    return bits.astype(np.uint8)
+
+
+def get_truth_table(seriess: dict[str, pd.Series], max_dense_cols: int = 20):
+    """
+    Counts the rows with every combination of values of binary series. Each row is packed into an integer code and all
+    combinations are counted with a single bincount. Beyond `max_dense_cols` series, only the combinations that occur
+    are returned (see `get_agreement_summary` for a compact summary of many series).
+    """
+    names = list(seriess)
+    bits = _get_binary_matrix(seriess)
+    n = len(names)
+
+    if n <= max_dense_cols:
+        codes = bits @ (1 << np.arange(n - 1, -1, -1, dtype=np.int64))
+        counts = np.bincount(codes, minlength=2**n)
+        index = pd.MultiIndex.from_product([[0, 1]] * n, names=names)
+        return pd.Series(counts, index=index, name="count")
+
+    # Rows packed into bytes sort in the same order as their combinations
+    combinations, counts = np.unique(np.packbits(bits, axis=1), axis=0, return_counts=True)
+    combinations = np.unpackbits(combinations, axis=1, count=n)
+    index = pd.MultiIndex.from_arrays(list(combinations.T.astype(int)), names=names)
+    return pd.Series(counts, index=index, name="count")
+
+
+def get_agreement_summary(seriess: dict[str, pd.Series]):
+    """
+    Returns the fraction of positives of every binary series, and the fraction of rows on which every pair of series
+    agrees, in O(n^2) memory irrespective of the number of combinations
+    """
+    names = list(seriess)
+    bits = _get_binary_matrix(seriess).astype(np.float64)
+    both_positive = bits.T @ bits
+    both_negative = (1 - bits).T @ (1 - bits)
+    marginals = pd.Series(bits.mean(axis=0), index=names)
+    agreement = pd.DataFrame((both_positive + both_negative) / len(bits), index=names, columns=names)
+    return marginals, agreement
 
 
 def drop_na(df: pd.DataFrame, cols: list[str] = None, drop_method: str = "any"):
@@ -90,18 +122,72 @@ def drop_na(df: pd.DataFrame, cols: list[str] = None, drop_method: str = "any"):
     return dropped_df
 
 
-def preprocess_data(data: pd.DataFrame, cols: list[str], other_cols: list[str] = [], drop_method: str = "any"):
-    df = data[cols + other_cols]
-    df = drop_na(df, cols, drop_method)
-    df = df.rename(
-        columns={
-            cols[0]: "GT",
-            cols[1]: "Score",
-        }
-    )
-    df = df.astype({"GT": int})
+def get_valid_mask(data: pd.DataFrame, cols: list[str], drop_method: str = "any"):
+    """Boolean mask of the rows that are not missing any (or all, as per `drop_method`) of `cols`"""
+    assert drop_method in ("any", "all"), f"Unknown drop method: {drop_method}"
+    valid = np.ones(len(data), dtype=bool) if drop_method == "any" else np.zeros(len(data), dtype=bool)
+    for col in cols:
+        notna = data[col].notna().to_numpy()
+        valid = valid & notna if drop_method == "any" else valid | notna
+    return valid
 
-    return df
+
+def _gather(series: pd.Series, positions: np.ndarray, index: pd.Index, compact: bool):
+    if compact and (series.dtype == object or pd.api.types.is_string_dtype(series.dtype)):
+        try:
+            # Factorizing the whole column and gathering the codes uses far less memory than gathering the strings
+            codes, categories = pd.factorize(series, sort=True)
+        except TypeError:
+            # Unhashable values such as the lists of unpacked strata columns
+            pass
+        else:
+            codes = codes.astype(np.int8 if len(categories) < 2**7 else np.int32)
+            if positions is not None:
+                codes = codes[positions]
+            return pd.Series(pd.Categorical.from_codes(codes, categories), index=index, name=series.name)
+    if positions is None:
+        return series
+    return pd.Series(series.array.take(positions), index=index, name=series.name)
+
+
+def preprocess_data(
+    data: pd.DataFrame, cols: list[str], other_cols: list[str] = [], drop_method: str = "any", compact: bool = True
+):
+    """
+    Returns the valid rows (see `get_valid_mask`) of `cols` and `other_cols`, with the first two of `cols` renamed to
+    GT and Score. Every column is gathered once through the validity mask instead of copying the frame to select the
+    columns and again to drop rows. With `compact`, GT is stored as int8, Score as float32 and string columns as
+    categoricals, which cuts the memory used by analyses of large frames severalfold.
+    """
+    valid = get_valid_mask(data, cols, drop_method)
+    positions = None if valid.all() else np.flatnonzero(valid)
+    index = data.index if positions is None else data.index[positions]
+
+    columns = {}
+    for col in dict.fromkeys(cols + other_cols):
+        if col == cols[0]:
+            columns["GT"] = _gather(data[col], positions, index, False).astype(np.int8 if compact else int)
+        elif col == cols[1]:
+            scores = data[col]
+            if compact:
+                scores = scores.astype(np.float32)
+            columns["Score"] = _gather(scores, positions, index, False)
+        else:
+            columns[col] = _gather(data[col], positions, index, compact)
+
+    return pd.DataFrame(columns, index=index, copy=False)
+
+
+def restore_index_dtypes(index: pd.Index):
+    """Converts the categorical levels of an index, e.g. after grouping by strata compacted by `preprocess_data`, back
+    to the dtypes of their categories"""
+
+    def restore(level):
+        return level.astype(level.categories.dtype) if isinstance(level, pd.CategoricalIndex) else level
+
+    if isinstance(index, pd.MultiIndex):
+        return index.set_levels([restore(level) for level in index.levels])
+    return restore(index)
 
 
 def add_metrics(df: pd.DataFrame, uncertainty_ranges: list = [], uncertainty_colnames: list = []):
@@ -112,8 +198,12 @@ def add_metrics(df: pd.DataFrame, uncertainty_ranges: list = [], uncertainty_col
     for i in range(len(uncertainty_ranges)):
         df[f"Uncertain{i}"] = df[f"Uncertain{i}"].astype(bool)
 
-    n_positives = df["GT"].sum()
-    n_negatives = (~df["GT"]).sum()
+    # Counts are taken on the boolean arrays directly, without materializing filtered frames
+    gt = df["GT"].to_numpy()
+    pred = df["Pred"].to_numpy()
+
+    n_positives = np.count_nonzero(gt)
+    n_negatives = len(gt) - n_positives
     has_both_classes = n_positives > 0 and n_negatives > 0
 
     if has_both_classes:
@@ -142,14 +232,14 @@ def add_metrics(df: pd.DataFrame, uncertainty_ranges: list = [], uncertainty_col
         spec_ci = (np.nan, np.nan)
 
     df["Total"] = len(df)
-    df["P"] = len(df[df["GT"]])
-    df["N"] = len(df[~df["GT"]])
-    df["PP"] = len(df[df["Pred"]])
-    df["PN"] = len(df[~df["Pred"]])
-    df["TP"] = len(df[df["GT"] & df["Pred"]])
-    df["FP"] = len(df[~df["GT"] & df["Pred"]])
-    df["FN"] = len(df[df["GT"] & ~df["Pred"]])
-    df["TN"] = len(df[~df["GT"] & ~df["Pred"]])
+    df["P"] = n_positives
+    df["N"] = n_negatives
+    df["PP"] = np.count_nonzero(pred)
+    df["PN"] = len(pred) - np.count_nonzero(pred)
+    df["TP"] = np.count_nonzero(gt & pred)
+    df["FP"] = np.count_nonzero(~gt & pred)
+    df["FN"] = np.count_nonzero(gt & ~pred)
+    df["TN"] = np.count_nonzero(~gt & ~pred)
     df["Sen"] = sen
     df["Sen 95% CI Lower"] = sen_ci[0]
     df["Sen 95% CI Upper"] = sen_ci[1]
@@ -170,10 +260,10 @@ def add_metrics(df: pd.DataFrame, uncertainty_ranges: list = [], uncertainty_col
             df["AUC"] = np.nan
             df["AUC 95% CI Lower"] = np.nan
             df["AUC 95% CI Upper"] = np.nan
-        df["Far FN"] = len(df[df["GT"] & ~df["Pred"] & ~df["Far FN Pred"]])
-        df["Far FP"] = len(df[~df["GT"] & df["Pred"] & df["Far FP Pred"]])
+        df["Far FN"] = np.count_nonzero(gt & ~pred & ~df["Far FN Pred"].to_numpy())
+        df["Far FP"] = np.count_nonzero(~gt & pred & df["Far FP Pred"].to_numpy())
         for i, uncertainty_colname in enumerate(uncertainty_colnames):
-            df[uncertainty_colname] = len(df[df[f"Uncertain{i}"]])
+            df[uncertainty_colname] = np.count_nonzero(df[f"Uncertain{i}"].to_numpy())
     else:
         df["AUC"] = np.nan
         df["Far FN"] = np.nan
@@ -183,6 +273,100 @@ def add_metrics(df: pd.DataFrame, uncertainty_ranges: list = [], uncertainty_col
     return df
 
 
+def get_histogram_aucs(blocks: np.ndarray, positives: np.ndarray, negatives: np.ndarray, n_blocks: int):
+    """
+    AUCs and DeLong 95% CIs, as computed by confidenceinterval, of several blocks of datapoints at once, from the number
+    of positives and negatives at every distinct score of every block. `blocks` must be sorted and the scores increasing
+    within each block. The placement values of DeLong's method are the same for all the datapoints with a score, so
+    their variances are taken over the distinct scores weighted by the counts.
+
+    Returns:
+        tuple[np.ndarray]: AUC, CI lower bound, CI upper bound and number of distinct scores of every block
+    """
+    n_positives = np.bincount(blocks, weights=positives, minlength=n_blocks)
+    n_negatives = np.bincount(blocks, weights=negatives, minlength=n_blocks)
+    n_unique = np.bincount(blocks, minlength=n_blocks)
+
+    # Negatives below each positive and positives below each negative within its block, with ties counted as half
+    negatives_below = np.cumsum(negatives) - negatives / 2 - (np.cumsum(n_negatives) - n_negatives)[blocks]
+    positives_below = np.cumsum(positives) - positives / 2 - (np.cumsum(n_positives) - n_positives)[blocks]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        v01 = negatives_below / n_negatives[blocks]
+        v10 = 1 - positives_below / n_positives[blocks]
+        aucs = np.bincount(blocks, weights=positives * v01, minlength=n_blocks) / n_positives
+        # Unbiased variances, as np.cov
+        v01_var = np.bincount(blocks, weights=positives * (v01 - aucs[blocks]) ** 2, minlength=n_blocks)
+        v10_var = np.bincount(blocks, weights=negatives * (v10 - aucs[blocks]) ** 2, minlength=n_blocks)
+        variances = v01_var / (n_positives - 1) / n_positives + v10_var / (n_negatives - 1) / n_negatives
+        half_widths = norm.ppf(0.975) * np.sqrt(variances)
+
+    has_both_classes = (n_positives > 0) & (n_negatives > 0)
+    aucs = np.where(has_both_classes, aucs, np.nan)
+    half_widths = np.where(has_both_classes, half_widths, np.nan)
+    return aucs, aucs - half_widths, aucs + half_widths, n_unique
+
+
+def get_block_aucs(blocks: np.ndarray, scores: np.ndarray, gt: np.ndarray, n_blocks: int):
+    """
+    `get_histogram_aucs` of the datapoints of several blocks. The block, float32 score and GT of every datapoint are
+    packed into a single integer which sorts in the same order, so all the blocks are sorted at once by a plain sort of
+    integers instead of a lexsort.
+    """
+    # Flipping the sign bit of positive floats and all the bits of negative floats makes their bits sort as they do
+    score_bits = (np.asarray(scores, dtype=np.float32) + np.float32(0)).view(np.uint32).astype(np.uint64)
+    score_bits ^= np.where(score_bits >> 31, np.uint64(0xFFFFFFFF), np.uint64(0x80000000))
+    keys = (np.asarray(blocks, dtype=np.uint64) << np.uint64(33)) | (score_bits << np.uint64(1)) | gt.astype(np.uint64)
+    keys.sort()
+
+    # Datapoints with the same block and score differ at most in the GT bit
+    score_keys = keys >> np.uint64(1)
+    is_new_score = np.ones(len(keys), dtype=bool)
+    is_new_score[1:] = score_keys[1:] != score_keys[:-1]
+    score_ids = np.cumsum(is_new_score) - 1
+    positives = np.bincount(score_ids, weights=keys & np.uint64(1))
+    negatives = np.bincount(score_ids) - positives
+    blocks = (keys[is_new_score] >> np.uint64(33)).astype(np.int64)
+    return get_histogram_aucs(blocks, positives, negatives, n_blocks)
+
+
+def _get_proportion_ci(successes: pd.Series, totals: pd.Series):
+    lower, upper = proportion_confint(successes, totals.clip(lower=1), alpha=0.05, method="wilson")
+    return lower.where(totals > 0), upper.where(totals > 0)
+
+
+def add_count_metrics(df: pd.DataFrame, uncertainty_colnames: list = []):
+    """
+    Computes the columns of `add_metrics` from the counts of every row of `df`, which must contain Total, P, PP and TP.
+    If `df` contains the number of distinct scores (Unique), its AUC, far error and uncertainty columns are blanked out
+    where the scores are not continuous.
+    """
+    df["N"] = df["Total"] - df["P"]
+    df["PN"] = df["Total"] - df["PP"]
+    df["FP"] = df["PP"] - df["TP"]
+    df["FN"] = df["P"] - df["TP"]
+    df["TN"] = df["N"] - df["FP"]
+
+    # Sen and Spec are computed as in confidenceinterval
+    df["Sen"] = (df["TP"] / (df["TP"] + df["FN"] + 1e-7)).where(df["P"] > 0)
+    df["Sen 95% CI Lower"], df["Sen 95% CI Upper"] = _get_proportion_ci(df["TP"], df["P"])
+    df["Spec"] = (df["TN"] / (df["TN"] + df["FP"] + 1e-7)).where(df["N"] > 0)
+    df["Spec 95% CI Lower"], df["Spec 95% CI Upper"] = _get_proportion_ci(df["TN"], df["N"])
+    df["Youden"] = df["Sen"] + df["Spec"] - 1
+    df["PPV"] = df["TP"] / df["PP"]
+    df["NPV"] = df["TN"] / df["PN"]
+    df["F1"] = (2 * df["TP"]) / (2 * df["TP"] + df["FP"] + df["FN"])
+    df["Acc"] = (df["TP"] + df["TN"]) / (df["Total"])
+
+    if "Unique" in df.columns:
+        # Like `add_metrics`, the AUC and far errors are only reported for continuous scores
+        continuous = df["Unique"] > 5
+        for colname in ["AUC", "AUC 95% CI Lower", "AUC 95% CI Upper", "Far FN", "Far FP", *uncertainty_colnames]:
+            if colname in df.columns:
+                df[colname] = df[colname].where(continuous)
+    return df
+
+
 def style_df(df: pd.DataFrame, show_bars: bool = True):
     known_colnames = [
         "Total",
@@ -1,4 +1,15 @@
-from .environment import set_multi_node_environment
+from .environment import get_rank_weights, set_multi_node_environment
 from .my_lightning_module import MyLightningModule
-from .parameters import freeze_module, freeze_modules, unfreeze_module, unfreeze_modules
+from .parameters import (
+    freeze_matching,
+    freeze_module,
+    freeze_modules,
+    get_matching_modules,
+    measure_saved_activations,
+    unfreeze_matching,
+    unfreeze_module,
+    unfreeze_modules,
+)
 from .profiler import profile
+from .sampler import RankWeightedDistributedSampler, get_accumulate_grad_batches
+from .unused_parameters import UnusedParameterTracker
@@ -53,3 +53,23 @@ def set_multi_node_environment(nodes, port=10051):
         "devices": devices,
         "cluster_environment": MyClusterEnvironment(),
     }
+
+
+def get_rank_weights(nodes, step_times=None):
+    """
+    Returns the relative throughput of every global rank in the order set by `set_multi_node_environment`.
+    nodes should be of the same form as in `set_multi_node_environment`.
+    step_times (optional) should be of the form {node_name: seconds_per_step, ...} as measured on a single device of
+    each node with the same batch size. If not provided, every device is assumed to be equally fast.
+    """
+    if step_times is not None:
+        missing_nodes = [node for node, _ in nodes if node not in step_times]
+        assert not missing_nodes, f"Step times missing for nodes: {missing_nodes}"
+
+    rank_weights = []
+    for node, node_info in nodes:
+        weight = 1.0 if step_times is None else 1 / step_times[node]
+        rank_weights.extend([weight] * node_info[1])
+
+    total = sum(rank_weights)
+    return [weight / total for weight in rank_weights]
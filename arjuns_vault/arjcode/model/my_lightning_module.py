@@ -1,11 +1,16 @@
 import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import lightning as L
+import pandas as pd
 import torch
 from prettytable import PrettyTable
 from torch import nn
 
+from .unused_parameters import UnusedParameterTracker
+
 
 class MyLightningModule(L.LightningModule):
     def __init__(
@@ -17,6 +22,8 @@ class MyLightningModule(L.LightningModule):
         small_normalized_gradient_norm_threshold: float = 1e-2,
         large_normalized_gradient_norm_threshold: float = 1e2,
         identify_unused_parameters: bool = False,
+        rarely_used_parameters_threshold: float = 0.1,
+        metrics_history_dir: str = None,
     ):
         super().__init__()
         self.log_gradients_before_clipping = log_gradients_before_clipping
@@ -26,6 +33,15 @@ class MyLightningModule(L.LightningModule):
         self.small_normalized_gradient_norm_threshold = small_normalized_gradient_norm_threshold
         self.large_normalized_gradient_norm_threshold = large_normalized_gradient_norm_threshold
         self.identify_unused_parameters = identify_unused_parameters
+        self.rarely_used_parameters_threshold = rarely_used_parameters_threshold
+        self.metrics_history_dir = metrics_history_dir
+
+        # Formatting and writing of the epoch metrics happens off the training loop
+        self._print_log_executor = None
+        self._print_log_future = None
+
+        self._unused_parameter_tracker = None
+        self._unused_parameter_tracker_epoch = None
 
     def get_steps_per_epoch(self):
         return self.trainer.estimated_stepping_batches * self.trainer.accumulate_grad_batches // self.trainer.max_epochs
@@ -83,10 +99,34 @@ class MyLightningModule(L.LightningModule):
         print("Identify NaN and Inf hook registered")
 
     def print_log(self):
-        """Should be called at the end of every epoch to print a table of all metrics that were logged"""
+        """Should be called at the end of every epoch (on all ranks) to print a table of all metrics that were logged.
+        Values are gathered from all ranks in one collective and their mean/min/max across ranks are shown. If
+        `metrics_history_dir` is set, the table is also saved as one parquet file per epoch in that directory."""
+        metrics = self.trainer.logged_metrics
+        keys = sorted(metrics)
+        if not keys:
+            return
+
+        # Stack all metrics so that there is a single collective and a single device to host copy
+        values = torch.stack([torch.as_tensor(metrics[key], device=self.device).float().reshape(()) for key in keys])
+        # all_gather only adds the rank dimension with more than one process, this gives (world size, n) in all cases
+        values = self.all_gather(values).reshape(self.trainer.world_size, -1).cpu()
+
         if self.global_rank != 0:
             return
 
+        stats = torch.stack([values.mean(0), values.min(0).values, values.max(0).values], dim=1).tolist()
+
+        if self._print_log_executor is None:
+            self._print_log_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="print_log")
+        if self._print_log_future is not None:
+            # Surface any error from the previous epoch
+            self._print_log_future.result()
+        self._print_log_future = self._print_log_executor.submit(
+            self._write_log, self.current_epoch, keys, stats, self.trainer.world_size
+        )
+
+    def _write_log(self, epoch, keys, stats, world_size):
         def split_key(key):
             """Ensures that only a 2-tuple is returned"""
             if "/" not in key:
@@ -97,32 +137,79 @@ class MyLightningModule(L.LightningModule):
                 splitted[1] = splitted[-1]
             return tuple(splitted[:2])
 
-        numbers = self.trainer.logged_metrics
-        numbers = list(numbers.items())
-        for i, (key, value) in enumerate(numbers):
-            value = round(float(value), 5)
-            key = split_key(key)
-            numbers[i] = key + (value,)
-        numbers = sorted(numbers)
+        numbers = sorted(split_key(key) + tuple(values) for key, values in zip(keys, stats))
 
-        print()
-        print()
-        print(f"Epoch = {self.current_epoch:<4}")
-        table = PrettyTable(["Header", "Metric", "Value"])
-        table.add_rows(numbers)
-        print(table)
-        print()
+        if world_size == 1:
+            columns = ["Header", "Metric", "Value"]
+            rows = [(*number[:2], round(number[2], 5)) for number in numbers]
+        else:
+            columns = ["Header", "Metric", "Mean", "Min", "Max"]
+            rows = [(*number[:2], *[round(value, 5) for value in number[2:]]) for number in numbers]
+
+        table = PrettyTable(columns)
+        table.add_rows(rows)
+        print(f"\n\nEpoch = {epoch:<4}\n{table}\n")
+
+        if self.metrics_history_dir is not None:
+            os.makedirs(self.metrics_history_dir, exist_ok=True)
+            history = pd.DataFrame(numbers, columns=["Header", "Metric", "Mean", "Min", "Max"])
+            history.insert(0, "Epoch", epoch)
+            history.to_parquet(os.path.join(self.metrics_history_dir, f"epoch_{epoch:05d}.parquet"), index=False)
 
-    def on_before_zero_grad(self, optimizer):
-        """Should be run to identify all unused parameters in case of "unused parameters" error.
-        Use with ddp_identify_unused_parameters_true"""
-        if self.identify_unused_parameters:
-            if self.global_rank == 0 and self.trainer.global_step > 0:  # Don't run on first step
-                print("Zero grad params")
-                for name, param in self.named_parameters():
-                    if param.requires_grad and param.grad is None:
-                        print(name)
-                print()
+    def on_before_backward(self, loss):
+        """Tracks parameters that do not receive gradients and reports them once per epoch. Use to identify unused
+        parameters in case of "unused parameters" error (with ddp_find_unused_parameters_true), or to check whether
+        unused parameter detection can be turned off in DDP."""
+        if not self.identify_unused_parameters:
+            return
+
+        if self._unused_parameter_tracker is None:
+            self._unused_parameter_tracker = UnusedParameterTracker(self, self.rarely_used_parameters_threshold)
+        elif self._unused_parameter_tracker_epoch != self.current_epoch:
+            self.report_unused_parameters()
+        self._unused_parameter_tracker_epoch = self.current_epoch
+        self._unused_parameter_tracker.step()
+
+    def _close_print_log(self):
+        """Waits for the metrics of the last epoch to be written, surfacing any error, and stops the writer thread"""
+        if self._print_log_executor is None:
+            return
+        future, self._print_log_future = self._print_log_future, None
+        self._print_log_executor.shutdown(wait=True)
+        self._print_log_executor = None
+        if future is not None:
+            future.result()
+
+    def teardown(self, stage):
+        self._close_print_log()
+
+    def on_train_end(self):
+        self._close_print_log()
+        if self._unused_parameter_tracker is not None:
+            self.report_unused_parameters()
+            self._unused_parameter_tracker.remove()
+            self._unused_parameter_tracker = None
+
+    def report_unused_parameters(self):
+        """Should be called on all ranks. Prints the parameters that were never or rarely used since the last report"""
+        tracker = self._unused_parameter_tracker
+        counts = self.trainer.strategy.reduce(tracker.get_counts().to(self.device), reduce_op="sum")
+        tracker.reset()
+
+        if self.global_rank != 0:
+            return
+
+        counts = counts.cpu()
+        never_used, rarely_used = tracker.summarize(counts)
+        print(f"Unused parameters (epoch {self._unused_parameter_tracker_epoch})")
+        print(f"Never used ({len(never_used)}):")
+        for name in never_used:
+            print(name)
+        print(f"Rarely used ({len(rarely_used)}):")
+        for name, fraction in rarely_used.items():
+            print(f"{name.ljust(50)} -- used in {fraction:.1%} of backward passes")
+        print(f"Suggested DDPStrategy kwargs: {tracker.suggest_ddp_config(counts)}")
+        print()
 
     def configure_gradient_clipping(self, *args, **kwargs):
         if self.log_gradients_before_clipping:
@@ -1,3 +1,9 @@
+import re
+import weakref
+from fnmatch import fnmatchcase
+from functools import partial
+
+import torch
 from torch import nn
 
 
@@ -13,12 +19,216 @@ def freeze_modules(modules: list[nn.Module]):
 
 
 def unfreeze_module(module: nn.Module):
-    module.train()
     for param in module.parameters():
         param.requires_grad = True
-    module.eval()
+    module.train()
 
 
 def unfreeze_modules(modules: list[nn.Module]):
     for module in modules:
         unfreeze_module(module)
+
+
+def get_matching_modules(model: nn.Module, patterns: list[str], regex: bool = False):
+    """
+    Returns the outermost modules of `model` whose names match any of the patterns. Submodules of a matched module are
+    not returned separately.
+
+    Args:
+        model (nn.Module): Model whose `named_modules` are searched
+        patterns (list[str]): Glob patterns (e.g. "encoder.layers.[0-3]*") or regexes if `regex` is True
+        regex (bool, optional): Treat patterns as regexes (matched with `re.fullmatch`). Defaults to False.
+
+    Returns:
+        dict[str, nn.Module]: Matched modules keyed by name
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+
+    if regex:
+        compiled = [re.compile(pattern) for pattern in patterns]
+
+        def is_match(name):
+            return any(pattern.fullmatch(name) for pattern in compiled)
+
+    else:
+
+        def is_match(name):
+            return any(fnmatchcase(name, pattern) for pattern in patterns)
+
+    matched = {}
+    for name, module in model.named_modules():
+        if any(prefix == "" or name.startswith(f"{prefix}.") for prefix in matched):
+            continue
+        if is_match(name):
+            matched[name] = module
+    return matched
+
+
+def measure_saved_activations(model: nn.Module, *model_args, **model_kwargs):
+    """
+    Runs a forward pass and returns the number of bytes of the tensors autograd saves for the backward pass. The
+    buffers of the model (e.g. BatchNorm running statistics) and the RNG states are restored afterwards, so the
+    measurement does not affect training.
+    """
+    saved_bytes = 0
+    seen = set()
+
+    def pack(tensor):
+        nonlocal saved_bytes
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in seen:
+            seen.add(storage.data_ptr())
+            saved_bytes += storage.nbytes()
+        return tensor
+
+    buffers = {name: buffer.clone() for name, buffer in model.named_buffers()}
+    cuda_devices = sorted({param.device.index or 0 for param in model.parameters() if param.device.type == "cuda"})
+    try:
+        with torch.random.fork_rng(devices=cuda_devices):
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                model(*model_args, **model_kwargs)
+    finally:
+        with torch.no_grad():
+            for name, buffer in model.named_buffers():
+                buffer.copy_(buffers[name])
+    return saved_bytes
+
+
+# Handles of the forward hooks of the modules frozen with a grad_mode
+_grad_mode_hooks = weakref.WeakKeyDictionary()
+
+
+def _enter_grad_mode(module, args, kwargs, context, contexts):
+    # A frozen module in the middle of the graph must still pass gradients through to earlier trainable modules
+    inputs = [*args, *kwargs.values()]
+    if any(isinstance(x, torch.Tensor) and x.requires_grad for x in inputs):
+        contexts.append(None)
+    else:
+        contexts.append(context())
+        contexts[-1].__enter__()
+
+
+def _exit_grad_mode(module, args, kwargs, output, contexts):
+    context = contexts.pop()
+    if context is not None:
+        context.__exit__(None, None, None)
+
+
+def _register_grad_mode_hooks(module: nn.Module, grad_mode: str):
+    if module in _grad_mode_hooks:
+        return
+    context = torch.inference_mode if grad_mode == "inference_mode" else torch.no_grad
+    # Stack of the contexts entered, as a module can be called again within its own forward
+    contexts = []
+    _grad_mode_hooks[module] = (
+        module.register_forward_pre_hook(
+            partial(_enter_grad_mode, context=context, contexts=contexts), with_kwargs=True
+        ),
+        module.register_forward_hook(partial(_exit_grad_mode, contexts=contexts), with_kwargs=True, always_call=True),
+    )
+
+
+def _remove_grad_mode_hooks(module: nn.Module):
+    for handle in _grad_mode_hooks.pop(module, ()):
+        handle.remove()
+
+
+def freeze_matching(
+    model: nn.Module,
+    patterns: list[str],
+    regex: bool = False,
+    optimizer: torch.optim.Optimizer = None,
+    dtype: torch.dtype = None,
+    grad_mode: str = None,
+    sample_inputs: tuple = None,
+    verbose: bool = True,
+):
+    """
+    Freezes all modules whose names match any of the patterns and frees the memory they no longer need
+
+    Args:
+        model (nn.Module): Model to freeze modules of
+        patterns (list[str]): Glob patterns (or regexes if `regex` is True) over `model.named_modules()`
+        regex (bool, optional): Treat patterns as regexes. Defaults to False.
+        optimizer (torch.optim.Optimizer, optional): If given, the optimizer state of the frozen parameters is dropped.
+            Defaults to None.
+        dtype (torch.dtype, optional): If given, frozen weights and buffers are cast to this (lower-precision) dtype.
+            The model should then be run under autocast. Defaults to None.
+        grad_mode (str, optional): "no_grad" or "inference_mode" to run the forward of frozen modules without
+            recording the graph whenever their inputs do not require grad. Outputs produced under "inference_mode"
+            cannot be saved for backward by trainable modules downstream, so prefer "no_grad" unless the frozen modules
+            are not followed by trainable ones. Defaults to None.
+        sample_inputs (tuple, optional): Inputs to `model` used to measure the activation memory saved.
+            Defaults to None.
+        verbose (bool, optional): Print the memory saved. Defaults to True.
+
+    Returns:
+        dict: Names of the frozen modules and the number of bytes saved
+    """
+    assert grad_mode in (None, "no_grad", "inference_mode"), f"Invalid grad_mode: {grad_mode}"
+
+    if sample_inputs is not None:
+        activation_bytes_before = measure_saved_activations(model, *sample_inputs)
+
+    modules = get_matching_modules(model, patterns, regex)
+    params = {param for module in modules.values() for param in module.parameters()}
+
+    for param in params:
+        param.grad = None
+
+    optimizer_state_bytes = 0
+    if optimizer is not None:
+        for param in params:
+            state = optimizer.state.pop(param, {})
+            optimizer_state_bytes += sum(value.nbytes for value in state.values() if isinstance(value, torch.Tensor))
+
+    weight_bytes_before = sum(param.nbytes for param in params)
+    for module in modules.values():
+        freeze_module(module)
+        if dtype is not None:
+            module.to(dtype)
+        if grad_mode is not None:
+            _register_grad_mode_hooks(module, grad_mode)
+    weight_bytes_after = sum(param.nbytes for module in modules.values() for param in module.parameters())
+
+    report = {
+        "modules": list(modules),
+        "optimizer_state_bytes": optimizer_state_bytes,
+        "weight_bytes": weight_bytes_before - weight_bytes_after,
+    }
+    if sample_inputs is not None:
+        report["activation_bytes"] = activation_bytes_before - measure_saved_activations(model, *sample_inputs)
+
+    if verbose:
+        print(f"Frozen modules: {len(modules)} ({sum(param.numel() for param in params):,} parameters)")
+        print(f"Optimizer state freed: {report['optimizer_state_bytes'] / 2**20:.2f} MB")
+        print(f"Weight memory freed: {report['weight_bytes'] / 2**20:.2f} MB")
+        if sample_inputs is not None:
+            print(f"Activation memory freed: {report['activation_bytes'] / 2**20:.2f} MB")
+
+    return report
+
+
+def unfreeze_matching(model: nn.Module, patterns: list[str], regex: bool = False, dtype: torch.dtype = None):
+    """
+    Reverts `freeze_matching` for all modules whose names match any of the patterns
+
+    Args:
+        model (nn.Module): Model to unfreeze modules of
+        patterns (list[str]): Glob patterns (or regexes if `regex` is True) over `model.named_modules()`
+        regex (bool, optional): Treat patterns as regexes. Defaults to False.
+        dtype (torch.dtype, optional): dtype to cast the weights back to, in case they were cast while freezing.
+            Defaults to None.
+
+    Returns:
+        list[str]: Names of the unfrozen modules
+    """
+    modules = get_matching_modules(model, patterns, regex)
+    for module in modules.values():
+        for submodule in module.modules():
+            _remove_grad_mode_hooks(submodule)
+        if dtype is not None:
+            module.to(dtype)
+        unfreeze_module(module)
+    return list(modules)
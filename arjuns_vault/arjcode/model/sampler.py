@@ -0,0 +1,99 @@
+import math
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset, Sampler
+
+
+def get_accumulate_grad_batches(rank_weights: list[float], min_accumulate_grad_batches: int = 1):
+    """
+    Returns the number of batches each rank should accumulate per optimizer step so that all ranks take roughly the
+    same amount of time per step. The slowest rank accumulates `min_accumulate_grad_batches` batches.
+
+    Args:
+        rank_weights (list[float]): Relative throughput of each global rank (see `get_rank_weights`)
+        min_accumulate_grad_batches (int, optional): Batches accumulated by the slowest rank. Defaults to 1.
+
+    Returns:
+        list[int]: accumulate_grad_batches for every global rank
+    """
+    slowest = min(rank_weights)
+    return [max(1, round(min_accumulate_grad_batches * weight / slowest)) for weight in rank_weights]
+
+
+class RankWeightedDistributedSampler(Sampler):
+    """
+    Drop-in replacement for `DistributedSampler` for heterogeneous clusters. Every optimizer step, rank i receives
+    `accumulate_grad_batches[i] * batch_size` samples, so every rank takes the same number of optimizer steps per epoch
+    while faster ranks process proportionally more data.
+
+    Each process should pass its own `accumulate_grad_batches[rank]` to its Trainer and set
+    `use_distributed_sampler=False`. As DDP averages gradients across ranks equally, multiply the loss by
+    `accumulate_grad_batches[rank] * world_size / sum(accumulate_grad_batches)` to weigh every sample equally.
+
+    Args:
+        dataset (Dataset): Dataset to sample from
+        accumulate_grad_batches (list[int]): Batches accumulated per optimizer step by each global rank
+            (see `get_accumulate_grad_batches`)
+        batch_size (int): Per-device batch size
+        rank (int, optional): Global rank of the current process. Inferred from torch.distributed by default.
+        shuffle (bool, optional): Whether to shuffle the indices every epoch. Defaults to True.
+        seed (int, optional): Seed used for shuffling. Must be the same on all ranks. Defaults to 0.
+        drop_last (bool, optional): Drop the tail of the data instead of padding it with repeated samples.
+            Defaults to False.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        accumulate_grad_batches: list[int],
+        batch_size: int,
+        rank: int = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+    ):
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        assert 0 <= rank < len(accumulate_grad_batches), f"Invalid rank {rank}"
+        assert all(acc >= 1 for acc in accumulate_grad_batches), "accumulate_grad_batches must all be >= 1"
+
+        self.dataset = dataset
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        # Contiguous slice of every global step that belongs to this rank
+        self.samples_per_step = batch_size * sum(accumulate_grad_batches)
+        self.start = batch_size * sum(accumulate_grad_batches[:rank])
+        self.end = self.start + batch_size * accumulate_grad_batches[rank]
+
+        if drop_last:
+            self.num_steps = len(dataset) // self.samples_per_step
+        else:
+            self.num_steps = math.ceil(len(dataset) / self.samples_per_step)
+        self.num_samples = self.num_steps * (self.end - self.start)
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=generator)
+        else:
+            indices = torch.arange(len(self.dataset))
+
+        total_size = self.num_steps * self.samples_per_step
+        if total_size > len(indices):
+            indices = indices.repeat(math.ceil(total_size / len(indices)))
+        indices = indices[:total_size]
+
+        indices = indices.view(self.num_steps, self.samples_per_step)[:, self.start : self.end]
+        return iter(indices.reshape(-1).tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
@@ -0,0 +1,92 @@
+from functools import partial
+
+import torch
+from torch import nn
+
+
+class UnusedParameterTracker:
+    """
+    Counts how many backward passes each trainable parameter receives a gradient in, using post-accumulate-grad hooks.
+    This costs one Python increment per parameter per backward pass instead of a scan over all parameters every step.
+
+    Args:
+        module (nn.Module): Module whose trainable parameters are tracked
+        rarely_used_threshold (float, optional): Parameters that receive gradients in fewer than this fraction of the
+            backward passes (but at least once) are reported as rarely used. Defaults to 0.1.
+    """
+
+    def __init__(self, module: nn.Module, rarely_used_threshold: float = 0.1):
+        self.rarely_used_threshold = rarely_used_threshold
+        self.names = []
+        self.params = []
+        self.handles = []
+        for name, param in module.named_parameters():
+            if not param.requires_grad:
+                continue
+            self.handles.append(param.register_post_accumulate_grad_hook(partial(self._hook, index=len(self.names))))
+            self.names.append(name)
+            self.params.append(param)
+        self.reset()
+
+    def _hook(self, param, index):
+        self.counts[index] += 1
+
+    def step(self):
+        """Should be called once per backward pass"""
+        self.num_steps += 1
+
+    def reset(self):
+        self.counts = [0] * len(self.names)
+        self.num_steps = 0
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def get_counts(self):
+        """Returns the gradient counts of all parameters and the number of backward passes as a single tensor, so that
+        they can be reduced across ranks in one collective"""
+        return torch.tensor(self.counts + [self.num_steps], dtype=torch.long)
+
+    def summarize(self, counts: torch.Tensor = None):
+        """
+        Args:
+            counts (torch.Tensor, optional): Output of `get_counts`, possibly summed across ranks. Defaults to the
+                counts of the current process.
+
+        Returns:
+            tuple[list[str], dict[str, float]]: Names of never-used parameters, and rarely-used parameters mapped to
+                the fraction of backward passes they received gradients in
+        """
+        if counts is None:
+            counts = self.get_counts()
+        counts = counts.tolist()
+        num_steps = counts.pop()
+
+        never_used = []
+        rarely_used = {}
+        for name, param, count in zip(self.names, self.params, counts):
+            if not param.requires_grad or num_steps == 0:
+                continue
+            if count == 0:
+                never_used.append(name)
+            elif count / num_steps < self.rarely_used_threshold:
+                rarely_used[name] = count / num_steps
+        return never_used, rarely_used
+
+    def suggest_ddp_config(self, counts: torch.Tensor = None):
+        """Returns the DDPStrategy kwargs that are sufficient for the observed parameter usage. `counts` is as in
+        `summarize`"""
+        if counts is None:
+            counts = self.get_counts()
+        counts = counts.tolist()
+        num_steps = counts.pop()
+
+        used_counts = [count for param, count in zip(self.params, counts) if param.requires_grad]
+        if any(0 < count < num_steps for count in used_counts):
+            # The set of used parameters changes between backward passes, so DDP has to search for them every step
+            return {"find_unused_parameters": True, "static_graph": False}
+        # The same parameters are used every backward pass. Never-used parameters are handled by static_graph but are
+        # better frozen
+        return {"find_unused_parameters": False, "static_graph": True}
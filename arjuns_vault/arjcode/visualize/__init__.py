@@ -1,3 +1,7 @@
 from .describe import describe_model
-from .jupyter import get_annotated_scan, plot_scans
+from .export import export_annotated_scans
+from .jupyter import get_annotated_scan, plot_planes, plot_scans
+from .overlay import AnnotatedVolume, annotate_scan, get_boundaries
 from .strings import get_maxlen, show_keys_hierarchy
+from .volume import LazyVolume, get_intensity_range
+from .windowing import WINDOW_PRESETS, get_window_range, to_uint8
@@ -0,0 +1,168 @@
+import math
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import SimpleITK as sitk
+from matplotlib import pyplot as plt
+
+from .overlay import annotate_scan
+from .volume import get_intensity_range
+
+# Files whose slices can be read without decoding the rest of the volume (.npy is memory-mapped, uncompressed NIfTI
+# through nibabel)
+_SLICEABLE_EXTENSIONS = (".npy", ".nii")
+
+
+def _get_name(img_path: str):
+    name = os.path.basename(img_path)
+    for ext in (".nii.gz", ".nii", ".npy", ".nrrd", ".mha", ".mhd"):
+        if name.endswith(ext):
+            return name[: -len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def _get_montage(slices: list[np.ndarray]):
+    cols = math.ceil(math.sqrt(len(slices)))
+    rows = math.ceil(len(slices) / cols)
+    height, width = slices[0].shape[:2]
+    montage = np.zeros((rows * height, cols * width, 3), dtype=np.uint8)
+    for i, slc in enumerate(slices):
+        row, col = divmod(i, cols)
+        montage[row * height : (row + 1) * height, col * width : (col + 1) * width] = slc
+    return montage
+
+
+def _read_volume(path: str):
+    """
+    Returns a path that `annotate_scan` reads lazily if its slices can be read on their own, and the decoded array
+    otherwise. Compressed files (e.g. .nii.gz) would be decompressed from the start for every slice read, so they are
+    decoded once.
+    """
+    if path.endswith(_SLICEABLE_EXTENSIONS):
+        return path
+    return sitk.GetArrayFromImage(sitk.ReadImage(path))
+
+
+def _save(path: str, save_fn):
+    # Write to a temporary file first so that an interrupted export is never mistaken for a finished one
+    tmp_path = f"{os.path.dirname(path)}/.tmp.{os.path.basename(path)}"
+    save_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _export_one(name, img_path, mask_paths, output_dir, mode, slices, n_montage_slices, fps, skip_existing):
+    if mode == "slices":
+        output_path = os.path.join(output_dir, name)
+    elif mode == "montage":
+        output_path = os.path.join(output_dir, f"{name}.png")
+    else:
+        output_path = os.path.join(output_dir, f"{name}.mp4")
+
+    if skip_existing and os.path.exists(output_path):
+        return name, "skipped"
+
+    img = _read_volume(img_path)
+    # The intensity range of a decoded volume is taken from the array in memory, instead of reading the file again
+    intensity_range = None if isinstance(img, str) else get_intensity_range(img)
+    # Only the requested slices are ever rendered
+    annotated_scan, _ = annotate_scan(
+        img, [_read_volume(mask_path) for mask_path in mask_paths], intensity_range=intensity_range, lazy=True
+    )
+    if slices is None:
+        if mode == "montage":
+            slices = np.linspace(0, len(annotated_scan) - 1, min(n_montage_slices, len(annotated_scan)))
+            slices = np.unique(slices.round().astype(int)).tolist()
+        else:
+            slices = range(len(annotated_scan))
+
+    if mode == "slices":
+        tmp_dir = os.path.join(output_dir, f".tmp.{name}")
+        os.makedirs(tmp_dir, exist_ok=True)
+        for z in slices:
+            plt.imsave(os.path.join(tmp_dir, f"{z:04d}.png"), annotated_scan[z])
+        if os.path.exists(output_path):
+            shutil.rmtree(output_path)
+        os.replace(tmp_dir, output_path)
+    elif mode == "montage":
+        montage = _get_montage([annotated_scan[z] for z in slices])
+        _save(output_path, lambda path: plt.imsave(path, montage, format="png"))
+    else:
+        import imageio.v2 as imageio
+
+        def write_video(path):
+            with imageio.get_writer(path, format="FFMPEG", fps=fps) as writer:
+                for z in slices:
+                    writer.append_data(annotated_scan[z])
+
+        _save(output_path, write_video)
+
+    return name, "exported"
+
+
+def export_annotated_scans(
+    scans,
+    output_dir: str,
+    mode: str = "montage",
+    slices: list[int] = None,
+    n_montage_slices: int = 16,
+    fps: int = 10,
+    num_workers: int = None,
+    skip_existing: bool = True,
+):
+    """
+    Renders annotated scans (see `annotate_scan`) to files in parallel, without jupyter. Only the requested slices are
+    rendered. Slices of .npy and uncompressed NIfTI files are also read lazily, so the memory used by each worker is
+    bounded by a few slices irrespective of the scan size. Compressed and other formats are decoded once per scan, as
+    reading their slices one at a time would decompress the file again for every slice.
+
+    Args:
+        scans (list or dict): (image path, list of mask paths) pairs, or a dict mapping an output name to such a pair.
+            Output names default to the image filename without its extension.
+        output_dir (str): Directory to save the renders in
+        mode (str, optional): "montage" saves a grid of slices as one PNG per scan, "slices" saves a directory with one
+            PNG per slice, and "video" saves an MP4 per scan (requires imageio with ffmpeg). Defaults to "montage".
+        slices (list[int], optional): Slices to render. Defaults to `n_montage_slices` evenly spaced slices for
+            montages, and all slices otherwise.
+        n_montage_slices (int, optional): Number of slices in a montage. Defaults to 16.
+        fps (int, optional): Frame rate of the videos. Defaults to 10.
+        num_workers (int, optional): Number of processes. Defaults to the number of CPUs.
+        skip_existing (bool, optional): Skip scans whose outputs already exist so that an interrupted export can be
+            resumed. Defaults to True.
+
+    Returns:
+        dict[str, str]: Status ("exported", "skipped" or the error) of every scan
+    """
+    assert mode in ("montage", "slices", "video"), f"Unknown mode: {mode}"
+
+    if not isinstance(scans, dict):
+        scans = {_get_name(img_path): (img_path, mask_paths) for img_path, mask_paths in scans}
+    os.makedirs(output_dir, exist_ok=True)
+
+    statuses = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(
+                _export_one,
+                name,
+                img_path,
+                mask_paths,
+                output_dir,
+                mode,
+                slices,
+                n_montage_slices,
+                fps,
+                skip_existing,
+            ): name
+            for name, (img_path, mask_paths) in scans.items()
+        }
+        for i, future in enumerate(as_completed(futures)):
+            name = futures[future]
+            try:
+                _, statuses[name] = future.result()
+            except Exception as e:
+                statuses[name] = repr(e)
+            print(f"[{i + 1}/{len(futures)}] {name}: {statuses[name]}")
+
+    return statuses
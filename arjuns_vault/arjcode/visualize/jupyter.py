@@ -2,19 +2,35 @@ import math
 
 import numpy as np
 import SimpleITK as sitk
-import skimage
-import skimage.segmentation
+from IPython.display import display
 from ipywidgets import interact, widgets
-from matplotlib import cm, patches
+from matplotlib import patches
 from matplotlib import pyplot as plt
 
+from .overlay import annotate_scan
+from .volume import LazyVolume
+from .windowing import WINDOW_PRESETS, get_window_range, to_uint8
 
-def plot_scans(img_arr_list, title_list=None, colors_legend=None, rows=None, cols=None, expand_dims=False, cmap="gray"):
+
+def plot_scans(
+    img_arr_list,
+    title_list=None,
+    colors_legend=None,
+    rows=None,
+    cols=None,
+    expand_dims=False,
+    cmap="gray",
+    window=None,
+    cache_size=32,
+    prefetch=4,
+):
     """
-    Plot multiple 3D scans in jupyter which can be scrolled through simultaneously
+    Plot multiple 3D scans in jupyter which can be scrolled through simultaneously. Slices are read lazily and the
+    figure is only created once, so scrolling does not slow down with the size of the scans.
 
     Args:
-        img_arr_list (list): All the scans to plot
+        img_arr_list (list): All the scans to plot. Each can be a np.ndarray (or np.memmap), sitk.Image, path to a
+            .npy/NIfTI/SimpleITK-readable file, or a LazyVolume
         title_list (list, optional): Titles of each of the plots to be displayed. Defaults to None.
         colors_legend (dict(color, label), optional): Tuple of annotation colors and their respective legend names.
             Defaults to None.
@@ -22,6 +38,10 @@ def plot_scans(img_arr_list, title_list=None, colors_legend=None, rows=None, col
         cols (int, optional): Number of cols to use to plot all the scans. Defaults to None.
         expand_dims (bool, optional): If a 2D input is given, it will expand it to a 3D by adding an axis at index 0.
             Defaults to False.
+        window (str or tuple[float, float], optional): CT window preset name (see WINDOW_PRESETS) or (level, width)
+            applied to all grayscale scans. Defaults to None i.e. each slice is scaled to its own min and max.
+        cache_size (int, optional): Number of slices of each scan to keep in memory. Defaults to 32.
+        prefetch (int, optional): Number of neighboring slices of each scan to load in the background. Defaults to 4.
     """
 
     if title_list is None:
@@ -33,12 +53,15 @@ def plot_scans(img_arr_list, title_list=None, colors_legend=None, rows=None, col
     if isinstance(cmap, str):
         cmap = [cmap] * len(img_arr_list)
 
+    img_arr_list = list(img_arr_list)
     for i in range(len(img_arr_list)):
-        if isinstance(img_arr_list[i], sitk.Image):
-            img_arr_list[i] = sitk.GetArrayFromImage(img_arr_list[i])
         if expand_dims:
-            if img_arr_list[i].ndim == 2:
+            if isinstance(img_arr_list[i], sitk.Image) and img_arr_list[i].GetDimension() == 2:
+                img_arr_list[i] = sitk.GetArrayFromImage(img_arr_list[i])
+            if isinstance(img_arr_list[i], np.ndarray) and img_arr_list[i].ndim == 2:
                 img_arr_list[i] = np.expand_dims(img_arr_list[i], 0)
+        if not isinstance(img_arr_list[i], LazyVolume):
+            img_arr_list[i] = LazyVolume(img_arr_list[i], cache_size=cache_size, prefetch=prefetch)
 
     if rows is None and cols is None:
         rows = 1
@@ -53,33 +76,57 @@ def plot_scans(img_arr_list, title_list=None, colors_legend=None, rows=None, col
         for color, label in colors_legend:
             handles.append(patches.Patch(color=color, label=label))
 
-    def show_layout(z=None):
-        fig, ax = plt.subplots(rows, cols, figsize=(7 * cols, 4 * cols), squeeze=False)
+    intensity_range = None if window is None else get_window_range(window)
 
-        for idx in range(len(img_arr_list)):
-            if z is None:
-                img = img_arr_list[idx][0]
-            else:
-                img = img_arr_list[idx][z]
+    def get_slice(idx, z):
+        img = img_arr_list[idx][min(z, len(img_arr_list[idx]) - 1)]
+        if intensity_range is not None and img.ndim == 2:
+            img = to_uint8(img, intensity_range)
+        return img
 
-            ax[idx // cols][idx % cols].imshow(img, cmap=cmap[idx])
-            ax[idx // cols][idx % cols].title.set_text(title_list[idx])
-            ax[idx // cols][idx % cols].axis("off")
-            ax[idx // cols][idx % cols].grid(False)
+    # Create the figure once and only update the image data on every scroll
+    fig, ax = plt.subplots(rows, cols, figsize=(7 * cols, 4 * cols), squeeze=False)
+    images = []
+    for idx in range(len(img_arr_list)):
+        images.append(ax[idx // cols][idx % cols].imshow(get_slice(idx, 0), cmap=cmap[idx]))
+        ax[idx // cols][idx % cols].title.set_text(title_list[idx])
+        ax[idx // cols][idx % cols].axis("off")
+        ax[idx // cols][idx % cols].grid(False)
+
+    if colors_legend is not None:
+        fig.legend(handles=handles)
 
-        if colors_legend is not None:
-            fig.legend(handles=handles)
+    fig.tight_layout()
 
-        fig.tight_layout()
+    # With interactive backends (e.g. ipympl) the canvas updates in place, else the figure has to be re-displayed
+    interactive_backend = "ipympl" in plt.get_backend() or "widget" in plt.get_backend()
+    if interactive_backend:
         fig.show()
+    else:
+        plt.close(fig)
+
+    def show_layout(z=0):
+        for idx in range(len(img_arr_list)):
+            img = get_slice(idx, z)
+            images[idx].set_data(img)
+            if img.ndim == 2:
+                if intensity_range is None:
+                    images[idx].autoscale()
+                else:
+                    images[idx].set_clim(0, 255)
 
-    if any([img.ndim >= 3 for img in img_arr_list]):
+        if interactive_backend:
+            fig.canvas.draw_idle()
+        else:
+            display(fig)
+
+    if len(img_arr_list[0]) > 1:
         interact(
             show_layout,
             z=widgets.IntSlider(
                 value=0,
                 min=0,
-                max=(img_arr_list[0].shape[0] - 1),
+                max=(len(img_arr_list[0]) - 1),
                 step=1,
             ),
         )
@@ -87,49 +134,172 @@ def plot_scans(img_arr_list, title_list=None, colors_legend=None, rows=None, col
         show_layout()
 
 
+def plot_planes(img_arr, window=None, cmap="gray", cache_size=32, prefetch=4):
+    """
+    Plot the axial, coronal and sagittal planes of a 3D scan in jupyter with synchronized cursors. Slices are read
+    lazily, windowing goes through a cached lookup table for integer scans, and the intensity range of the scan is only
+    computed once, so changing the window or any plane only reads and renders the planes that changed.
+
+    Args:
+        img_arr (np.ndarray, sitk.Image, str or LazyVolume): Grayscale scan of shape (z, y, x)
+        window (str or tuple[float, float], optional): Initial CT window preset name (see WINDOW_PRESETS) or
+            (level, width). Defaults to the min and max of the scan.
+        cmap (str, optional): Colormap. Defaults to "gray".
+        cache_size (int, optional): Number of slices (across all planes) to keep in memory. Defaults to 32.
+        prefetch (int, optional): Number of neighboring slices to load in the background. Defaults to 4.
+    """
+
+    if not isinstance(img_arr, LazyVolume):
+        img_arr = LazyVolume(img_arr, cache_size=cache_size, prefetch=prefetch)
+    assert img_arr.ndim == 3, "Scan should be 3D"
+
+    window = "auto" if window is None else window
+    window_options = [(name, name) for name in ["auto", *WINDOW_PRESETS]]
+    if isinstance(window, tuple):
+        window_options.append((f"{window[0]}/{window[1]}", window))
+
+    def get_intensity_range(window):
+        return img_arr.get_intensity_range() if window == "auto" else get_window_range(window)
+
+    # For every plane: name, the axes of the (z, y, x) volume shown as (rows, cols), and the pixel aspect ratio
+    spacing = img_arr.spacing
+    planes = [
+        ("Axial", (1, 2), spacing[1] / spacing[2]),
+        ("Coronal", (0, 2), spacing[0] / spacing[2]),
+        ("Sagittal", (0, 1), spacing[0] / spacing[1]),
+    ]
+
+    cursor = [size // 2 for size in img_arr.shape]
+    intensity_range = get_intensity_range(window)
+
+    fig, ax = plt.subplots(1, 3, figsize=(21, 7), squeeze=False)
+    ax = ax[0]
+    images = []
+    lines = []
+    for axis, (title, (row_axis, col_axis), aspect) in enumerate(planes):
+        slc = to_uint8(img_arr.get_slice(cursor[axis], axis), intensity_range)
+        images.append(ax[axis].imshow(slc, cmap=cmap, vmin=0, vmax=255, aspect=aspect))
+        lines.append(
+            (
+                ax[axis].axhline(cursor[row_axis], color="yellow", linewidth=0.5),
+                ax[axis].axvline(cursor[col_axis], color="yellow", linewidth=0.5),
+            )
+        )
+        ax[axis].title.set_text(title)
+        ax[axis].axis("off")
+    fig.tight_layout()
+
+    interactive_backend = "ipympl" in plt.get_backend() or "widget" in plt.get_backend()
+    if interactive_backend:
+        fig.show()
+    else:
+        plt.close(fig)
+
+    state = {"cursor": list(cursor), "window": window}
+
+    def show_layout(z, y, x, window):
+        cursor = [z, y, x]
+        for axis, (_, (row_axis, col_axis), _) in enumerate(planes):
+            # Only planes whose slice or window changed are re-rendered
+            if cursor[axis] != state["cursor"][axis] or window != state["window"]:
+                images[axis].set_data(to_uint8(img_arr.get_slice(cursor[axis], axis), get_intensity_range(window)))
+            lines[axis][0].set_ydata([cursor[row_axis]] * 2)
+            lines[axis][1].set_xdata([cursor[col_axis]] * 2)
+        state["cursor"] = cursor
+        state["window"] = window
+
+        if interactive_backend:
+            fig.canvas.draw_idle()
+        else:
+            display(fig)
+
+    interact(
+        show_layout,
+        **{
+            name: widgets.IntSlider(value=cursor[axis], min=0, max=img_arr.shape[axis] - 1, step=1)
+            for axis, name in enumerate("zyx")
+        },
+        window=widgets.Dropdown(options=window_options, value=window),
+    )
+
+
 def get_annotated_scan(
-    img_arr: np.ndarray, mask_arrs: list[np.array], return_colors: bool = False, colors_labels: list = [], **kwargs
+    img_arr: np.ndarray,
+    mask_arrs: list[np.array],
+    return_colors: bool = False,
+    colors_labels: list = [],
+    label_arr: np.ndarray = None,
+    mode: str = "outer",
+    background_label: int = 0,
+    window=None,
+    chunk_size: int = None,
+    lazy: bool = False,
+    as_uint8: bool = False,
+    outline_color: tuple[float, float, float] = None,
 ):
     """
-    Returns an annotated scan given a base scan and a mask of the same size
+    Returns an annotated scan given a base scan and a mask of the same size. Boundaries are drawn as by
+    `skimage.segmentation.mark_boundaries`, whose `mode`, `background_label` and `outline_color` arguments are
+    supported.
 
     Args:
         img_arr (np.ndarray or sitk.Image): Base image
         mask_arrs (list[np.ndarray or sitk.Image]): Masks. Each should be of the same size as img_arr
+        return_colors (bool, optional): Also return the colors used along with `colors_labels`. Defaults to False.
+        colors_labels (list, optional): Legend names of the masks (and labels of label_arr). Defaults to [].
+        label_arr (np.ndarray or sitk.Image, optional): Label map of the same size as img_arr. Each label is drawn in
+            its own color. Defaults to None.
+        mode (str, optional): Boundary mode as in `skimage.segmentation.mark_boundaries`. Defaults to "outer".
+        background_label (int, optional): Label of the background. Defaults to 0.
+        window (str or tuple[float, float], optional): CT window preset name (see WINDOW_PRESETS) or (level, width).
+            Defaults to the min and max of img_arr.
+        chunk_size (int, optional): Number of slices rendered at a time to bound memory usage. Defaults to None.
+        lazy (bool, optional): Return an AnnotatedVolume that renders uint8 RGB slices on demand (3D only). Defaults
+            to False.
+        as_uint8 (bool, optional): Return uint8 RGB values in [0, 255], which take 8 times less memory than the floats
+            returned by default. Defaults to False.
+        outline_color (tuple[float, float, float], optional): RGB color in [0, 1] of an outline drawn around the
+            boundaries, as in `skimage.segmentation.mark_boundaries`. Defaults to None.
 
     Returns:
-        np.ndarray: Annotated scan
+        np.ndarray: Annotated scan (float RGB in [0, 1], or uint8 RGB if as_uint8 is True)
     """
-
     if isinstance(img_arr, sitk.Image):
-        img_arr = sitk.GetArrayFromImage(img_arr)
-    for i in range(len(mask_arrs)):
-        if isinstance(mask_arrs[i], sitk.Image):
-            mask_arrs[i] = sitk.GetArrayFromImage(mask_arrs[i]).astype(int)
+        img_arr = img_arr if lazy else sitk.GetArrayFromImage(img_arr)
 
-    colors = cm.get_cmap("hsv")(np.linspace(0, 1, len(mask_arrs), endpoint=False))
-
-    orig_dim = img_arr.ndim
+    orig_dim = img_arr.ndim if isinstance(img_arr, np.ndarray) else 3
     if orig_dim == 2:
+        assert not lazy, "Lazy annotation is only supported for 3D images"
         img_arr = np.expand_dims(img_arr, 0)
-    assert img_arr.ndim == 3, "Image should be 3D"
+        mask_arrs = [np.expand_dims(_as_array(mask_arr), 0) for mask_arr in mask_arrs]
+        if label_arr is not None:
+            label_arr = np.expand_dims(_as_array(label_arr), 0)
+    assert not isinstance(img_arr, np.ndarray) or img_arr.ndim == 3, "Image should be 3D"
 
-    img_arr = (img_arr - img_arr.min() + 1e-6) / (img_arr.max() - img_arr.min() + 1e-6)
-
-    annotated_scan = list(img_arr)
-    for mask_arr, color in zip(mask_arrs, colors):
-        for i, mask_slc in zip(range(len(annotated_scan)), mask_arr):
-            annotated_scan[i] = skimage.segmentation.mark_boundaries(
-                annotated_scan[i], mask_slc, color=color[:3], **kwargs
-            )
-    annotated_scan = np.stack(annotated_scan)
+    annotated_scan, colors = annotate_scan(
+        img_arr,
+        mask_arrs,
+        label_arr=label_arr,
+        mode=mode,
+        background_label=background_label,
+        window=window,
+        chunk_size=chunk_size,
+        lazy=lazy,
+        outline_color=outline_color,
+    )
 
     if orig_dim == 2:
         annotated_scan = np.squeeze(annotated_scan, 0)
-
-    annotated_scan = np.clip(annotated_scan, 0, 1)
+    if not lazy and not as_uint8:
+        annotated_scan = annotated_scan / 255
 
     if return_colors:
         colors_legend = list(zip(colors, colors_labels))
         return annotated_scan, colors_legend
     return annotated_scan
+
+
+def _as_array(arr):
+    if isinstance(arr, sitk.Image):
+        return sitk.GetArrayFromImage(arr)
+    return arr
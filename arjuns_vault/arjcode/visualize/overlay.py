@@ -0,0 +1,221 @@
+import numpy as np
+import SimpleITK as sitk
+from matplotlib import colormaps
+
+from .volume import LazyVolume, get_intensity_range
+from .windowing import get_window_range, to_uint8
+
+
+def _filter(arr: np.ndarray, op, square: bool):
+    """Applies `op` (np.maximum or np.minimum) over the in-plane 3x3 cross (or square) neighborhood of every pixel of a
+    (z, y, x) volume, replicating edge pixels"""
+    padded = np.pad(arr, ((0, 0), (1, 1), (1, 1)), mode="edge")
+    if square:
+        # The square neighborhood is separable into a row and a column pass
+        rows = op(op(padded[:, :, :-2], padded[:, :, 1:-1]), padded[:, :, 2:])
+        return op(op(rows[:, :-2], rows[:, 1:-1]), rows[:, 2:])
+    out = op(padded[:, 1:-1, 1:-1], padded[:, :-2, 1:-1])
+    op(out, padded[:, 2:, 1:-1], out=out)
+    op(out, padded[:, 1:-1, :-2], out=out)
+    op(out, padded[:, 1:-1, 2:], out=out)
+    return out
+
+
+def get_boundaries(label_arr: np.ndarray, mode: str = "outer", background_label: int = 0):
+    """
+    Vectorized equivalent of calling `skimage.segmentation.find_boundaries` on every slice of a (z, y, x) label volume
+
+    Args:
+        label_arr (np.ndarray): Label volume (binary mask or label map)
+        mode (str, optional): "thick", "inner" or "outer". Defaults to "outer".
+        background_label (int, optional): Label of the background. Defaults to 0.
+
+    Returns:
+        np.ndarray: Boolean volume marking the boundaries
+    """
+    if mode not in ("thick", "inner", "outer"):
+        raise ValueError(f"Unknown mode: {mode}")
+
+    if label_arr.dtype == bool and background_label == 0:
+        dilated = _filter(label_arr, np.maximum, square=False)
+        eroded = _filter(label_arr, np.minimum, square=False)
+        if mode == "inner":
+            return label_arr & ~eroded
+        if mode == "outer":
+            return dilated & ~label_arr
+        return dilated ^ eroded
+
+    boundaries = _filter(label_arr, np.maximum, square=False) != _filter(label_arr, np.minimum, square=False)
+    if mode == "inner":
+        boundaries &= label_arr != background_label
+    elif mode == "outer":
+        background = label_arr == background_label
+        # Any value larger than all labels works as the inverted background
+        inverted_background = label_arr.astype(np.int64)
+        inverted_background[background] = inverted_background.max() + 1
+        adjacent_objects = _filter(label_arr, np.maximum, square=True) != _filter(
+            inverted_background, np.minimum, square=True
+        )
+        adjacent_objects &= ~background
+        boundaries &= background | adjacent_objects
+    return boundaries
+
+
+def _as_volume(arr, lazy: bool):
+    """Returns an object whose slices can be read without loading the whole of `arr` where possible"""
+    if arr is None or isinstance(arr, np.ndarray):
+        return arr
+    if lazy:
+        return arr if isinstance(arr, LazyVolume) else LazyVolume(arr, cache_size=1, prefetch=0)
+    if isinstance(arr, LazyVolume):
+        return np.stack([arr[z] for z in range(len(arr))])
+    if isinstance(arr, str):
+        if arr.endswith(".npy"):
+            return np.load(arr, mmap_mode="r")
+        arr = sitk.ReadImage(arr)
+    return sitk.GetArrayFromImage(arr)
+
+
+class AnnotatedVolume:
+    """
+    Annotated version of a 3D scan whose slices are rendered on demand, for volumes that do not fit in memory. Can be
+    passed to `plot_scans` directly. Use `get_annotated_scan(..., lazy=True)` to create one.
+    """
+
+    def __init__(self, img, mask_arrs, label_arr, lut, intensity_range, mode, background_label, outline_color=None):
+        self.img = img
+        self.mask_arrs = mask_arrs
+        self.label_arr = label_arr
+        self.lut = lut
+        self.intensity_range = intensity_range
+        self.mode = mode
+        self.background_label = background_label
+        self.outline_color = outline_color
+        self.shape = (*img.shape[:3], 3)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, z: int):
+        def get_slice(arr):
+            return None if arr is None else np.asarray(arr[z])[None]
+
+        return _annotate(
+            get_slice(self.img),
+            [get_slice(mask_arr) for mask_arr in self.mask_arrs],
+            get_slice(self.label_arr),
+            self.lut,
+            self.intensity_range,
+            self.mode,
+            self.background_label,
+            self.outline_color,
+        )[0]
+
+
+def _annotate(img, mask_arrs, label_arr, lut, intensity_range, mode, background_label, outline_color=None, out=None):
+    """Renders a chunk of slices into a uint8 RGB volume"""
+    gray = to_uint8(img, intensity_range)
+
+    if out is None:
+        out = np.empty((*gray.shape, 3), dtype=np.uint8)
+    out[...] = gray[..., None]
+
+    def draw_outline(boundaries):
+        # As in `skimage.segmentation.mark_boundaries`, the outline is the 3x3 dilation of the boundaries
+        if outline_color is not None:
+            out[_filter(boundaries, np.maximum, square=True)] = np.round(np.asarray(outline_color) * 255)
+
+    # Masks are drawn one after the other, so later masks are drawn over earlier ones
+    for i, mask_arr in enumerate(mask_arrs):
+        boundaries = get_boundaries(mask_arr, mode, background_label)
+        draw_outline(boundaries)
+        out[boundaries] = lut[i]
+
+    # All labels of a label map are drawn at once, each with its own color
+    if label_arr is not None:
+        boundaries = get_boundaries(label_arr, mode, background_label)
+        draw_outline(boundaries)
+        if mode != "inner":
+            # Outer boundaries lie on the background, so take the color of the neighboring label
+            label_arr = _filter(label_arr, np.maximum, square=True)
+        labels = np.clip(label_arr[boundaries].astype(np.intp), 1, len(lut) - len(mask_arrs))
+        out[boundaries] = lut[len(mask_arrs) - 1 + labels]
+
+    return out
+
+
+def annotate_scan(
+    img_arr,
+    mask_arrs: list = [],
+    label_arr=None,
+    mode: str = "outer",
+    background_label: int = 0,
+    intensity_range: tuple[float, float] = None,
+    window=None,
+    chunk_size: int = None,
+    lazy: bool = False,
+    outline_color: tuple[float, float, float] = None,
+):
+    """
+    Draws the boundaries of every mask (and of every label of a label map) on a 3D scan in a single vectorized pass.
+
+    Args:
+        img_arr (np.ndarray, sitk.Image, LazyVolume or str): Base scan of shape (z, y, x). Paths are read as in
+            LazyVolume.
+        mask_arrs (list, optional): Masks of the same shape as img_arr. Each is drawn in its own color.
+            Defaults to [].
+        label_arr (optional): Label map of the same shape as img_arr. Every label is drawn in its own color.
+            Defaults to None.
+        mode (str, optional): Boundary mode as in `skimage.segmentation.find_boundaries`. Defaults to "outer".
+        background_label (int, optional): Label of the background. Defaults to 0.
+        intensity_range (tuple[float, float], optional): Intensities mapped to black and white. Defaults to the
+            min and max of img_arr (computed once and cached if img_arr is a LazyVolume).
+        window (str or tuple[float, float], optional): CT window preset name (see WINDOW_PRESETS) or (level, width),
+            used instead of intensity_range. Defaults to None.
+        chunk_size (int, optional): Number of slices rendered at a time, to bound the temporary memory used.
+            Defaults to all slices at once.
+        lazy (bool, optional): Return an AnnotatedVolume that renders slices on demand. Defaults to False.
+        outline_color (tuple[float, float, float], optional): RGB color in [0, 1] of an outline drawn around the
+            boundaries, as in `skimage.segmentation.mark_boundaries`. Defaults to None.
+
+    Returns:
+        tuple[np.ndarray or AnnotatedVolume, np.ndarray]: uint8 RGB annotated scan of shape (z, y, x, 3), and the RGBA
+            colors used for the masks followed by those used for labels 1, 2, ... of the label map
+    """
+    img_arr = _as_volume(img_arr, lazy)
+    mask_arrs = [_as_volume(mask_arr, lazy) for mask_arr in mask_arrs]
+    label_arr = _as_volume(label_arr, lazy)
+
+    n_labels = 0 if label_arr is None else int(get_intensity_range(label_arr)[1])
+    colors = colormaps["hsv"](np.linspace(0, 1, len(mask_arrs) + n_labels, endpoint=False))
+    lut = np.round(colors[:, :3] * 255).astype(np.uint8)
+
+    if window is not None:
+        intensity_range = get_window_range(window)
+    elif intensity_range is None:
+        intensity_range = get_intensity_range(img_arr)
+
+    if lazy:
+        annotated_scan = AnnotatedVolume(
+            img_arr, mask_arrs, label_arr, lut, intensity_range, mode, background_label, outline_color
+        )
+        return annotated_scan, colors
+
+    if chunk_size is None:
+        chunk_size = len(img_arr)
+
+    annotated_scan = np.empty((*img_arr.shape, 3), dtype=np.uint8)
+    for start in range(0, len(img_arr), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        _annotate(
+            np.asarray(img_arr[chunk]),
+            [np.asarray(mask_arr[chunk]) for mask_arr in mask_arrs],
+            None if label_arr is None else np.asarray(label_arr[chunk]),
+            lut,
+            intensity_range,
+            mode,
+            background_label,
+            outline_color,
+            out=annotated_scan[chunk],
+        )
+    return annotated_scan, colors
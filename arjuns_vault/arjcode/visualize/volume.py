@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import numpy as np
+import SimpleITK as sitk
+
+
+def get_intensity_range(arr):
+    """Returns the (min, max) intensity of a volume. Cached for LazyVolumes, so it is only computed once per volume"""
+    if isinstance(arr, LazyVolume):
+        return arr.get_intensity_range()
+    return float(arr.min()), float(arr.max())
+
+
+class LazyVolume:
+    """
+    Read-only view of a 3D scan that loads slices on demand and keeps an LRU cache of recently used and neighboring
+    slices. Neighbors are prefetched in a background thread. Slices can be read along any axis of the (z, y, x) array
+    i.e. axial (0), coronal (1) and sagittal (2) planes.
+
+    Args:
+        source (np.ndarray, sitk.Image or str): Array-like (including np.memmap), SimpleITK image, or path to a .npy
+            file (memory-mapped), a NIfTI file (read lazily through nibabel) or any other SimpleITK-readable file
+            (streamed slice by slice where the format supports it)
+        cache_size (int, optional): Maximum number of slices kept in memory. Defaults to 32.
+        prefetch (int, optional): Number of slices on either side of the requested slice to load in the background.
+            Defaults to 4.
+    """
+
+    def __init__(self, source, cache_size: int = 32, prefetch: int = 4):
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+
+        self._array = None
+        self._image = None
+        self._reader = None
+        self._nifti = None
+
+        if isinstance(source, str):
+            if source.endswith(".npy"):
+                source = np.load(source, mmap_mode="r")
+            elif source.endswith((".nii", ".nii.gz")):
+                import nibabel as nib
+
+                nifti = nib.load(source)
+                self._nifti = nifti.dataobj
+                # Reverse the axes to match the (z, y, x) order of SimpleITK arrays
+                self.shape = tuple(reversed(self._nifti.shape))
+                self.spacing = tuple(float(zoom) for zoom in reversed(nifti.header.get_zooms()[:3]))
+            else:
+                self._reader = sitk.ImageFileReader()
+                self._reader.SetFileName(source)
+                self._reader.ReadImageInformation()
+                self.shape = tuple(reversed(self._reader.GetSize()))
+                self.spacing = tuple(reversed(self._reader.GetSpacing()))
+
+        if isinstance(source, sitk.Image):
+            self._image = source
+            self.shape = tuple(reversed(source.GetSize()))
+            self.spacing = tuple(reversed(source.GetSpacing()))
+        elif not isinstance(source, str):
+            # np.ndarray, np.memmap or any other array-like such as an AnnotatedVolume
+            self._array = source
+            self.shape = tuple(source.shape)
+            self.spacing = (1.0,) * 3
+
+        self.ndim = len(self.shape)
+
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        self._read_lock = Lock()
+        self._executor = None
+        self._latest = None
+        self._intensity_range = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_intensity_range(self):
+        """Returns the (min, max) intensity of the volume, computed with a single pass over the slices the first time"""
+        if self._intensity_range is None:
+            if isinstance(self._array, np.ndarray):
+                self._intensity_range = float(self._array.min()), float(self._array.max())
+            else:
+                lo, hi = np.inf, -np.inf
+                for z in range(len(self)):
+                    slc = self._read_slice(0, z)
+                    lo, hi = min(lo, float(slc.min())), max(hi, float(slc.max()))
+                self._intensity_range = lo, hi
+        return self._intensity_range
+
+    def _read_slice(self, axis: int, index: int):
+        if self._array is not None:
+            if axis == 0:
+                return np.asarray(self._array[index])
+            return np.asarray(self._array[(slice(None),) * axis + (index,)])
+
+        # SimpleITK and nibabel index their dimensions in the reverse order of the array
+        dim = 2 - axis
+        location = (slice(None),) * dim + (index,)
+
+        # SimpleITK readers and nibabel file handles are not thread-safe
+        with self._read_lock:
+            if self._image is not None:
+                return sitk.GetArrayFromImage(self._image[location])
+            if self._nifti is not None:
+                return np.asarray(self._nifti[location]).T
+            return self._read_file_slice(dim, index)
+
+    def _read_file_slice(self, dim: int, index: int):
+        size = list(self._reader.GetSize())
+        extract_index = [0] * len(size)
+        size[dim] = 0  # Collapse the dimension
+        extract_index[dim] = index
+        self._reader.SetExtractSize(size)
+        self._reader.SetExtractIndex(extract_index)
+        return sitk.GetArrayFromImage(self._reader.Execute())
+
+    def _load(self, axis: int, index: int):
+        key = (axis, index)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        slc = self._read_slice(axis, index)
+
+        with self._lock:
+            self._cache[key] = slc
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return slc
+
+    def _prefetch(self, axis: int, index: int):
+        for offset in range(1, self.prefetch + 1):
+            for neighbor in (index + offset, index - offset):
+                if self._latest != (axis, index):
+                    # A newer slice has been requested in the meantime
+                    return
+                if 0 <= neighbor < self.shape[axis]:
+                    with self._lock:
+                        cached = (axis, neighbor) in self._cache
+                    if not cached:
+                        self._load(axis, neighbor)
+
+    def get_slice(self, index: int, axis: int = 0):
+        """
+        Args:
+            index (int): Index of the slice
+            axis (int, optional): 0 for axial, 1 for coronal and 2 for sagittal slices. Defaults to 0.
+
+        Returns:
+            np.ndarray: 2D slice (or 3D for multi-channel volumes)
+        """
+        if index < 0:
+            index += self.shape[axis]
+        slc = self._load(axis, index)
+
+        self._latest = (axis, index)
+        if self.prefetch > 0:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="LazyVolume")
+            self._executor.submit(self._prefetch, axis, index)
+        return slc
+
+    def __getitem__(self, index: int):
+        return self.get_slice(index)
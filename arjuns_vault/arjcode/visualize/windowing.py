@@ -0,0 +1,62 @@
+from functools import lru_cache
+
+import numpy as np
+
+# (level, width) in Hounsfield units
+WINDOW_PRESETS = {
+    "lung": (-600, 1500),
+    "mediastinum": (50, 350),
+    "bone": (400, 1800),
+    "brain": (40, 80),
+    "soft_tissue": (40, 400),
+}
+
+
+def get_window_range(window):
+    """
+    Args:
+        window (str or tuple[float, float]): Name of a preset in WINDOW_PRESETS or a (level, width) tuple
+
+    Returns:
+        tuple[float, float]: Intensities mapped to black and white
+    """
+    if isinstance(window, str):
+        assert window in WINDOW_PRESETS, f"Unknown window preset: {window}. Choose from {list(WINDOW_PRESETS)}"
+        window = WINDOW_PRESETS[window]
+    level, width = window
+    return level - width / 2, level + width / 2
+
+
+@lru_cache(maxsize=32)
+def _get_lut(dtype: str, lo: float, hi: float):
+    info = np.iinfo(dtype)
+    values = np.arange(info.min, info.max + 1, dtype=np.float32)
+    return np.clip((values - lo) * (255 / max(hi - lo, 1e-6)), 0, 255).astype(np.uint8)
+
+
+def to_uint8(arr: np.ndarray, intensity_range: tuple[float, float]):
+    """
+    Linearly maps intensities in `intensity_range` to [0, 255] and clips the rest. 8 and 16 bit integer arrays (e.g. CT
+    scans) go through a cached lookup table, so switching between windows never recomputes anything per voxel.
+
+    Args:
+        arr (np.ndarray): Image or slice
+        intensity_range (tuple[float, float]): Intensities mapped to black and white
+
+    Returns:
+        np.ndarray: uint8 image
+    """
+    lo, hi = intensity_range
+    if arr.dtype.kind in "iu" and arr.dtype.itemsize <= 2:
+        # Big-endian arrays (e.g. from some NIfTI and DICOM files) would be indexed by their byte-swapped values
+        arr = arr.astype(arr.dtype.newbyteorder("="), copy=False)
+        lut = _get_lut(arr.dtype.str, float(lo), float(hi))
+        if arr.dtype.kind == "i":
+            # Shift signed values to the [0, 2**bits) index range of the table without upcasting
+            unsigned = np.dtype(f"u{arr.dtype.itemsize}")
+            arr = arr.view(unsigned) ^ unsigned.type(1 << (8 * arr.dtype.itemsize - 1))
+        return lut[arr]
+
+    gray = np.subtract(arr, lo, dtype=np.float32)
+    gray *= 255 / max(hi - lo, 1e-6)
+    return np.clip(gray, 0, 255, out=gray).astype(np.uint8)
@@ -4,102 +4,520 @@ Bot user OAuth Access Token: <ENTER_BOT_USER_OAUTH_ACCESS_TOKEN_HERE>
 """
 
 import argparse
+import hashlib
+import json
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from threading import Thread
 from time import sleep, time
 
 from clearml import Task
 from clearml.automation.monitor import Monitor
+from clearml.backend_api.services import events
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
 SLACK_API_TOKEN = "<ENTER_BOT_USER_OAUTH_ACCESS_TOKEN_HERE>"
 SLACK_CHANNEL = "<ENTER_CHANNEL_NAME_HERE>"
 
+# Limits of the Slack API for a section block and for the number of blocks in a message
+SLACK_MAX_BLOCK_LENGTH = 3000
+SLACK_MAX_BLOCKS = 50
+
+
+def split_text(text, max_length=SLACK_MAX_BLOCK_LENGTH):
+    """Splits a text into pieces of at most `max_length` characters. A ``` code fence open where the text is split is
+    closed at the end of the piece and reopened at the start of the next one, so that every piece renders on its own."""
+    if len(text) <= max_length:
+        return [text]
+    # Room for the fences added around a piece
+    max_length -= len("```\n") + len("\n```")
+    pieces = []
+    in_fence = False
+    start = 0
+    while start < len(text):
+        end = min(start + max_length, len(text))
+        # Never cut through a fence marker
+        while start + 1 < end < len(text) and text[end - 1] == "`":
+            end -= 1
+        piece = text[start:end]
+        opened = in_fence
+        in_fence ^= piece.count("```") % 2 == 1
+        pieces.append(("```\n" if opened else "") + piece + ("\n```" if in_fence and end < len(text) else ""))
+        start = end
+    return pieces
+
+
+def chunk_blocks(texts, max_block_length=SLACK_MAX_BLOCK_LENGTH, max_blocks=SLACK_MAX_BLOCKS):
+    """Packs texts into as few messages as possible, each a list of at most `max_blocks` section texts of at most
+    `max_block_length` characters. Texts are merged into a block while they fit, and longer texts are split."""
+    blocks = []
+    for text in texts:
+        for piece in split_text(text, max_block_length):
+            if blocks and len(blocks[-1]) + 2 + len(piece) <= max_block_length:
+                blocks[-1] = f"{blocks[-1]}\n\n{piece}"
+            else:
+                blocks.append(piece)
+    return [blocks[start : start + max_blocks] for start in range(0, len(blocks), max_blocks)]
+
+
+class SlackPoster:
+    """
+    Posts messages to Slack from a background thread so that the monitoring loop never waits on Slack. Messages are
+    posted in order, at most one every `min_interval` seconds, and failed posts are retried with exponential backoff
+    (or after the delay requested by Slack when rate limited).
+    """
+
+    def __init__(self, slack_client, channel, min_interval=1.0, initial_backoff=1.0, max_backoff=300.0):
+        self.slack_client = slack_client
+        self.channel = channel
+        self.min_interval = min_interval
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+        self.queue = Queue()
+        self.last_post_timestamp = 0.0
+        Thread(target=self._run, daemon=True, name="SlackPoster").start()
+
+    def post(self, msg, retries=5):
+        """
+        Args:
+            msg (str or list[str]): Message, or the texts of the section blocks of a message
+            retries (int, optional): Number of attempts. Defaults to 5.
+        """
+        self.queue.put(([msg] if isinstance(msg, str) else msg, retries))
+
+    def join(self):
+        """Waits until all queued messages have been posted (or have failed)"""
+        self.queue.join()
+
+    def _get_backoff(self, error, attempt):
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        retry_after = headers.get("Retry-After", headers.get("retry-after"))
+        if retry_after is not None:
+            return float(retry_after)
+        return min(self.initial_backoff * 2**attempt, self.max_backoff)
+
+    def _run(self):
+        while True:
+            texts, retries = self.queue.get()
+            try:
+                for attempt in range(retries):
+                    sleep(max(0.0, self.last_post_timestamp + self.min_interval - time()))
+                    self.last_post_timestamp = time()
+                    try:
+                        self.slack_client.chat_postMessage(
+                            channel=self.channel,
+                            blocks=[dict(type="section", text={"type": "mrkdwn", "text": text}) for text in texts],
+                            # text="Could not render message.",
+                        )
+                        break
+                    except Exception as e:
+                        # Connection errors and timeouts are retried like Slack API errors, so the thread never dies
+                        error = e.response["error"] if isinstance(e, SlackApiError) else repr(e)
+                        msg = "\n".join(texts)
+                        print(f'While trying to send message: "\n{msg}\n"\nGot an error: {error}')
+                        if attempt + 1 < retries:
+                            sleep(self._get_backoff(e, attempt))
+            finally:
+                self.queue.task_done()
+
+
+class TaskProgress:
+    """
+    Progress model of a task. Throughput (iterations per second) is tracked by a fast and a slow exponentially weighted
+    moving average. The task is considered slowed down when the fast average drops below `slowdown_fraction` of the
+    slow one, which catches slowed down tasks (e.g. by a dataloader bottleneck) and not only stalled ones.
+
+    ClearML reports iterations in bursts, so the model is only updated when the iteration changes, with the rate over
+    the time since the previous change. A task is also considered stalled when its iteration has not changed for longer
+    than the usual time between changes divided by `slowdown_fraction`.
+    """
+
+    def __init__(self, fast_alpha=0.3, slow_alpha=0.05, slowdown_fraction=0.5, min_updates=5):
+        self.fast_alpha = fast_alpha
+        self.slow_alpha = slow_alpha
+        self.slowdown_fraction = slowdown_fraction
+        self.min_updates = min_updates
+
+        self.iteration = None
+        self.timestamp = None
+        self.fast_rate = None
+        self.slow_rate = None
+        # Average time between changes of the iteration
+        self.interval = None
+        self.num_updates = 0
+        self.slowed_down = False
+
+    def update(self, iteration, timestamp):
+        if self.iteration is not None and (iteration == self.iteration or timestamp <= self.timestamp):
+            return
+        if self.iteration is not None:
+            interval = timestamp - self.timestamp
+            rate = max(iteration - self.iteration, 0) / interval
+            if self.fast_rate is None:
+                self.fast_rate = self.slow_rate = rate
+                self.interval = interval
+            else:
+                self.fast_rate += self.fast_alpha * (rate - self.fast_rate)
+                self.slow_rate += self.slow_alpha * (rate - self.slow_rate)
+                self.interval += self.slow_alpha * (interval - self.interval)
+            self.num_updates += 1
+        self.iteration = iteration
+        self.timestamp = timestamp
+
+    def is_stalled(self, timestamp):
+        return (
+            self.num_updates >= self.min_updates
+            and self.interval is not None
+            and timestamp - self.timestamp > self.interval / self.slowdown_fraction
+        )
+
+    def is_slow(self, timestamp):
+        return self.is_stalled(timestamp) or (
+            self.num_updates >= self.min_updates
+            and self.slow_rate > 0
+            and self.fast_rate < self.slowdown_fraction * self.slow_rate
+        )
+
+    def get_eta(self, total_iterations):
+        """Returns the estimated number of seconds left, or None if it cannot be estimated"""
+        if total_iterations is None or not self.fast_rate:
+            return None
+        return max(total_iterations - self.iteration, 0) / self.fast_rate
+
+    def state_dict(self):
+        return {
+            key: getattr(self, key)
+            for key in ("iteration", "timestamp", "fast_rate", "slow_rate", "interval", "num_updates", "slowed_down")
+        }
+
+    def load_state_dict(self, state_dict):
+        for key, value in state_dict.items():
+            setattr(self, key, value)
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds / 3600:.1f}h"
+
 
 class SlackMonitor(Monitor):
-    def __init__(self, min_num_iterations, update_frequency):
+    """
+    Posts Slack alerts for new, ongoing and ended ClearML tasks. All the tasks of a poll are fetched with one query per
+    status, the per-task requests run concurrently in a thread pool, static task metadata (project name and URL) is
+    cached, and messages are posted in the background by a SlackPoster.
+
+    Console output is tailed incrementally: only the reports newer than the last one seen are fetched for each task.
+    All the alerts of a poll are batched into as few Slack messages as the Slack limits allow, and ongoing tasks whose
+    progress and console output have not changed since the last update are only listed by name.
+
+    `slack_client` and `task_api` can be replaced by local stand-ins (objects with `chat_postMessage`, and with
+    `get_tasks` respectively) to run the monitor without Slack or a ClearML server. Console reports are fetched by
+    `_get_console_reports`, which stand-ins can override.
+
+    If `state_path` is given, the monitored tasks, console cursors and progress models are saved there after every
+    step and restored on start, so that a restart does not re-announce every running task. Throughput slowdowns are
+    alerted as soon as they are detected, and per-task metrics are served in the Prometheus text format on
+    `metrics_port` if it is given.
+    """
+
+    def __init__(
+        self,
+        min_num_iterations,
+        update_frequency,
+        slack_client=None,
+        task_api=Task,
+        num_workers=16,
+        slack_min_interval=1.0,
+        state_path=None,
+        slowdown_fraction=0.5,
+        total_iterations_param=None,
+        metrics_port=None,
+    ):
         super().__init__()
 
-        self.slack_client = WebClient(token=SLACK_API_TOKEN)
+        if slack_client is None:
+            slack_client = WebClient(token=SLACK_API_TOKEN)
+        self.slack_poster = SlackPoster(slack_client, SLACK_CHANNEL, min_interval=slack_min_interval)
+        self.task_api = task_api
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="SlackMonitor")
 
         self.min_num_iterations = min_num_iterations
         self.update_frequency = update_frequency
 
         self.tasks_being_monitored = {}
+        self.task_metadata = {}
+        self.console_cursors = {}
+        self.console_tails = {}
+        self.task_digests = {}
+        self.task_progress = {}
         self.last_ongoing_alert_timestamp = time()
 
-    @staticmethod
-    def remove_ansi(msg):
-        remove_ansi_re = re.compile(r"(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]")
-        return remove_ansi_re.sub("", msg)
+        self.slowdown_fraction = slowdown_fraction
+        self.total_iterations_param = total_iterations_param
+        self.step_duration = 0.0
+
+        self.state_path = state_path
+        if state_path is not None and os.path.exists(state_path):
+            self.load_state()
+
+        if metrics_port is not None:
+            self.start_metrics_server(metrics_port)
+
+    remove_ansi_re = re.compile(r"(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]")
+
+    @classmethod
+    def remove_ansi(cls, msg):
+        return cls.remove_ansi_re.sub("", msg)
 
     def _get_universal_filters(self):
         return {
             "project": self._get_projects_ids(),
         }
 
-    def _get_formatted_console_output(self, task, limit=2**11):
-        console_output = task.get_reported_console_output(number_of_reports=3)
-        console_output = "\n".join(console_output)
-        console_output = self.remove_ansi(console_output)
-        return console_output[-limit:]
+    @staticmethod
+    def _parse_iterations(value):
+        # Parameters are free-form strings ("", "None", "1e5", ...), and a bad one must not abort the alerts
+        try:
+            return int(float(value))
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    def _get_metadata(self, task):
+        # The project, URL and length of a task never change, so they are only fetched once per task
+        if task.id not in self.task_metadata:
+            total_iterations = None
+            if self.total_iterations_param is not None:
+                total_iterations = self._parse_iterations(task.get_parameter(self.total_iterations_param))
+            self.task_metadata[task.id] = (
+                task.get_project_name(),
+                task.get_output_log_web_page(),
+                task.name,
+                total_iterations,
+            )
+        return self.task_metadata[task.id]
+
+    def save_state(self):
+        state = {
+            "tasks_being_monitored": self.tasks_being_monitored,
+            "task_metadata": self.task_metadata,
+            "console_cursors": self.console_cursors,
+            "console_tails": self.console_tails,
+            "task_digests": self.task_digests,
+            "task_progress": {task_id: progress.state_dict() for task_id, progress in self.task_progress.items()},
+            "last_ongoing_alert_timestamp": self.last_ongoing_alert_timestamp,
+        }
+        # Write to a temporary file first so that a crash while saving never corrupts the state
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def load_state(self):
+        with open(self.state_path) as f:
+            state = json.load(f)
+        self.tasks_being_monitored = state["tasks_being_monitored"]
+        self.task_metadata = {task_id: tuple(metadata) for task_id, metadata in state["task_metadata"].items()}
+        # Cursors are (timestamp, number of reports seen at that timestamp), older states only have the timestamp
+        self.console_cursors = {
+            task_id: tuple(cursor) if isinstance(cursor, list) else (cursor, 0)
+            for task_id, cursor in state["console_cursors"].items()
+        }
+        self.console_tails = state["console_tails"]
+        self.task_digests = state["task_digests"]
+        for task_id, progress_state in state["task_progress"].items():
+            self.task_progress[task_id] = TaskProgress(slowdown_fraction=self.slowdown_fraction)
+            self.task_progress[task_id].load_state_dict(progress_state)
+        self.last_ongoing_alert_timestamp = state["last_ongoing_alert_timestamp"]
+        print(f"Restored the state of {len(self.tasks_being_monitored)} monitored tasks from {self.state_path}")
+
+    def get_metrics(self):
+        """Returns the metrics of the monitored tasks in the Prometheus text format"""
+
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        lines = [
+            "# TYPE slack_monitor_tasks_monitored gauge",
+            f"slack_monitor_tasks_monitored {len(self.tasks_being_monitored)}",
+            "# TYPE slack_monitor_step_duration_seconds gauge",
+            f"slack_monitor_step_duration_seconds {self.step_duration}",
+        ]
+        samples = {
+            "slack_monitor_task_iteration": [],
+            "slack_monitor_task_iterations_per_second": [],
+            "slack_monitor_task_eta_seconds": [],
+            "slack_monitor_task_slowed_down": [],
+        }
+        for task_id, progress in list(self.task_progress.items()):
+            # The metadata of a task can be dropped by the monitor thread at any time
+            metadata = self.task_metadata.get(task_id)
+            if metadata is None or progress.iteration is None:
+                continue
+            project_name, _, name, total_iterations = metadata
+            labels = f'task_id="{escape(task_id)}",task_name="{escape(name)}",project="{escape(project_name)}"'
+            samples["slack_monitor_task_iteration"].append(f"{{{labels}}} {progress.iteration}")
+            if progress.fast_rate is not None:
+                samples["slack_monitor_task_iterations_per_second"].append(f"{{{labels}}} {progress.fast_rate}")
+            eta = progress.get_eta(total_iterations)
+            if eta is not None:
+                samples["slack_monitor_task_eta_seconds"].append(f"{{{labels}}} {eta}")
+            samples["slack_monitor_task_slowed_down"].append(f"{{{labels}}} {int(progress.slowed_down)}")
+        for metric, metric_samples in samples.items():
+            lines.append(f"# TYPE {metric} gauge")
+            lines += [f"{metric}{sample}" for sample in metric_samples]
+        return "\n".join(lines) + "\n"
+
+    def start_metrics_server(self, port):
+        monitor = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = monitor.get_metrics().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), MetricsHandler)
+        Thread(target=server.serve_forever, daemon=True, name="MetricsServer").start()
+        print(f"Serving metrics on port {port}")
+        return server
+
+    def _get_console_reports(self, task, from_timestamp=None, batch_size=100):
+        """Returns the (timestamp, message) of the console reports of a task in chronological order. Without
+        `from_timestamp`, the last `batch_size` reports. Otherwise, the first `batch_size` reports after it."""
+        if from_timestamp is None:
+            request = events.GetTaskLogRequest(task=task.id, order="asc", navigate_earlier=True, batch_size=batch_size)
+        else:
+            request = events.GetTaskLogRequest(
+                task=task.id, order="asc", navigate_earlier=False, from_timestamp=from_timestamp, batch_size=batch_size
+            )
+        response = task.send(request).wait()
+        if not response.ok():
+            return []
+        return [(event["timestamp"], event.get("msg", "")) for event in response.response_data.get("events") or []]
+
+    @staticmethod
+    def _advance_cursor(cursor, reports):
+        """Returns the cursor after `reports`: the timestamp of the last report and the number of reports seen with that
+        timestamp, as several lines can share a timestamp"""
+        timestamp = reports[-1][0]
+        n_seen = sum(report[0] == timestamp for report in reports)
+        if cursor is not None and cursor[0] == timestamp:
+            n_seen += cursor[1]
+        return (timestamp, n_seen)
+
+    def _get_formatted_console_output(self, task, limit=2**11, batch_size=100, max_batches=10):
+        cursor = self.console_cursors.get(task.id)
+        tail = self.console_tails.get(task.id, "")
+        if cursor is None:
+            reports = self._get_console_reports(task, batch_size=3)
+        else:
+            reports = []
+            for _ in range(max_batches):
+                # The reports already seen at the cursor timestamp come first, so the batch is enlarged to skip them
+                n_skip = cursor[1]
+                n_requested = batch_size + n_skip
+                fetched = self._get_console_reports(task, cursor[0], n_requested)
+                batch = []
+                for report in fetched:
+                    if report[0] < cursor[0] or (report[0] == cursor[0] and n_skip > 0):
+                        n_skip -= report[0] == cursor[0]
+                        continue
+                    batch.append(report)
+                if not batch:
+                    break
+                reports += batch
+                cursor = self._advance_cursor(cursor, batch)
+                if len(fetched) < n_requested:
+                    break
+            else:
+                # Too far behind, the last few reports are enough
+                reports = self._get_console_reports(task, batch_size=3)
+                tail = ""
+                cursor = None
+
+        if reports:
+            self.console_cursors[task.id] = cursor if cursor is not None else self._advance_cursor(None, reports)
+            lines = [tail] if tail else []
+            lines += [self.remove_ansi(msg) for _, msg in reports]
+            self.console_tails[task.id] = "\n".join(lines)[-limit:]
+        return self.console_tails.get(task.id, "")
 
     def _get_task_details(self, task):
+        project_name, url, _, _ = self._get_metadata(task)
         return (
-            f"Project:\t\t\t{task.get_project_name()}\n"
-            f"Experiment:\t<{task.get_output_log_web_page()}|{task.name}>\n"
+            f"Project:\t\t\t{project_name}\n"
+            f"Experiment:\t<{url}|{task.name}>\n"
             "Console output:\n"
             f"```\n{self._get_formatted_console_output(task)}\n```"
         )
 
-    def monitor_new(self):
-        # Define the filters
+    def _forget(self, task_id):
+        for cache in (
+            self.task_metadata,
+            self.console_cursors,
+            self.console_tails,
+            self.task_digests,
+            self.task_progress,
+        ):
+            cache.pop(task_id, None)
+
+    def _map(self, fn, tasks):
+        """Runs `fn` on all tasks concurrently, returning the results in the same order"""
+        return list(self.executor.map(fn, tasks))
+
+    def _get_tasks(self, statuses, task_ids=None):
         filters = self._get_universal_filters()
-        filters.update({"status": ["in_progress"]})
-
-        # Get all relevant tasks
-        tasks: list[Task] = Task.get_tasks(task_filter=filters)
-
-        for task in tasks:
-            # Check if the task is already being monitored
-            if task.id in self.tasks_being_monitored:
-                continue
-
-            # Check if required number of iterations is completed
-            if self.min_num_iterations and task.get_last_iteration() < self.min_num_iterations:
-                continue
-
-            # Post on Slack
+        filters.update({"status": statuses})
+        return self.task_api.get_tasks(task_ids=task_ids, task_filter=filters)
+
+    def monitor_new(self, tasks, last_iterations):
+        # Check if the task is already being monitored and if required number of iterations is completed
+        tasks = [
+            task
+            for task in tasks
+            if task.id not in self.tasks_being_monitored
+            and not (self.min_num_iterations and last_iterations[task.id] < self.min_num_iterations)
+        ]
+
+        sections = []
+        for task, details in zip(tasks, self._map(self._get_task_details, tasks)):
             divider = "-----------------------"
             header = ":large_purple_circle: *NEW TASK* :large_purple_circle:"
-            details = self._get_task_details(task)
+            sections.append(f"{divider}\n{header}\n{divider}\n\n{details}")
 
-            msg = f"{divider}\n{header}\n{divider}\n\n{details}"
-            self.post_message(msg, retries=5)
-
-            print(f"Message posted for experiment {task.get_project_name()} - {task.name}")
+            print(f"Alert queued for experiment {self._get_metadata(task)[0]} - {task.name}")
 
             # Add to the set of tasks to be monitored
-            self.tasks_being_monitored[task.id] = task.get_last_iteration()
+            self.tasks_being_monitored[task.id] = last_iterations[task.id]
+
+        return sections
 
     def monitor_ended(self):
         # Can only alert for those tasks which were already being monitored
         if len(self.tasks_being_monitored) == 0:
-            return
-
-        # Define the filters
-        allowed_statuses = ["completed", "failed", "stopped"]
-        filters = self._get_universal_filters()
-        filters.update({"status": allowed_statuses})
+            return []
 
         # Get all relevant tasks
-        tasks: list[Task] = Task.get_tasks(task_ids=list(self.tasks_being_monitored.keys()), task_filter=filters)
-
-        for task in tasks:
-            if task.status not in allowed_statuses:
-                continue
+        allowed_statuses = ["completed", "failed", "stopped"]
+        tasks: list[Task] = self._get_tasks(allowed_statuses, task_ids=list(self.tasks_being_monitored.keys()))
+        tasks = [task for task in tasks if task.status in allowed_statuses]
 
-            # Post on Slack
+        sections = []
+        for task, details in zip(tasks, self._map(self._get_task_details, tasks)):
             divider = ""
             header = ""
             if task.status == "completed":
@@ -111,72 +529,143 @@ class SlackMonitor(Monitor):
             else:
                 divider = "-----------------------------"
                 header = ":large_blue_circle: *TASK ABORTED* :large_blue_circle:"
-            details = self._get_task_details(task)
 
-            msg = f"{divider}\n{header}\n{divider}\n\n{details}"
-            self.post_message(msg, retries=5)
+            sections.append(f"{divider}\n{header}\n{divider}\n\n{details}")
 
-            print(f"Message posted for experiment {task.get_project_name()} - {task.name}")
+            print(f"Alert queued for experiment {self._get_metadata(task)[0]} - {task.name}")
 
             # Remove from the set of tasks to be monitored
             self.tasks_being_monitored.pop(task.id)
+            self._forget(task.id)
 
-    def monitor_ongoing(self):
-        # Define the filters
-        filters = self._get_universal_filters()
-        filters.update({"status": ["in_progress"]})
-
-        # Get all relevant tasks
-        tasks: list[Task] = Task.get_tasks(task_ids=list(self.tasks_being_monitored.keys()), task_filter=filters)
+        return sections
 
-        if len(tasks):
-            # Post heading on Slack
-            divider = "-------------------------------"
-            header = ":large_orange_circle: *ONGOING TASKS* :large_orange_circle:"
-            msg = f"{divider}\n{header}\n{divider}\n"
-            self.post_message(msg, retries=5)
+    def monitor_ongoing(self, tasks, last_iterations):
+        tasks = [task for task in tasks if task.id in self.tasks_being_monitored]
+        if not len(tasks):
+            return []
 
-            for task in tasks:
-                # Post on Slack
-                warning = ""
-                if task.get_last_iteration() == self.tasks_being_monitored[task.id]:
-                    warning = ":warning: ALERT :warning:\nNo progress since last alert"
-                details = self._get_task_details(task)
+        divider = "-------------------------------"
+        header = ":large_orange_circle: *ONGOING TASKS* :large_orange_circle:"
+        sections = [f"{divider}\n{header}\n{divider}\n"]
 
-                msg = f"{warning}\n{details}"
-                self.post_message(msg, retries=5)
+        unchanged = []
+        for task, details in zip(tasks, self._map(self._get_task_details, tasks)):
+            warning = ""
+            if last_iterations[task.id] == self.tasks_being_monitored[task.id]:
+                warning = ":warning: ALERT :warning:\nNo progress since last alert"
 
-                print(f"Message posted for experiment {task.get_project_name()} - {task.name}")
+            # Tasks whose alert would be identical to the previous one are only listed
+            digest = hashlib.blake2b(f"{warning}\n{details}".encode(), digest_size=16).hexdigest()
+            if self.task_digests.get(task.id) == digest:
+                unchanged.append(task)
+            else:
+                sections.append(f"{warning}\n{details}\n{self._get_progress_summary(task)}")
+                self.task_digests[task.id] = digest
+                print(f"Alert queued for experiment {self._get_metadata(task)[0]} - {task.name}")
 
-                # Add to the set of tasks to be monitored
-                self.tasks_being_monitored[task.id] = task.get_last_iteration()
+            # Add to the set of tasks to be monitored
+            self.tasks_being_monitored[task.id] = last_iterations[task.id]
+
+        if unchanged:
+            names = ", ".join(f"<{self._get_metadata(task)[1]}|{task.name}>" for task in unchanged)
+            sections.append(f":warning: ALERT :warning:\nNo change since last alert: {names}")
+
+        return sections
+
+    def _get_progress_summary(self, task):
+        progress = self.task_progress.get(task.id)
+        if progress is None or progress.fast_rate is None:
+            return ""
+        summary = f"Progress:\t\titeration {progress.iteration}, {progress.fast_rate:.3g} it/s"
+        eta = progress.get_eta(self._get_metadata(task)[3])
+        if eta is not None:
+            summary += f", ETA {format_duration(eta)}"
+        return summary
+
+    def monitor_progress(self, tasks, last_iterations):
+        """Updates the progress models of the monitored tasks and alerts on throughput slowdowns"""
+        sections = []
+        for task in tasks:
+            if task.id not in self.tasks_being_monitored:
+                continue
+            if task.id not in self.task_progress:
+                self.task_progress[task.id] = TaskProgress(slowdown_fraction=self.slowdown_fraction)
+            progress = self.task_progress[task.id]
+            progress.update(last_iterations[task.id], self._timestamp)
+
+            # Alert once when the task slows down, and again only after it has recovered
+            is_slow = progress.is_slow(self._timestamp)
+            if is_slow and not progress.slowed_down:
+                project_name, url, _, _ = self._get_metadata(task)
+                if progress.is_stalled(self._timestamp):
+                    details = f"No progress for {format_duration(self._timestamp - progress.timestamp)}"
+                else:
+                    details = f"Throughput dropped to {progress.fast_rate:.3g} it/s from {progress.slow_rate:.3g} it/s"
+                sections.append(
+                    ":snail: *SLOWDOWN* :snail:\n"
+                    f"Project:\t\t\t{project_name}\n"
+                    f"Experiment:\t<{url}|{task.name}>\n"
+                    f"{details}"
+                )
+                print(f"Alert queued for experiment {project_name} - {task.name}")
+            progress.slowed_down = is_slow
+        return sections
 
     def monitor_step(self):
         # Monitor tasks that have ended
-        self.monitor_ended()
+        sections = self.monitor_ended()
+
+        # New and ongoing tasks are found with a single query, and their progress is fetched concurrently
+        tasks: list[Task] = self._get_tasks(["in_progress"])
+        last_iterations = dict(
+            zip([task.id for task in tasks], self._map(lambda task: task.get_last_iteration(), tasks))
+        )
 
         # Monitor new tasks
-        self.monitor_new()
+        sections += self.monitor_new(tasks, last_iterations)
+
+        # Monitor the throughput of all tasks every step
+        sections += self.monitor_progress(tasks, last_iterations)
 
         # Monitor tasks that are ongoing every self.update_frequency mins
         if self._timestamp - self.last_ongoing_alert_timestamp > self.update_frequency * 60:
-            self.monitor_ongoing()
+            sections += self.monitor_ongoing(tasks, last_iterations)
             self.last_ongoing_alert_timestamp = time()
 
-    def post_message(self, msg, retries, wait_period=10):
-        for i in range(retries):
-            if i != 0:
-                sleep(wait_period)
+        # Post all the alerts of this step together
+        for blocks in chunk_blocks(sections):
+            self.post_message(blocks, retries=5)
+
+        if self.state_path is not None:
+            self.save_state()
+        self.step_duration = time() - self._timestamp
 
+    def monitor(self, pool_period=15.0):
+        # Same as Monitor.monitor, except that the time taken by a step is deducted from the sleep so that steps start
+        # every pool_period seconds
+        self._setup()
+
+        self._timestamp = time()
+        last_report = self._timestamp
+
+        while True:
+            self._timestamp = time()
             try:
-                self.slack_client.chat_postMessage(
-                    channel=SLACK_CHANNEL,
-                    blocks=[dict(type="section", text={"type": "mrkdwn", "text": msg})],
-                    # text="Could not render message.",
-                )
-                return
-            except SlackApiError as e:
-                print(f'While trying to send message: "\n{msg}\n"\nGot an error: {e.response["error"]}')
+                self.monitor_step()
+            except Exception as ex:
+                print(f"Exception: {ex}")
+
+            # print I'm alive message every 15 minutes
+            if time() - last_report > 60.0 * 15:
+                print("Service is running")
+                last_report = time()
+
+            sleep(max(0.0, self._timestamp + pool_period - time()))
+
+    def post_message(self, msg, retries=5):
+        # Returns immediately, the message (a string or the texts of its blocks) is posted in the background
+        self.slack_poster.post(msg, retries)
 
 
 def main():
@@ -210,11 +699,44 @@ def main():
         default=10.0,
         help="Set refresh rate of the monitoring service, default every 10.0 sec",
     )
+    parser.add_argument(
+        "--state_path",
+        type=str,
+        default="slack_monitor_state.json",
+        help="File in which the monitor state is saved so that it survives restarts, use empty to disable "
+        "(default: slack_monitor_state.json)",
+    )
+    parser.add_argument(
+        "--slowdown_fraction",
+        type=float,
+        default=0.5,
+        help="Alert when the throughput of a task drops below this fraction of its usual throughput (default: 0.5)",
+    )
+    parser.add_argument(
+        "--total_iterations_param",
+        type=str,
+        default=None,
+        help="Name of the task parameter holding the total number of iterations, used to estimate the time to "
+        "completion e.g. Args/max_steps (default: no estimate)",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="Port on which to serve metrics in the Prometheus text format (default: disabled)",
+    )
 
     args = parser.parse_args()
 
     # create the slack monitoring object
-    slack_monitor = SlackMonitor(args.min_num_iterations, args.update_frequency)
+    slack_monitor = SlackMonitor(
+        args.min_num_iterations,
+        args.update_frequency,
+        state_path=args.state_path or None,
+        slowdown_fraction=args.slowdown_fraction,
+        total_iterations_param=args.total_iterations_param,
+        metrics_port=args.metrics_port,
+    )
 
     # configure the monitoring filters
     if args.projects:
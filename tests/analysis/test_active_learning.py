@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+from arjcode.analysis import UncertaintyOrder
+from arjcode.analysis.classifier_gui import _LabelState, _Prefetcher
+
+LABEL_GROUPS = {"Finding": ["Yes", "No"]}
+
+
+def _get_order():
+    rng = np.random.default_rng(0)
+    scores = pd.Series(rng.uniform(0, 1, 500), index=[f"id{i}" for i in range(500)])
+    return UncertaintyOrder(scores, 0.5, label_fn=lambda labels: labels["Finding"] == "Yes", bandwidth=0.1)
+
+
+def test_undo_reverts_update():
+    order = _get_order()
+    initial_margins = order.margins.copy()
+    key = order[0]
+    order.update(key, {"Finding": "No" if order.scores[order.position[key], 0] >= 0.5 else "Yes"})
+    assert not np.array_equal(order.margins, initial_margins)
+    order.undo()
+    np.testing.assert_array_equal(order.margins, initial_margins)
+
+
+def test_relabel_after_undo_matches_single_label():
+    relabelled, labelled = _get_order(), _get_order()
+    for order, n_labels in [(relabelled, 2), (labelled, 1)]:
+        key = order[0]
+        for _ in range(n_labels):
+            order.update(key, {"Finding": "Yes"})
+            order.undo()
+        order.update(key, {"Finding": "Yes"})
+    np.testing.assert_array_equal(relabelled.margins, labelled.margins)
+    assert relabelled[:20] == labelled[:20]
+
+
+def test_restore_replays_undos(tmp_path):
+    log_path = tmp_path / "session.jsonl"
+    live = _get_order()
+    state = _LabelState(LABEL_GROUPS, log_path)
+    for finding in ["Yes", "No", "Yes", None, "No", "Yes"]:
+        if finding is None:
+            state.pop()
+            live.undo()
+            continue
+        key = live[len(state)]
+        state.append(key, {"Finding": finding})
+        live.update(key, {"Finding": finding})
+    state.close()
+
+    resumed = _get_order()
+    replayed = _LabelState(LABEL_GROUPS, log_path)
+    resumed.restore(*map(list, zip(*replayed.replayed)))
+    replayed.close()
+    assert replayed.index == state.index
+    np.testing.assert_array_equal(resumed.margins, live.margins)
+    assert resumed[: len(state)] == state.index
+    assert resumed[:50] == live[:50]
+
+
+def test_replay_keeps_tuple_keys_and_drops_incomplete_line(tmp_path, capsys):
+    log_path = tmp_path / "session.jsonl"
+    state = _LabelState(LABEL_GROUPS, log_path)
+    state.append(("scan1", 3), {"Finding": "Yes"})
+    state.close()
+    with open(log_path, "a") as f:
+        f.write('{"op": "add", "ind')
+
+    # The line left incomplete by a crash is dropped when the session is resumed
+    resumed = _LabelState(LABEL_GROUPS, log_path)
+    resumed.append(("scan2", 0), {"Finding": "No"})
+    resumed.close()
+    replayed = _LabelState(LABEL_GROUPS, log_path)
+    replayed.close()
+    assert replayed.index == [("scan1", 3), ("scan2", 0)]
+    assert "corrupt" not in capsys.readouterr().out
+
+    # Corrupt lines in the middle of the log are reported
+    with open(log_path) as f:
+        lines = f.readlines()
+    with open(log_path, "w") as f:
+        f.writelines([lines[0], "not json\n", lines[1]])
+    replayed = _LabelState(LABEL_GROUPS)
+    replayed._replay(log_path)
+    assert replayed.index == [("scan1", 3), ("scan2", 0)]
+    assert "corrupt line 2" in capsys.readouterr().out
+
+
+def test_peek_does_not_serve():
+    order = _get_order()
+    upcoming = order.peek(0, 5)
+    assert order.served == []
+    assert order[:5] == upcoming
+    assert order.peek(3, 8) == order[3:8]
+
+
+def test_prefetching_keeps_reprioritized_order():
+    # Every label contradicts the model, so the datapoints near it move ahead of the prefetched ones
+    orders = {"prefetched": _get_order(), "direct": _get_order()}
+    loaded = []
+    prefetcher = _Prefetcher(orders["prefetched"], lambda key: loaded.append(key) or key, prefetch=4, num_workers=2)
+    for i in range(20):
+        for name, order in orders.items():
+            key = prefetcher.get(i) if name == "prefetched" else order[i]
+            assert key == order[i]
+            order.update(key, {"Finding": "No" if order.scores[order.position[key], 0] >= 0.5 else "Yes"})
+    prefetcher.executor.shutdown()
+    assert orders["prefetched"].served == orders["direct"].served
+    assert set(orders["prefetched"].served) <= set(loaded)
@@ -0,0 +1,90 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from arjcode.analysis import stratified_analysis, threshold_analysis
+
+pl = pytest.importorskip("polars")
+
+STRATIFIED_ARGS = [
+    dict(strata_cols=["site", "sex"]),
+    dict(),
+    dict(strata_cols=["site"], threshold=[0.5, ("site", {"A": 0.3})]),
+    dict(
+        strata_cols=["sex"],
+        threshold=0.4,
+        uncertainty_ranges=[(0.3, 0.5), (0.1, 0.2)],
+        table_columns=["Total", "AUC", "AUC 95% CI Lower", "AUC 95% CI Upper", "Sen 95% CI Lower", "Youden", "F1"],
+    ),
+]
+THRESHOLD_ARGS = [
+    dict(strata_cols=["site"]),
+    dict(),
+    dict(strata_cols=["site", "sex"], custom_thresholds=(0.33, 0.5)),
+    dict(pm_mode=True),
+]
+INPUTS = ["arrow", "polars", "lazy", "path"]
+
+
+@pytest.fixture(scope="module")
+def data(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    n = 5000
+    df = pd.DataFrame(
+        {
+            "site": rng.choice(["A", "B", "C", "D"], n),
+            "sex": rng.choice(["M", "F", None], n),
+            "y": rng.integers(0, 2, n).astype(float),
+        }
+    )
+    df.loc[rng.random(n) < 0.05, "y"] = np.nan
+    df["s"] = np.clip(rng.normal(0.3 + 0.4 * df["y"].fillna(0), 0.2), 0, 1).round(3)
+    df.loc[rng.random(n) < 0.05, "s"] = np.nan
+    # Few distinct scores in one stratum, and a single class in another
+    df.loc[df["site"] == "D", "s"] = df.loc[df["site"] == "D", "s"].round(0)
+    df.loc[(df["site"] == "C") & (df["y"] == 1), "y"] = 0
+
+    path = str(tmp_path_factory.mktemp("arrow") / "data.parquet")
+    df.to_parquet(path)
+    return df, path
+
+
+def _to_input(data, kind):
+    df, path = data
+    return {
+        "arrow": lambda: pa.Table.from_pandas(df),
+        "polars": lambda: pl.from_pandas(df),
+        "lazy": lambda: pl.scan_parquet(path),
+        "path": lambda: path,
+    }[kind]()
+
+
+def _assert_equal(expected, actual):
+    def normalize(df):
+        df = df.copy()
+        df.index = pd.MultiIndex.from_tuples(
+            [tuple(str(value) for value in (key if isinstance(key, tuple) else (key,))) for key in df.index]
+        )
+        return df
+
+    pd.testing.assert_frame_equal(normalize(expected), normalize(actual), check_dtype=False, rtol=1e-6)
+
+
+@pytest.mark.parametrize("kind", INPUTS)
+@pytest.mark.parametrize("args", STRATIFIED_ARGS)
+def test_stratified_parity(data, kind, args):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = stratified_analysis(data[0], "y", "s", return_df=True, **args)
+    _assert_equal(expected, stratified_analysis(_to_input(data, kind), "y", "s", return_df=True, **args))
+
+
+@pytest.mark.parametrize("kind", INPUTS)
+@pytest.mark.parametrize("args", THRESHOLD_ARGS)
+def test_threshold_parity(data, kind, args):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = threshold_analysis(data[0], "y", "s", return_df=True, **args)
+    _assert_equal(expected, threshold_analysis(_to_input(data, kind), "y", "s", return_df=True, **args))
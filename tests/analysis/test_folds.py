@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+from arjcode.analysis import fold_analysis, stratified_analysis
+
+
+def _get_data(n: int = 2000, n_folds: int = 5, n_seeds: int = 3, seed: int = 0):
+    # Every datapoint is predicted once per seed, by the model of its fold
+    rng = np.random.default_rng(seed)
+    gt = rng.integers(0, 2, n)
+    site = rng.choice(["A", "B"], n)
+    fold = np.arange(n) % n_folds
+    return pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "GT": gt,
+                    "Score": np.clip(gt * 0.3 + rng.normal(0.35, 0.2, n), 0, 1),
+                    "Site": site,
+                    "Fold": fold,
+                    "Seed": seed,
+                }
+            )
+            for seed in range(n_seeds)
+        ],
+        ignore_index=True,
+    )
+
+
+COLUMNS = ["Total", "AUC", "AUC 95% CI Lower", "AUC 95% CI Upper", "Sen 95% CI Lower"]
+
+
+def test_pooled_metrics_average_seeds():
+    data = _get_data()
+    table = fold_analysis(data, "GT", "Score", ["Fold"], ["Site"], seed_col="Seed", return_df=True)
+    assert list(table.index.names) == ["Site", "Fold", "Seed"]
+
+    for site in ["A", "B"]:
+        pooled = table.loc[(site, "Pooled", "")]
+        # Every datapoint counts once, and the CIs are those of one seed, not of the seeds taken as independent
+        per_seed = pd.concat(
+            [
+                stratified_analysis(
+                    data[data["Seed"] == seed], "GT", "Score", ["Site"], table_columns=COLUMNS, return_df=True
+                ).loc[[site]]
+                for seed in range(3)
+            ]
+        )
+        assert pooled["Total"] == (data["Site"] == site).sum() / 3
+        for colname in COLUMNS[1:]:
+            np.testing.assert_allclose(pooled[colname], per_seed[colname].mean(), rtol=1e-5, err_msg=colname)
+
+        replicated = fold_analysis(data, "GT", "Score", ["Fold", "Seed"], ["Site"], return_df=True)
+        replicated = replicated.loc[(site, "Pooled", "")]
+        assert replicated["AUC 95% CI Upper"] - replicated["AUC 95% CI Lower"] < (
+            pooled["AUC 95% CI Upper"] - pooled["AUC 95% CI Lower"]
+        )
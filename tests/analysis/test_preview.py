@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+from arjcode.analysis import get_preview_sample, preview_analysis
+
+
+def _get_data(n_rare_positives: int = 6, n_rare: int = 200_000, n_common: int = 200_000, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    gt = np.concatenate([rng.integers(0, 2, n_common), np.zeros(n_rare, dtype=int)])
+    gt[n_common + rng.choice(n_rare, n_rare_positives, replace=False)] = 1
+    scores = np.clip(gt * 0.3 + rng.normal(0.35, 0.2, len(gt)), 0, 1)
+    return pd.DataFrame({"GT": gt, "Score": scores, "Site": ["Common"] * n_common + ["Rare"] * n_rare})
+
+
+def test_rare_positives_keep_growing():
+    # The first sample of the rare stratum has no positives, so its Sen and AUC errors are unknown, not met
+    table = preview_analysis(_get_data(), "GT", "Score", ["Site"], target_ci_width=0.05, return_df=True)
+    rare = table.loc["Rare"]
+    assert rare["Sampled"] > 1000
+    for colname in ["Sen", "Sen Error", "AUC", "AUC Error"]:
+        assert not np.isnan(rare[colname]), colname
+
+
+def test_single_class_stratum_stops():
+    # A stratum without positives has no Sen or AUC to estimate, so only its Spec error is needed
+    data = _get_data(n_rare_positives=0)
+    sample = get_preview_sample(data, "GT", "Score", ["Site"], target_ci_width=0.05)
+    assert (sample["Site"] == "Rare").sum() < len(data) / 2
+
+
+def test_sample_is_subset_of_valid_rows():
+    data = _get_data()
+    data.loc[::7, "Score"] = np.nan
+    sample = get_preview_sample(data, "GT", "Score", ["Site"], target_ci_width=0.1)
+    assert sample.index.is_unique
+    assert sample.index.isin(data.index[data["Score"].notna()]).all()
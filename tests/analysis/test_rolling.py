@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+from arjcode.analysis import RollingEvaluation
+
+
+def _get_data(n: int = 128, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    gt = rng.integers(0, 2, n)
+    return pd.DataFrame(
+        {
+            "GT": gt,
+            "Score": np.clip(gt * 0.3 + rng.normal(0.35, 0.2, n), 0, 1),
+            "Time": pd.Timestamp("2026-01-01") + pd.to_timedelta(rng.integers(0, 3, n), unit="D"),
+        }
+    )
+
+
+def test_relabel_moves_unlabelled_datapoints():
+    data = _get_data()
+    labelled = RollingEvaluation("GT", "Score", "Time")
+    labelled.update(data)
+
+    late = RollingEvaluation("GT", "Score", "Time")
+    late.update(data.assign(GT=np.nan))
+    assert late.get_table()["Total"].sum() == 0
+    late.update(data, relabel=True)
+
+    pd.testing.assert_frame_equal(late.get_table(), labelled.get_table())
+    assert late.get_table()["Scored"].sum() == len(data)
+
+
+def test_relabel_requires_unlabelled_datapoints():
+    data = _get_data()
+    evaluation = RollingEvaluation("GT", "Score", "Time")
+    evaluation.update(data)
+    stats = {key: counts.copy() for key, counts in evaluation.stats.items()}
+    with pytest.raises(AssertionError):
+        evaluation.update(data, relabel=True)
+    assert all((evaluation.stats[key] == counts).all() for key, counts in stats.items())
+
+
+def test_rolling_must_be_positive():
+    evaluation = RollingEvaluation("GT", "Score", "Time")
+    evaluation.update(_get_data())
+    with pytest.raises(AssertionError):
+        evaluation.get_table(rolling=0)
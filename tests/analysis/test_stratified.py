@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+from arjcode.analysis import stratified_analysis
+
+
+def _get_data(n: int = 1000, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    gt = rng.integers(0, 2, n)
+    return pd.DataFrame(
+        {
+            "GT": gt,
+            "Score": np.clip(gt * 0.3 + rng.normal(0.35, 0.2, n), 0, 1),
+            "Site": rng.choice(["A", "B", "C"], n),
+            "Year": rng.choice([2024, 2025], n),
+        }
+    )
+
+
+def test_index_keeps_strata_dtypes():
+    # String strata are compacted to categoricals while aggregating, the table is indexed by the original values
+    data = _get_data()
+    table = stratified_analysis(data, "GT", "Score", ["Site", "Year"], return_df=True)
+    for name in ["Site", "Year"]:
+        level = table.index.get_level_values(name)
+        assert not isinstance(level.dtype, pd.CategoricalDtype), name
+        assert level.dtype == data[name].dtype, name
+
+    table = stratified_analysis(data, "GT", "Score", ["Site"], return_df=True)
+    assert table.index.dtype == data["Site"].dtype
+    assert list(table.index) == ["A", "B", "C"]
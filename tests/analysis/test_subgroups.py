@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+from arjcode.analysis import find_worst_subgroups, stratified_analysis
+
+COLUMNS = ["Sen", "Sen 95% CI Lower", "Spec 95% CI Upper", "AUC", "AUC 95% CI Lower", "AUC 95% CI Upper"]
+
+
+def _get_data(n: int = 4000, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    gt = rng.integers(0, 2, n)
+    site = rng.choice(["A", "B", "C"], n)
+    # The model is worse on site C
+    signal = np.where(site == "C", 0.1, 0.3)
+    return pd.DataFrame(
+        {
+            "GT": gt,
+            "Score": np.clip(gt * signal + rng.normal(0.35, 0.2, n), 0, 1).round(3),
+            "Site": site,
+            "Sex": rng.choice(["M", "F"], n),
+        }
+    )
+
+
+def test_metrics_match_stratified_analysis():
+    data = _get_data()
+    worst = find_worst_subgroups(data, "GT", "Score", ["Site", "Sex"], metric="AUC", max_depth=1, return_df=True)
+    assert worst.index[0] == ("C", "All")
+
+    table = stratified_analysis(data, "GT", "Score", ["Site"], table_columns=COLUMNS, return_df=True)
+    for site in ["A", "B", "C"]:
+        np.testing.assert_allclose(
+            worst.loc[(site, "All"), COLUMNS].to_numpy(dtype=float),
+            table.loc[site, COLUMNS].to_numpy(dtype=float),
+            rtol=1e-6,
+        )
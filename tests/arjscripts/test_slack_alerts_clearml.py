@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("clearml")
+pytest.importorskip("slack_sdk")
+from arjscripts.slack_alerts_clearml import TaskProgress  # noqa: E402
+
+
+def _count_alerts(get_iteration, duration=3600, poll_period=10):
+    # Alerts once when the task slows down, and again only after it has recovered, as `monitor_progress` does
+    progress = TaskProgress()
+    n_alerts = 0
+    for timestamp in range(0, duration, poll_period):
+        progress.update(get_iteration(timestamp), timestamp)
+        is_slow = progress.is_slow(timestamp)
+        n_alerts += is_slow and not progress.slowed_down
+        progress.slowed_down = is_slow
+    return n_alerts
+
+
+def _bursty(rate, report_period=60):
+    # ClearML reports the last iteration once every `report_period` seconds
+    def get_iteration(timestamp):
+        return int(rate * (timestamp // report_period * report_period))
+
+    return get_iteration
+
+
+def test_steady_bursty_task_never_alerts():
+    assert _count_alerts(_bursty(1.0)) == 0
+    assert _count_alerts(_bursty(1.0, report_period=25)) == 0
+
+
+def test_slowdown_alerts_once():
+    def get_iteration(timestamp):
+        reported = timestamp // 60 * 60
+        return reported if reported < 1800 else 1800 + (reported - 1800) // 4
+
+    assert _count_alerts(get_iteration) == 1
+
+
+def test_stall_alerts_once():
+    assert _count_alerts(lambda timestamp: min(_bursty(1.0)(timestamp), 1800)) == 1